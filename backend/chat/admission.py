@@ -0,0 +1,299 @@
+# backend/chat/admission.py
+import asyncio
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+
+
+class Overloaded(Exception):
+    """The upstream can't take this call now; try again after `retry_after` seconds."""
+    status_code = 429
+
+    def __init__(self, message, retry_after=1.0):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class QueueFull(Overloaded):
+    """Every slot is busy and the wait queue is full (or the wait ran out)."""
+
+
+class CircuitOpen(Overloaded):
+    """The upstream failed repeatedly; calls are refused until it has had time to recover."""
+    status_code = 503
+
+
+def is_upstream_failure(exc):
+    """Connection errors, timeouts, 5xx and 429 count against the upstream; other 4xx are our fault."""
+    if isinstance(exc, Overloaded):
+        return False
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    return not (status and 400 <= status < 500 and status != 429)
+
+
+def error_type(exc):
+    """Short label for an upstream error: "http_503", "ConnectTimeout", ..."""
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    return f"http_{status}" if status else type(exc).__name__
+
+
+class ConcurrencyLimiter:
+    """
+    At most max_concurrent calls at once, at most max_waiting callers queued behind
+    them, each for at most queue_seconds. Callers beyond that get QueueFull at once,
+    so a burst turns into a few quick "busy" replies instead of everyone timing out.
+
+    max_concurrent <= 0 disables the limit.
+    """
+
+    def __init__(self, name, max_concurrent=4, max_waiting=16, queue_seconds=10.0):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.queue_seconds = queue_seconds
+        self._cond = threading.Condition()
+        self.active = self.waiting = 0
+        self.admitted = self.rejected = 0
+        self.wait_seconds = 0.0
+        self.hold_seconds = 1.0  # moving average of one call, for Retry-After
+
+    def retry_after(self):
+        # time for the queue ahead of a new caller to drain
+        return self.hold_seconds * (self.waiting + 1) / max(self.max_concurrent, 1)
+
+    def check(self):
+        """Raise QueueFull if a caller arriving now would be turned away (reserves nothing)."""
+        if self.max_concurrent > 0 and self.active >= self.max_concurrent and self.waiting >= self.max_waiting:
+            with self._cond:
+                self.rejected += 1
+            raise QueueFull(f"{self.name} is busy", self.retry_after())
+
+    def try_acquire(self):
+        if self.max_concurrent <= 0:
+            return True
+        with self._cond:
+            if self.active < self.max_concurrent and not self.waiting:
+                self.active += 1
+                self.admitted += 1
+                return True
+        return False
+
+    def acquire(self):
+        if self.try_acquire():
+            return
+        start = time.monotonic()
+        with self._cond:
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise QueueFull(f"{self.name} is busy", self.retry_after())
+            self.waiting += 1
+            try:
+                admitted = self._cond.wait_for(lambda: self.active < self.max_concurrent, self.queue_seconds)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.rejected += 1
+                raise QueueFull(f"{self.name} is busy", self.retry_after())
+            self.active += 1
+            self.admitted += 1
+            self.wait_seconds += time.monotonic() - start
+
+    def release(self, held_seconds=None):
+        if self.max_concurrent <= 0:
+            return
+        with self._cond:
+            self.active -= 1
+            if held_seconds is not None:
+                self.hold_seconds = 0.9 * self.hold_seconds + 0.1 * held_seconds
+            self._cond.notify()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "mean_wait_ms": round(1000.0 * self.wait_seconds / self.admitted, 2) if self.admitted else 0.0,
+        }
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive upstream failures; while open, calls
+    fail fast with CircuitOpen. After reset_seconds one trial call is let through:
+    success closes the circuit, failure opens it again.
+
+    failure_threshold <= 0 disables the breaker.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.opens = self.refused = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.reset_seconds else "half-open"
+
+    def _refuse(self, retry_after):
+        self.refused += 1
+        raise CircuitOpen(f"{self.name} is unavailable", retry_after)
+
+    def check(self):
+        """Raise CircuitOpen if a call now would be refused (reserves nothing)."""
+        opened_at = self.opened_at
+        if opened_at is not None:
+            remaining = opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0 or self.trial:
+                with self._lock:
+                    self._refuse(max(remaining, 1.0))
+
+    def before(self):
+        if self.opened_at is None:
+            return
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.reset_seconds - time.monotonic()
+            if remaining > 0:
+                self._refuse(remaining)
+            if self.trial:
+                # one trial call at a time while half-open
+                self._refuse(1.0)
+            self.trial = True
+
+    def success(self):
+        if self.opened_at is None and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.trial or (self.opened_at is None and self.failures >= self.failure_threshold):
+                self.opens += 1
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+    def cancel(self):
+        """The call ended without telling us anything about the upstream (e.g. client went away)."""
+        with self._lock:
+            self.trial = False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opens": self.opens,
+            "refused": self.refused,
+        }
+
+
+class UpstreamGuard:
+    """
+    ConcurrencyLimiter + CircuitBreaker around the calls to one upstream server.
+
+        with guard.slot():
+            r = http.post(...)
+
+    Limits are per process: the server sees up to (worker processes x max_concurrent) calls.
+    """
+
+    def __init__(self, name, max_concurrent=4, max_waiting=16, queue_seconds=10.0,
+                 failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.limiter = ConcurrencyLimiter(name, max_concurrent, max_waiting, queue_seconds)
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_seconds)
+        self.errors = {}  # error_type -> count
+        # async callers park in the blocking acquire() on these threads, never on the loop's
+        # default executor (which the async path needs for retrieval); rebuilt after a fork
+        self._waiters = None
+        self._waiters_pid = None
+        self._waiters_lock = threading.Lock()
+
+    def _wait_pool(self):
+        with self._waiters_lock:
+            if self._waiters_pid != os.getpid():
+                self._waiters = ThreadPoolExecutor(
+                    max_workers=max(self.limiter.max_waiting, 1), thread_name_prefix=f"{self.name} wait",
+                )
+                self._waiters_pid = os.getpid()
+            return self._waiters
+
+    def check(self):
+        """Fast admission check before starting a request that will need this upstream."""
+        self.breaker.check()
+        self.limiter.check()
+
+    @contextmanager
+    def slot(self):
+        self.breaker.before()
+        try:
+            self.limiter.acquire()
+        except BaseException:
+            self.breaker.cancel()
+            raise
+        with self._held():
+            yield
+
+    @asynccontextmanager
+    async def aslot(self):
+        self.breaker.before()
+        try:
+            if not self.limiter.try_acquire():
+                # one wait thread per queue place: a full queue is refused here rather than
+                # piling up behind the wait threads
+                self.limiter.check()
+                future = asyncio.get_running_loop().run_in_executor(self._wait_pool(), self.limiter.acquire)
+                try:
+                    await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    # the thread may still get the slot after we've gone; hand it back
+                    future.add_done_callback(lambda f: f.cancelled() or f.exception() or self.limiter.release())
+                    raise
+        except BaseException:
+            self.breaker.cancel()
+            raise
+        with self._held():
+            yield
+
+    @contextmanager
+    def _held(self):
+        start = time.monotonic()
+        verdict = False
+        try:
+            yield
+        except Exception as e:
+            verdict = True
+            kind = error_type(e)
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            if is_upstream_failure(e):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        else:
+            verdict = True
+            self.breaker.success()
+        finally:
+            if not verdict:
+                self.breaker.cancel()
+            self.limiter.release(time.monotonic() - start)
+
+    def stats(self):
+        return dict(self.limiter.stats(), **self.breaker.stats())
@@ -0,0 +1,115 @@
+# backend/chat/answer_cache.py
+import hashlib
+import json
+import threading
+
+import numpy as np
+
+from .cache_backends import LRUCache, SQLiteCache
+from .embed_cache import normalize_query
+
+
+class AnswerCache:
+    """
+    Cache of LLM answers (plus the sources they were built from).
+
+    Exact key: (index version, brand, appliance, retrieved chunk ids, normalised
+    question). The index version is part of every key, so publishing a new index
+    or new manuals makes older entries unreachable; `invalidate()` also drops them
+    from memory.
+
+    With similarity > 0 a near-duplicate lookup is tried on a miss: the query
+    embedding is compared (cosine) against recent questions for the same
+    brand/appliance, and an entry at or above the threshold is reused. That part
+    is kept per worker, up to max_neighbours vectors per brand/appliance.
+    """
+
+    def __init__(self, max_entries=1024, ttl=6 * 3600, similarity=0.0, shared_path=None, max_neighbours=512):
+        self.local = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.shared = None
+        if shared_path:
+            self.shared = SQLiteCache(shared_path, table="answers", ttl=ttl, max_entries=max_entries * 50)
+        self.similarity = similarity
+        self.max_neighbours = max_neighbours
+        self._neighbours = {}  # (version, brand, appliance) -> (keys list, (n, d) unit vectors)
+        self._lock = threading.Lock()
+        self.hits = self.near_hits = self.misses = 0
+
+    @staticmethod
+    def _bucket(version, brand, appliance):
+        return version, (brand or "").lower(), (appliance or "").lower()
+
+    def key(self, version, brand, appliance, retrieved, question):
+        chunk_ids = [f"{r['file_name']}#{r['chunk_id']}" for r in retrieved]
+        raw = json.dumps([self._bucket(version, brand, appliance), chunk_ids, normalize_query(question)])
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _lookup(self, key):
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+        return entry
+
+    @staticmethod
+    def _unit(qvec):
+        v = np.asarray(qvec, dtype="float32").reshape(-1)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def get(self, version, brand, appliance, retrieved, question, qvec=None):
+        """Return (answer, sources) on a hit, else None."""
+        entry = self._lookup(self.key(version, brand, appliance, retrieved, question))
+        if entry is not None:
+            self.hits += 1
+            return entry["answer"], entry["sources"]
+
+        if self.similarity > 0 and qvec is not None:
+            with self._lock:
+                keys, vecs = self._neighbours.get(self._bucket(version, brand, appliance), ([], None))
+                if keys:
+                    scores = vecs @ self._unit(qvec)
+                    best = int(np.argmax(scores))
+                    near_key = keys[best] if scores[best] >= self.similarity else None
+                else:
+                    near_key = None
+            if near_key is not None:
+                entry = self._lookup(near_key)
+                if entry is not None:
+                    self.hits += 1
+                    self.near_hits += 1
+                    return entry["answer"], entry["sources"]
+
+        self.misses += 1
+        return None
+
+    def set(self, version, brand, appliance, retrieved, question, answer, qvec=None):
+        key = self.key(version, brand, appliance, retrieved, question)
+        entry = {"answer": answer, "sources": retrieved}
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry)
+
+        if self.similarity > 0 and qvec is not None:
+            bucket = self._bucket(version, brand, appliance)
+            with self._lock:
+                keys, vecs = self._neighbours.get(bucket, ([], None))
+                unit = self._unit(qvec)[None, :]
+                vecs = unit if vecs is None else np.vstack([vecs, unit])[-self.max_neighbours:]
+                keys = (keys + [key])[-self.max_neighbours:]
+                self._neighbours[bucket] = (keys, vecs)
+
+    def invalidate(self):
+        """Forget everything held in memory (the shared store's old keys simply stop matching)."""
+        self.local.clear()
+        with self._lock:
+            self._neighbours.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "near_duplicate_hits": self.near_hits,
+            "misses": self.misses,
+            "entries": len(self.local),
+        }
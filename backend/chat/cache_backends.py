@@ -0,0 +1,187 @@
+# backend/chat/cache_backends.py
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    In-process LRU cache with a size cap and a per-entry TTL. Thread-safe.
+
+    max_entries <= 0 disables the size cap; ttl <= 0 disables expiry.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expires_at, value = item
+            if expires_at and expires_at < now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl and ttl > 0 else 0
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while self.max_entries > 0 and len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        """Snapshot of (key, value) pairs that have not expired, oldest first."""
+        now = time.monotonic()
+        with self._lock:
+            return [(k, v) for k, (exp, v) in self._data.items() if not exp or exp >= now]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class SQLiteCache:
+    """
+    Cache in a SQLite file, shared by every worker process on the box.
+
+    Values go through `encode` / `decode` (JSON by default) and are stored as BLOBs.
+    Once more than max_entries rows exist, the oldest-written ones are dropped.
+    Database errors (e.g. a locked file) count as misses instead of failing the request.
+    """
+
+    PRUNE_EVERY = 100  # writes between expiry / size sweeps
+
+    def __init__(self, path, table="cache", max_entries=100000, ttl=3600,
+                 encode=None, decode=None):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.encode = encode or (lambda v: json.dumps(v).encode("utf-8"))
+        self.decode = decode or (lambda b: json.loads(bytes(b).decode("utf-8")))
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = self.misses = self.errors = 0
+        self.evictions = self.expirations = 0  # rows dropped by this process's sweeps
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._conn() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL, written_at REAL NOT NULL)"
+            )
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {table}_written ON {table} (written_at)")
+
+    def _conn(self):
+        # sqlite connections are per thread; WAL lets readers run while one worker writes
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key, default=None):
+        try:
+            row = self._conn().execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            self.misses += 1
+            return default
+        if row is None or (row[1] and row[1] < time.time()):
+            self.misses += 1
+            return default
+        self.hits += 1
+        return self.decode(row[0])
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        now = time.time()
+        expires_at = now + ttl if ttl and ttl > 0 else 0
+        try:
+            conn = self._conn()
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, written_at) VALUES (?, ?, ?, ?)",
+                (key, sqlite3.Binary(self.encode(value)), expires_at, now),
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self.prune(conn)
+        except sqlite3.Error:
+            self.errors += 1
+
+    def delete(self, key):
+        try:
+            self._conn().execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        except sqlite3.Error:
+            self.errors += 1
+
+    def clear(self):
+        try:
+            self._conn().execute(f"DELETE FROM {self.table}")
+        except sqlite3.Error:
+            self.errors += 1
+
+    def prune(self, conn=None):
+        conn = conn or self._conn()
+        cur = conn.execute(f"DELETE FROM {self.table} WHERE expires_at > 0 AND expires_at < ?", (time.time(),))
+        self.expirations += max(cur.rowcount, 0)
+        if self.max_entries > 0:
+            cur = conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY written_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.evictions += max(cur.rowcount, 0)
+
+    def __len__(self):
+        try:
+            return self._conn().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
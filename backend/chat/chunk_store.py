@@ -0,0 +1,144 @@
+# backend/chat/chunk_store.py
+import mmap
+import struct
+
+import numpy as np
+
+# Binary chunk store, one row per index position (same order as faiss_metadata.json).
+#
+#   header        MAGIC, n rows, n files, names blob bytes, text blob bytes
+#   file_ids      int32[n]     row -> position in the file name table
+#   chunk_ids     int32[n]
+#   page_starts   int32[n]     first / last manual page of the chunk, 0 if unknown
+#   page_ends     int32[n]     (v2 only)
+#   text_offsets  uint64[n+1]  row text is text_blob[off[i]:off[i+1]]
+#   name_offsets  uint64[n_files+1]
+#   names blob    utf-8 file names
+#   text blob     utf-8 chunk texts
+#
+# Opened with mmap, so every worker shares one page-cache copy and loading does no JSON parsing.
+MAGIC = b"CHUNKST2"
+MAGIC_V1 = b"CHUNKST1"  # no page columns; still readable
+HEADER = struct.Struct("<8sQQQQ")
+
+
+def write_chunk_store(path, rows):
+    """Write (file_name, chunk_id, text[, page_start, page_end]) rows, in index order, to `path`."""
+    names, name_pos = [], {}
+    file_ids, chunk_ids, texts, page_starts, page_ends = [], [], [], [], []
+    for file_name, chunk_id, text, *pages in rows:
+        if file_name not in name_pos:
+            name_pos[file_name] = len(names)
+            names.append(file_name)
+        file_ids.append(name_pos[file_name])
+        chunk_ids.append(int(chunk_id))
+        texts.append((text or "").encode("utf-8"))
+        page_starts.append(int(pages[0] or 0) if pages else 0)
+        page_ends.append(int(pages[1] or 0) if len(pages) > 1 else 0)
+
+    encoded_names = [n.encode("utf-8") for n in names]
+    text_offsets = np.zeros(len(texts) + 1, dtype="<u8")
+    np.cumsum([len(t) for t in texts], out=text_offsets[1:])
+    name_offsets = np.zeros(len(names) + 1, dtype="<u8")
+    np.cumsum([len(n) for n in encoded_names], out=name_offsets[1:])
+
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(texts), len(names), int(name_offsets[-1]), int(text_offsets[-1])))
+        f.write(np.asarray(file_ids, dtype="<i4").tobytes())
+        f.write(np.asarray(chunk_ids, dtype="<i4").tobytes())
+        f.write(np.asarray(page_starts, dtype="<i4").tobytes())
+        f.write(np.asarray(page_ends, dtype="<i4").tobytes())
+        f.write(text_offsets.tobytes())
+        f.write(name_offsets.tobytes())
+        f.write(b"".join(encoded_names))
+        f.write(b"".join(texts))
+
+
+def page_arrays(metadata):
+    """(page_starts, page_ends) int32 arrays for a metadata list or ChunkStore; 0 = unknown."""
+    if isinstance(metadata, ChunkStore):
+        return metadata.page_starts, metadata.page_ends
+    starts = np.fromiter((m.get("page_start", 0) for m in metadata), dtype="int32", count=len(metadata))
+    ends = np.fromiter((m.get("page_end", 0) for m in metadata), dtype="int32", count=len(metadata))
+    return starts, ends
+
+
+def metadata_arrays(metadata):
+    """
+    (file_names, file_ids, chunk_ids) for a metadata list or ChunkStore: row i is
+    file_names[file_ids[i]] # chunk_ids[i]. Lets search results be resolved with
+    numpy fancy indexing instead of one dict lookup per hit.
+    """
+    if isinstance(metadata, ChunkStore):
+        return metadata.file_names, metadata.file_ids, metadata.chunk_ids
+    names, name_pos = [], {}
+    file_ids = np.empty(len(metadata), dtype="int32")
+    chunk_ids = np.empty(len(metadata), dtype="int32")
+    for i, meta in enumerate(metadata):
+        pos = name_pos.get(meta["file_name"])
+        if pos is None:
+            pos = name_pos[meta["file_name"]] = len(names)
+            names.append(meta["file_name"])
+        file_ids[i] = pos
+        chunk_ids[i] = int(meta["chunk_id"])
+    return names, file_ids, chunk_ids
+
+
+class ChunkStore:
+    """
+    Read-only, mmap-backed view of a chunk store file.
+
+    Indexing a row returns the same {"file_name", "chunk_id"[, "page_start",
+    "page_end"]} dict as an entry of faiss_metadata.json, so it can stand in for the
+    metadata list; `text(i)` returns the chunk text. `file_ids` / `chunk_ids` /
+    `page_starts` / `page_ends` are numpy views for vectorised lookups.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, n, n_files, names_len, text_len = HEADER.unpack_from(self._mm, 0)
+        if magic not in (MAGIC, MAGIC_V1):
+            raise ValueError(f"{path} is not a chunk store")
+
+        off = HEADER.size
+        self.file_ids = np.frombuffer(self._mm, dtype="<i4", count=n, offset=off)
+        off += 4 * n
+        self.chunk_ids = np.frombuffer(self._mm, dtype="<i4", count=n, offset=off)
+        off += 4 * n
+        if magic == MAGIC:
+            self.page_starts = np.frombuffer(self._mm, dtype="<i4", count=n, offset=off)
+            self.page_ends = np.frombuffer(self._mm, dtype="<i4", count=n, offset=off + 4 * n)
+            off += 8 * n
+        else:
+            self.page_starts = self.page_ends = np.zeros(n, dtype="<i4")
+        self.text_offsets = np.frombuffer(self._mm, dtype="<u8", count=n + 1, offset=off)
+        off += 8 * (n + 1)
+        name_offsets = np.frombuffer(self._mm, dtype="<u8", count=n_files + 1, offset=off)
+        off += 8 * (n_files + 1)
+        # the file name table is tiny; decode it once
+        self.file_names = [
+            self._mm[off + int(s):off + int(e)].decode("utf-8")
+            for s, e in zip(name_offsets[:-1], name_offsets[1:])
+        ]
+        self._text_start = off + names_len
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def __getitem__(self, i):
+        meta = {"file_name": self.file_names[self.file_ids[i]], "chunk_id": int(self.chunk_ids[i])}
+        if self.page_starts[i]:
+            meta.update(page_start=int(self.page_starts[i]), page_end=int(self.page_ends[i]))
+        return meta
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def text(self, i):
+        start = self._text_start + int(self.text_offsets[i])
+        end = self._text_start + int(self.text_offsets[i + 1])
+        return self._mm[start:end].decode("utf-8")
@@ -0,0 +1,168 @@
+# backend/chat/chunker.py
+import re
+from collections import namedtuple
+
+# "--- PAGE 12 ---", "--- PAGE 12 (TEXT) ---", "--- PAGE 12 (OCR) ---" written by the extractor
+PAGE_RE = re.compile(r"^--- PAGE (\d+)(?: \([A-Z ]+\))? ---$")
+# numbered section headings: "3 INSTALLATION", "4.2 Ice Maker"
+NUMBERED_HEADING_RE = re.compile(r"^\d+(\.\d+)*\.?\s+[A-Z]")
+TROUBLESHOOTING_RE = re.compile(r"troubleshoot|before calling for service|error code", re.I)
+TABLE_COLUMNS_RE = re.compile(r"\b(problem|symptom|possible cause|causes?|solutions?|what to do|code)\b", re.I)
+# words and punctuation; close to what a BPE tokenizer produces for manual text
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+# language tabs printed on every page of bilingual manuals; not section headings
+RUNNING_HEADERS = {"ENGLISH", "ESPAÑOL", "ESPANOL", "FRANÇAIS", "FRANCAIS"}
+
+CHUNK_TOKENS = 350
+OVERLAP_TOKENS = 50
+
+Block = namedtuple("Block", "kind text page section table_header")
+
+
+def count_tokens(text):
+    return len(TOKEN_RE.findall(text))
+
+
+def truncate_tokens(text, max_tokens):
+    """The prefix of `text` holding at most max_tokens tokens."""
+    for n, match in enumerate(TOKEN_RE.finditer(text)):
+        if n == max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+
+def is_heading(line):
+    """Short all-caps lines ("TROUBLESHOOTING") and numbered section titles ("4.2 Ice Maker")."""
+    words = line.split()
+    if not words or len(words) > 10 or len(line) > 80:
+        return False
+    if sum(c.isalpha() for c in line) < 4:
+        return False
+    return line.isupper() or bool(NUMBERED_HEADING_RE.match(line))
+
+
+def iter_blocks(lines):
+    """
+    Stream extracted-text lines into blocks: headings, and paragraphs (runs of lines
+    ended by a blank line, heading or page marker). Each block carries its page,
+    the section heading it falls under and, inside troubleshooting sections, the
+    table's column header line.
+    """
+    page, section, table_header = 0, None, None
+    buf = []
+
+    def block():
+        return Block("text", "\n".join(buf), page, section, table_header)
+
+    for raw in lines:
+        line = raw.strip()
+        if line in RUNNING_HEADERS or (line and line == section):
+            # page furniture, or the section title repeated at the top of its next page
+            continue
+        marker = PAGE_RE.match(line)
+        if marker or not line or is_heading(line):
+            if buf:
+                yield block()
+                buf = []
+            if marker:
+                page = int(marker.group(1))
+            elif line:
+                section, table_header = line, None
+                yield Block("heading", line, page, section, None)
+            continue
+        if (section and TROUBLESHOOTING_RE.search(section) and table_header is None
+                and len(TABLE_COLUMNS_RE.findall(line)) >= 2):
+            table_header = line
+        buf.append(line)
+    if buf:
+        yield block()
+
+
+def _split_long_line(line, max_tokens):
+    words = line.split()
+    step = max(1, int(max_tokens / 1.5))  # words per piece; punctuation adds tokens
+    for start in range(0, len(words), step):
+        yield " ".join(words[start:start + step])
+
+
+def chunk_lines(lines, max_tokens=CHUNK_TOKENS, overlap=OVERLAP_TOKENS):
+    """
+    Pack a stream of extracted-text lines into chunks of at most ~max_tokens tokens.
+
+    Paragraphs are kept whole when they fit; a new section starts a new chunk once
+    the current one is half full; consecutive chunks share up to `overlap` tokens of
+    trailing lines. A chunk that starts inside a section is prefixed with the section
+    heading (and a troubleshooting table's column header), so it reads on its own.
+
+    Yields {"text", "page_start", "page_end", "section"}.
+    """
+    cur = []  # (line, tokens, page, is_new_content)
+    cur_tokens = 0
+
+    def emit():
+        content_pages = [p for _, _, p, new in cur if new and p]
+        return {
+            "text": "\n".join(line for line, _, _, _ in cur),
+            "page_start": min(content_pages) if content_pages else 0,
+            "page_end": max(content_pages) if content_pages else 0,
+            "section": section,
+        }
+
+    def tail():
+        kept, total = [], 0
+        for line, tokens, page, _ in reversed(cur):
+            if total + tokens > overlap:
+                break
+            kept.insert(0, (line, tokens, page, False))
+            total += tokens
+        return kept, total
+
+    section = None
+    for block in iter_blocks(lines):
+        if block.kind == "heading":
+            if any(new for *_, new in cur) and cur_tokens >= max_tokens // 2:
+                yield emit()
+                cur, cur_tokens = [], 0
+            section = block.section
+
+        context = [block.section] if block.section and block.kind != "heading" else []
+        if block.table_header and block.table_header not in block.text.split("\n")[:1]:
+            context.append(block.table_header)
+        context_tokens = sum(count_tokens(c) for c in context)
+        limit = max(8, max_tokens - overlap - context_tokens)
+
+        block_lines = []
+        for line in block.text.split("\n"):
+            tokens = count_tokens(line)
+            if tokens > limit:
+                block_lines.extend((piece, count_tokens(piece)) for piece in _split_long_line(line, limit))
+            else:
+                block_lines.append((line, tokens))
+        block_tokens = sum(t for _, t in block_lines)
+
+        # keep the paragraph whole: flush first if it fits in a fresh chunk but not in this one
+        if cur and cur_tokens + block_tokens > max_tokens and block_tokens <= limit and any(new for *_, new in cur):
+            yield emit()
+            cur, cur_tokens = tail()
+
+        for line, tokens in block_lines:
+            if cur and cur_tokens + tokens > max_tokens and any(new for *_, new in cur):
+                yield emit()
+                cur, cur_tokens = tail()
+            if not any(new for *_, new in cur) and context:
+                # chunk starts inside a section: lead with its heading / table header
+                present = {line_ for line_, *_ in cur}
+                head = [(c, count_tokens(c), block.page, False) for c in context if c not in present]
+                cur = head + cur
+                cur_tokens += sum(t for _, t, _, _ in head)
+            cur.append((line, tokens, block.page, True))
+            cur_tokens += tokens
+
+    if any(new for *_, new in cur):
+        yield emit()
+
+
+def chunk_file(path, max_tokens=CHUNK_TOKENS, overlap=OVERLAP_TOKENS):
+    """Chunk one extracted-text file, reading it line by line."""
+    with open(path, "r", encoding="utf-8") as f:
+        yield from chunk_lines(f, max_tokens, overlap)
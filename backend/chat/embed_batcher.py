@@ -0,0 +1,101 @@
+# backend/chat/embed_batcher.py
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent single-query embedding calls into batched requests.
+
+    Callers `submit(text)` and get a Future for their own row. A dispatcher
+    thread waits up to `window` seconds after the first pending text (or until
+    `max_batch` texts are queued), then hands the batch to `embed_batch(texts)`
+    on a small sender pool, so several batches can be in flight at once.
+    `embed_batch` must return one vector per input text, in order.
+    Identical texts in the same batch are embedded once.
+    """
+
+    def __init__(self, embed_batch, window=0.005, max_batch=32, max_in_flight=4):
+        self.embed_batch = embed_batch
+        self.window = window
+        self.max_batch = max_batch
+        self.max_in_flight = max_in_flight
+        self._pending = []  # (text, Future)
+        self._cond = threading.Condition()
+        self._pid = None
+        self._senders = None
+        self.batches = self.items = 0
+
+    def _start(self):
+        # the dispatcher thread and sender pool do not survive a fork (gunicorn --preload)
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pending = []
+        self._senders = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="embed-batch")
+        threading.Thread(target=self._dispatch, name="embed-batcher", daemon=True).start()
+
+    def submit(self, text):
+        future = Future()
+        with self._cond:
+            self._start()
+            self._pending.append((text, future))
+            self._cond.notify()
+        return future
+
+    def embed(self, text, timeout=None):
+        """Block for the vector; concurrent.futures.TimeoutError after `timeout` seconds."""
+        future = self.submit(text)
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            # still queued: drop it from the next batch (a batch already sent can't be recalled)
+            future.cancel()
+            raise
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.window
+                while len(self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._pending[:self.max_batch]
+                self._pending = self._pending[self.max_batch:]
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch):
+        # callers that gave up while the batch waited for a sender (cancelled futures) are
+        # dropped; the rest can no longer be cancelled
+        batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        texts = list(dict.fromkeys(text for text, _ in batch))
+        try:
+            vectors = self.embed_batch(texts)
+            if len(vectors) != len(texts):
+                raise ValueError(f"embedding server returned {len(vectors)} vectors for {len(texts)} inputs")
+            rows = dict(zip(texts, vectors))
+        except Exception as exc:
+            # every caller in the batch gets the error instead of waiting out its timeout
+            for _, future in batch:
+                future.set_exception(exc)
+            return
+        for text, future in batch:
+            future.set_result(rows[text])
+        self.batches += 1
+        self.items += len(batch)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "pending": len(self._pending),
+        }
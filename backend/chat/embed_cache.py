@@ -0,0 +1,78 @@
+# backend/chat/embed_cache.py
+import hashlib
+import re
+
+import numpy as np
+
+from .cache_backends import LRUCache, SQLiteCache
+
+_SPACES = re.compile(r"\s+")
+_EDGE_PUNCT = " \t\n?!.,;:"
+
+
+def normalize_query(text):
+    """Case-fold, collapse whitespace and drop surrounding punctuation: "Fridge not cooling?" == "fridge  not cooling"."""
+    return _SPACES.sub(" ", (text or "").lower()).strip(_EDGE_PUNCT)
+
+
+def cache_key(model, text):
+    return hashlib.sha1(f"{model}\0{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+
+def _encode_vector(vec):
+    return np.asarray(vec, dtype="<f4").tobytes()
+
+
+def _decode_vector(blob):
+    return np.frombuffer(bytes(blob), dtype="<f4")
+
+
+class EmbeddingCache:
+    """
+    Query-embedding cache: an in-process LRU in front of an optional shared SQLite
+    file, keyed on (model, normalised query text).
+
+    Lookups try the local LRU, then the shared store (copying hits into the LRU).
+    """
+
+    def __init__(self, max_entries=2048, ttl=86400, shared_path=None):
+        self.local = LRUCache(max_entries=max_entries, ttl=ttl)
+        self.shared = None
+        if shared_path:
+            self.shared = SQLiteCache(
+                shared_path, table="query_embeddings", ttl=ttl, max_entries=max_entries * 50,
+                encode=_encode_vector, decode=_decode_vector,
+            )
+        self.hits = self.shared_hits = self.misses = 0
+
+    def get(self, model, text):
+        key = cache_key(model, text)
+        vec = self.local.get(key)
+        if vec is not None:
+            self.hits += 1
+            return vec
+        if self.shared is not None:
+            vec = self.shared.get(key)
+            if vec is not None:
+                self.local.set(key, vec)
+                self.hits += 1
+                self.shared_hits += 1
+                return vec
+        self.misses += 1
+        return None
+
+    def set(self, model, text, vec):
+        key = cache_key(model, text)
+        vec = np.asarray(vec, dtype="float32").reshape(-1)
+        self.local.set(key, vec)
+        if self.shared is not None:
+            self.shared.set(key, vec)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "entries": len(self.local),
+            "evictions": self.local.evictions,
+        }
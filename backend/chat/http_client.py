@@ -0,0 +1,164 @@
+# backend/chat/http_client.py
+import asyncio
+import os
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# connections kept alive per upstream host, per worker process
+POOL_SIZE = int(os.environ.get("RAG_HTTP_POOL_SIZE", "10"))
+# the async path multiplexes many conversations per process, so it gets a bigger pool
+ASYNC_POOL_SIZE = int(os.environ.get("RAG_HTTP_ASYNC_POOL_SIZE", "100"))
+# retries on 429 / 503 and on failed connects, with exponential backoff: 0.5s, 1s, 2s ...
+# a Retry-After header from the server takes precedence over the backoff. A request that
+# was sent and then timed out or broke is never resent: the server may still be generating.
+MAX_RETRIES = int(os.environ.get("RAG_HTTP_RETRIES", "3"))
+BACKOFF_FACTOR = float(os.environ.get("RAG_HTTP_BACKOFF", "0.5"))
+RETRY_STATUSES = (429, 503)
+
+# httpx is only needed for the async (ASGI) chat path
+try:
+    import httpx
+except ImportError:  # pragma: no cover - optional dependency
+    httpx = None
+
+# (connect, read) timeouts per endpoint
+TIMEOUTS = {
+    "embed": (5, 30),
+    "llm": (5, 60),
+}
+DEFAULT_TIMEOUT = (5, 60)
+
+
+class UpstreamSession:
+    """
+    Keep-alive, pooled HTTP session for the NIM embedding / LLM endpoints.
+
+    One requests.Session shared by all threads of a worker: urllib3's pools are
+    thread-safe, and sharing them is what lets connections be reused across
+    chat requests instead of opening two new TCP connections per message.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            # a read timeout / dropped response means the upstream got the request: don't resend
+            read=False,
+            other=0,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            # resending is fine when the server refused up front (429 / 503) or never got the request
+            allowed_methods=frozenset({"GET", "POST"}),
+            respect_retry_after_header=True,
+            # hand the last 429/503 back so callers' raise_for_status() still fires
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+
+    def post(self, endpoint, url, **kwargs):
+        """POST using the timeout configured for `endpoint` ("embed" / "llm") unless one is given."""
+        kwargs.setdefault("timeout", TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+        return self.session.post(url, **kwargs)
+
+    def stats(self):
+        """Connections opened vs. reused, summed over every upstream pool."""
+        opened = requests_sent = 0
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            "requests": requests_sent,
+            "connections_opened": opened,
+            "connections_reused": max(requests_sent - opened, 0),
+        }
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """The per-process UpstreamSession, created on first use."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = UpstreamSession()
+    return _session
+
+
+class AsyncUpstreamSession:
+    """
+    asyncio counterpart of UpstreamSession, built on httpx.AsyncClient.
+
+    Same per-endpoint timeouts and 429/503 retry policy. An AsyncClient
+    is tied to the event loop it was created on, so one is kept per running loop.
+    """
+
+    def __init__(self, pool_size=ASYNC_POOL_SIZE, max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+        if httpx is None:
+            raise RuntimeError("The async chat path needs httpx: pip install httpx")
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self._clients = weakref.WeakKeyDictionary()  # event loop -> httpx.AsyncClient
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            client = httpx.AsyncClient(limits=limits)
+            self._clients[loop] = client
+        return client
+
+    def _delay(self, attempt, response):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.backoff_factor * (2 ** attempt)
+
+    async def post(self, endpoint, url, **kwargs):
+        connect, read = TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        kwargs.setdefault("timeout", httpx.Timeout(read, connect=connect))
+        client = self._client()
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = await client.post(url, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout):
+                # the request never reached the server; read timeouts etc. are not retried
+                if attempt == self.max_retries:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                    return response
+            await asyncio.sleep(self._delay(attempt, response))
+        return response
+
+
+_async_session = None
+
+
+def get_async_session():
+    """The per-process AsyncUpstreamSession, created on first use."""
+    global _async_session
+    if _async_session is None:
+        with _session_lock:
+            if _async_session is None:
+                _async_session = AsyncUpstreamSession()
+    return _async_session
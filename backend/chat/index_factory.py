@@ -0,0 +1,154 @@
+# backend/chat/index_factory.py
+import numpy as np
+import faiss
+
+# supported index types:
+#   flat      exact brute-force L2 (what the notebooks always built)
+#   ivf_flat  inverted lists over k-means cells, full vectors; tune `nprobe` at query time
+#   ivf_pq    inverted lists + product-quantized codes; smallest, least accurate
+#   hnsw      graph index, full vectors; tune `ef_search` at query time
+#   sq8       8-bit scalar quantized codes, exact scan (1 byte per dimension)
+#   fp16      half-precision codes, exact scan (2 bytes per dimension)
+#   pq        product-quantized codes, exact scan (pq_m bytes per vector at 8 bits)
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw", "sq8", "fp16", "pq")
+
+# types whose stored codes are lossy; pair them with an on-disk float store for exact re-ranking
+COMPRESSED_TYPES = ("ivf_pq", "sq8", "fp16", "pq")
+
+DEFAULT_BUILD_PARAMS = {
+    "nlist": 256,           # IVF cells
+    "pq_m": 64,             # PQ sub-quantizers (must divide the vector dimension)
+    "pq_nbits": 8,          # bits per PQ code
+    "hnsw_m": 32,           # HNSW neighbours per node
+    "ef_construction": 80,  # HNSW build-time beam width
+}
+
+# below this many vectors an exact scan is as fast as any ANN index (and IVF/PQ cannot train)
+MIN_ANN_VECTORS = 1000
+
+# types that are only worth it (or only trainable) on corpora of MIN_ANN_VECTORS or more;
+# sq8/fp16 train on any size and are kept so small partitions still get the memory saving
+SIZE_GATED_TYPES = ("ivf_flat", "ivf_pq", "hnsw", "pq")
+
+
+def _pq_nbits(params, n):
+    nbits = int(params["pq_nbits"])
+    while nbits > 1 and 2 ** nbits > n:
+        nbits -= 1
+    return nbits
+
+
+def _pq_m(params, dim):
+    m = int(params["pq_m"])
+    if dim % m:
+        raise ValueError(f"pq_m={m} does not divide vector dimension {dim}")
+    return m
+
+
+def factory_string(index_type, dim, n, params=None):
+    p = dict(DEFAULT_BUILD_PARAMS, **(params or {}))
+    if index_type == "flat":
+        return "Flat"
+    if index_type in ("ivf_flat", "ivf_pq"):
+        # faiss wants ~39 training points per cell; clamp so small corpora still train
+        nlist = max(1, min(int(p["nlist"]), n // 39))
+        if index_type == "ivf_flat":
+            return f"IVF{nlist},Flat"
+        return f"IVF{nlist},PQ{_pq_m(p, dim)}x{_pq_nbits(p, n)}"
+    if index_type == "hnsw":
+        return f"HNSW{int(p['hnsw_m'])}"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type == "fp16":
+        return "SQfp16"
+    if index_type == "pq":
+        return f"PQ{_pq_m(p, dim)}x{_pq_nbits(p, n)}"
+    raise ValueError(f"Unknown index type {index_type!r}; expected one of {INDEX_TYPES}")
+
+
+def build_index(vectors, index_type="flat", params=None, min_vectors=MIN_ANN_VECTORS):
+    """Build and fill an L2 index of the requested type from an (n, d) float32 array."""
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, dim = vectors.shape
+    if index_type in SIZE_GATED_TYPES and n < min_vectors:
+        index_type = "flat"
+
+    index = faiss.index_factory(dim, factory_string(index_type, dim, n, params), faiss.METRIC_L2)
+    if index_type == "hnsw":
+        p = dict(DEFAULT_BUILD_PARAMS, **(params or {}))
+        faiss.downcast_index(index).hnsw.efConstruction = int(p["ef_construction"])
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def _hnsw(index):
+    inner = faiss.downcast_index(index)
+    while hasattr(inner, "index") and not hasattr(inner, "hnsw"):
+        inner = faiss.downcast_index(inner.index)
+    return inner.hnsw if hasattr(inner, "hnsw") else None
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Apply query-time knobs; settings that do not apply to the index type are ignored."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe:
+        ivf.nprobe = min(int(nprobe), ivf.nlist)
+
+    hnsw = _hnsw(index)
+    if hnsw is not None and ef_search:
+        hnsw.efSearch = int(ef_search)
+    return index
+
+
+def filtered_search_params(index, selector):
+    """
+    faiss SearchParameters that restrict a search of `index` to the ids `selector` accepts,
+    keeping the nprobe / efSearch currently set on the index (pass as `params=` to search).
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    hnsw = _hnsw(index)
+    if hnsw is not None:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def reconstruct_all(index):
+    """Return every stored vector as an (ntotal, d) float32 array (IVF indexes get a direct map first)."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def bytes_per_vector(index):
+    """Serialized size of the index divided by its vector count (codes + any graph/list overhead)."""
+    if not index.ntotal:
+        return 0.0
+    return faiss.serialize_index(index).nbytes / float(index.ntotal)
+
+
+def rerank_exact(vectors, qvecs, candidates, k):
+    """
+    Re-score candidate ids with exact L2 distances against the float store and keep the best k.
+
+    vectors: (ntotal, d) float32 array, usually np.load(..., mmap_mode="r") so only the
+    candidate rows are paged in. candidates: (nq, c) ids with -1 for empty slots.
+    Returns (D, I) shaped (nq, k) like `index.search`.
+    """
+    D = np.full((len(candidates), k), np.finfo("float32").max, dtype="float32")
+    I = np.full((len(candidates), k), -1, dtype="int64")
+    for row, (q, cand) in enumerate(zip(qvecs, candidates)):
+        # sorted, de-duplicated ids keep reads from the mmap'd store sequential
+        cand = np.unique(cand[cand >= 0])
+        if not len(cand):
+            continue
+        diff = np.asarray(vectors[cand], dtype="float32") - q
+        dist = np.einsum("ij,ij->i", diff, diff)
+        top = np.argsort(dist)[:k]
+        D[row, :len(top)] = dist[top]
+        I[row, :len(top)] = cand[top]
+    return D, I
@@ -0,0 +1,145 @@
+# backend/chat/index_partitions.py
+import os
+import numpy as np
+import faiss
+
+from .index_factory import build_index, filtered_search_params, reconstruct_all, rerank_exact
+
+# manual file names look like "<Brand>_<Appliance>_<n>.txt", e.g. "LG_Fridge_1.txt" / "Sam_WM_2.txt"
+# map those prefixes onto the brand / appliance keys used by chat sessions
+BRAND_PREFIXES = {
+    "lg": "lg",
+    "sam": "samsung",
+    "samsung": "samsung",
+}
+APPLIANCE_PREFIXES = {
+    "fridge": "refrigerator",
+    "refrigerator": "refrigerator",
+    "wm": "washing-machine",
+    "washer": "washing-machine",
+}
+
+
+def partition_key(brand, appliance):
+    """Normalise a session's brand/appliance into a partition key, or None if either is missing."""
+    if not brand or not appliance:
+        return None
+    return brand.strip().lower(), appliance.strip().lower()
+
+
+def partition_for_file(file_name):
+    """Return the (brand, appliance) partition a manual belongs to, or None if the name is not recognised."""
+    parts = os.path.splitext(os.path.basename(file_name))[0].split("_")
+    if len(parts) < 2:
+        return None
+    brand = BRAND_PREFIXES.get(parts[0].lower())
+    appliance = APPLIANCE_PREFIXES.get(parts[1].lower())
+    if not brand or not appliance:
+        return None
+    return brand, appliance
+
+
+class PartitionedIndex:
+    """
+    One FAISS sub-index per (brand, appliance) on top of the global index.
+
+    Sub-indexes return positions into the global index / metadata list, so callers
+    never need to know which one answered. Searches for a partition that does not
+    exist fall back to the global index. Sub-indexes are built with the same
+    index type as the global one (small partitions stay flat, see index_factory).
+
+    With a float `vectors` store (the full-precision rows, normally mmap'd from
+    disk) and rerank_factor > 1, searches over compressed indexes fetch
+    k * rerank_factor candidates and re-score them exactly.
+
+    Use `build()` to create the sub-indexes from the global one, `save()` to write
+    them next to the index, and `load()` to open them again (optionally mmap'd).
+    `filtered()` keeps no sub-indexes at all: a partition search runs on the global
+    index restricted to the partition's ids, for layouts with no saved partitions.
+    """
+
+    def __init__(self, index, partitions=None, vectors=None, rerank_factor=1):
+        self.index = index
+        self.vectors = vectors
+        self.rerank_factor = rerank_factor if vectors is not None else 1
+        # (brand, appliance) -> (sub_index, global ids as int64 array); sub_index is an
+        # IDSelector over the global index for partitions made by `filtered()`
+        self.partitions = partitions or {}
+
+    @staticmethod
+    def group(metadata):
+        """(brand, appliance) -> global ids (int64 array) of the chunks from that partition's manuals."""
+        groups = {}
+        for pos, meta in enumerate(metadata):
+            key = partition_for_file(meta["file_name"])
+            if key is not None:
+                groups.setdefault(key, []).append(pos)
+        return {key: np.asarray(positions, dtype="int64") for key, positions in groups.items()}
+
+    @classmethod
+    def filtered(cls, index, metadata, vectors=None, rerank_factor=1):
+        """Partitions that search the global index through an id filter: no vectors are copied."""
+        partitions = {key: (faiss.IDSelectorBatch(ids), ids) for key, ids in cls.group(metadata).items()}
+        return cls(index, partitions, vectors, rerank_factor)
+
+    @classmethod
+    def build(cls, index, metadata, index_type="flat", params=None, vectors=None, rerank_factor=1):
+        groups = cls.group(metadata)
+        partitions = {}
+        if groups:
+            # prefer the exact float store; reconstructing from a compressed index is lossy
+            source = vectors if vectors is not None else reconstruct_all(index)
+            for key, ids in groups.items():
+                partitions[key] = (build_index(source[ids], index_type, params), ids)
+        return cls(index, partitions, vectors, rerank_factor)
+
+    @classmethod
+    def load(cls, directory, index, io_flags=0, vectors=None, rerank_factor=1):
+        """Open the sub-indexes written by `save()`; io_flags are passed to faiss.read_index."""
+        partitions = {}
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".index"):
+                continue
+            stem = name[:-len(".index")]
+            brand, _, appliance = stem.partition("__")
+            sub = faiss.read_index(os.path.join(directory, name), io_flags)
+            ids = np.load(os.path.join(directory, stem + ".ids.npy"), mmap_mode="r")
+            partitions[(brand, appliance)] = (sub, ids)
+        return cls(index, partitions, vectors, rerank_factor)
+
+    def save(self, directory):
+        """Write every sub-index as <brand>__<appliance>.index plus its global ids (.ids.npy)."""
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".index") or name.endswith(".ids.npy"):
+                os.remove(os.path.join(directory, name))
+        for (brand, appliance), (sub, ids) in self.partitions.items():
+            stem = f"{brand}__{appliance}"
+            faiss.write_index(sub, os.path.join(directory, stem + ".index"))
+            np.save(os.path.join(directory, stem + ".ids.npy"), np.asarray(ids, dtype="int64"))
+
+    def indexes(self):
+        """The global index followed by every sub-index (for applying search params)."""
+        return [self.index] + [sub for sub, _ in self.partitions.values() if isinstance(sub, faiss.Index)]
+
+    def rows(self, brand=None, appliance=None):
+        """Global ids in the brand/appliance partition, or None when searches use the global index."""
+        part = self.partitions.get(partition_key(brand, appliance))
+        return None if part is None else part[1]
+
+    def search(self, qvec, k, brand=None, appliance=None):
+        """Same contract as faiss `index.search`, restricted to the brand/appliance partition when one exists."""
+        fetch = k * self.rerank_factor if self.rerank_factor > 1 else k
+        part = self.partitions.get(partition_key(brand, appliance))
+        if part is None:
+            D, I = self.index.search(qvec, fetch)
+        elif not isinstance(part[0], faiss.Index):
+            D, I = self.index.search(qvec, fetch, params=filtered_search_params(self.index, part[0]))
+        else:
+            sub, ids = part
+            D, I = sub.search(qvec, fetch)
+            # sub-index returns -1 when it has fewer than k vectors; keep that marker
+            I = np.where(I >= 0, ids[np.maximum(I, 0)], -1)
+        if fetch > k:
+            return rerank_exact(self.vectors, qvec, I, k)
+        return D, I
@@ -0,0 +1,110 @@
+# backend/chat/index_versions.py
+import json
+import os
+import shutil
+import time
+import uuid
+
+# Published index layout:
+#
+#   vectorstore/manifest.json          {"current": "<version>", "published_at": ..., ...}
+#   vectorstore/versions/<version>/    faiss_index.bin, faiss_metadata.json, chunk_store.bin,
+#                                      faiss_vectors.npy, partitions/
+#
+# A version directory is never modified once the manifest points at it; publishing
+# writes a new directory and then swaps the manifest with one rename. Without a
+# manifest the files directly under vectorstore/ are used (the original layout).
+KEEP_VERSIONS = 3
+
+
+class IndexPaths:
+    """
+    File locations for one index version (or for the flat legacy layout), and the
+    index type the manifest says the version was built as (None when unknown).
+    """
+
+    def __init__(self, root, index_type=None):
+        self.root = root
+        self.index_type = index_type
+        self.index = os.path.join(root, "faiss_index.bin")
+        self.metadata = os.path.join(root, "faiss_metadata.json")
+        self.chunk_store = os.path.join(root, "chunk_store.bin")
+        self.vectors = os.path.join(root, "faiss_vectors.npy")
+        self.partitions = os.path.join(root, "partitions")
+        # text sources only used by the legacy layout
+        self.embeddings_json = os.path.join(root, "embeddings.json")
+        self.chunks_json = os.path.join(root, "chunks.json")
+
+    def published(self):
+        """The paths a version directory carries over from one publish to the next."""
+        return [self.index, self.metadata, self.chunk_store, self.vectors, self.partitions]
+
+
+class VersionStore:
+    """Reads the manifest and publishes new version directories under `data_dir`."""
+
+    def __init__(self, data_dir, keep=KEEP_VERSIONS):
+        self.data_dir = os.path.abspath(data_dir)
+        self.manifest_file = os.path.join(self.data_dir, "manifest.json")
+        self.versions_dir = os.path.join(self.data_dir, "versions")
+        self.keep = keep
+
+    def manifest(self):
+        try:
+            with open(self.manifest_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def current(self):
+        """(version, IndexPaths) from the manifest, or (None, legacy paths) when there is none."""
+        manifest = self.manifest()
+        if manifest and manifest.get("current"):
+            root = os.path.join(self.versions_dir, manifest["current"])
+            return manifest["current"], IndexPaths(root, manifest.get("index_type"))
+        return None, IndexPaths(self.data_dir)
+
+    def stage(self):
+        """
+        Start a new version: a private copy of the current version's files that the
+        caller may overwrite. Returns (version, IndexPaths); publish it with commit().
+        """
+        version = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        staging = IndexPaths(os.path.join(self.versions_dir, f".{version}.staging"))
+        os.makedirs(staging.root)
+        _, current = self.current()
+        # copies, not hard links: writers may overwrite files in place
+        for src, dst in zip(current.published(), staging.published()):
+            if os.path.isdir(src):
+                shutil.copytree(src, dst)
+            elif os.path.exists(src):
+                shutil.copy2(src, dst)
+        return version, staging
+
+    def commit(self, version, staging, **info):
+        """Move the staged directory into place, point the manifest at it and prune old versions."""
+        final = os.path.join(self.versions_dir, version)
+        os.replace(staging.root, final)
+        # carry forward what this publish did not change (e.g. index_type on a chunk store rebuild)
+        manifest = {k: v for k, v in (self.manifest() or {}).items() if k not in ("current", "published_at")}
+        manifest.update(info, current=version, published_at=time.strftime("%Y-%m-%dT%H:%M:%S%z"))
+        tmp = self.manifest_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, self.manifest_file)
+        self.prune(version)
+        return IndexPaths(final)
+
+    def discard(self, staging):
+        shutil.rmtree(staging.root, ignore_errors=True)
+
+    def prune(self, current):
+        # running workers may still have an older version open; unlinked mmaps stay
+        # valid, but keep a few so a rollback is a manifest edit away
+        older = sorted(
+            (n for n in os.listdir(self.versions_dir) if not n.startswith(".") and n != current),
+            key=lambda n: os.path.getmtime(os.path.join(self.versions_dir, n)),
+        )
+        keep_older = max(self.keep - 1, 0)
+        for name in older[:len(older) - keep_older]:
+            shutil.rmtree(os.path.join(self.versions_dir, name), ignore_errors=True)
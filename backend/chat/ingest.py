@@ -0,0 +1,291 @@
+# backend/chat/ingest.py
+import hashlib
+import json
+import os
+import shutil
+
+import faiss
+import numpy as np
+
+from . import rag_pipeline
+from .chunk_store import ChunkStore, write_chunk_store
+from .chunker import CHUNK_TOKENS, OVERLAP_TOKENS, chunk_file
+from .http_client import get_session
+from .index_factory import COMPRESSED_TYPES, build_index, reconstruct_all
+from .index_partitions import PartitionedIndex
+
+DATA_ROOT = os.path.abspath(os.path.join(rag_pipeline.DATA_DIR, ".."))
+EXTRACTED_DIR = os.path.join(DATA_ROOT, "extracted_texts")
+# chunks written by the chunking notebook; used to seed the registry the first time
+SOURCE_CHUNKS_JSON = os.path.join(DATA_ROOT, "chunks", "chunks.json")
+
+# ID-mapped master copy of every chunk vector, plus what each id holds
+# (file name, chunk id, text hash, text). Serving files are published from it.
+INGEST_DIR = os.path.join(os.path.abspath(rag_pipeline.DATA_DIR), "ingest")
+MASTER_INDEX_FILE = os.path.join(INGEST_DIR, "chunks.index")
+REGISTRY_FILE = os.path.join(INGEST_DIR, "registry.json")
+
+# "words": the notebook's 500-word windows (reproduces data/chunks/chunks.json, so
+# unchanged manuals hash identically); "tokens": chunker.py's structure-aware chunks
+CHUNKERS = ("tokens", "words")
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 50
+EMBED_BATCH_SIZE = 32
+
+
+def chunk_words(text, chunk_size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Split text into windows of chunk_size words, each overlapping the previous by `overlap` words."""
+    words = text.split()
+    chunks = []
+    start = 0
+    while start < len(words):
+        chunks.append(" ".join(words[start:start + chunk_size]))
+        start += chunk_size - overlap
+    return chunks
+
+
+def chunk_manual(path, chunker="tokens", size=None, overlap=None):
+    """Chunks of one extracted-text file as [{"text", "page_start", "page_end"}] (pages 0 if unknown)."""
+    if chunker == "words":
+        with open(path, "r", encoding="utf-8") as f:
+            texts = chunk_words(f.read(), size or CHUNK_SIZE, CHUNK_OVERLAP if overlap is None else overlap)
+        return [{"text": t, "page_start": 0, "page_end": 0} for t in texts]
+    return list(chunk_file(path, size or CHUNK_TOKENS, OVERLAP_TOKENS if overlap is None else overlap))
+
+
+def chunk_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def load_chunk_texts(paths=None, extra_sources=()):
+    """
+    {(file_name, chunk_id): text} from the given chunks / embeddings JSON files, the
+    chunking notebook's chunks.json, the legacy text files and the published chunk store.
+    Earlier sources win.
+    """
+    paths = paths or rag_pipeline.VERSION_STORE.current()[1]
+    texts = {}
+    for path in (*extra_sources, SOURCE_CHUNKS_JSON, rag_pipeline.CHUNKS_JSON, rag_pipeline.EMB_JSON):
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for c in json.load(f):
+                    if c.get("text"):
+                        texts.setdefault((c["file_name"], c["chunk_id"]), c["text"])
+    if os.path.exists(paths.chunk_store):
+        store = ChunkStore(paths.chunk_store)
+        for i, meta in enumerate(store):
+            texts.setdefault((meta["file_name"], meta["chunk_id"]), store.text(i))
+    return texts
+
+
+def embed_passages(texts, batch_size=EMBED_BATCH_SIZE):
+    """Embed document chunks (input_type "passage") in batches; returns an (n, dim) float32 array."""
+    http = get_session()
+    rows = []
+    for start in range(0, len(texts), batch_size):
+        payload = {"model": rag_pipeline.EMBED_MODEL,
+                   "input": texts[start:start + batch_size], "input_type": "passage"}
+        r = http.post("embed", rag_pipeline.EMBED_URL, json=payload)
+        r.raise_for_status()
+        rows.append(rag_pipeline.RAGPipeline.parse_embeddings(r.json()))
+    return np.vstack(rows) if rows else np.zeros((0, 0), dtype="float32")
+
+
+def replace_file(path, write):
+    """Write via `write(tmp_path)` next to `path`, then move it into place in one rename."""
+    tmp = path + ".tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+
+class ChunkRegistry:
+    """
+    Every indexed chunk, keyed by a stable int64 id, with its vector in a faiss
+    IndexIDMap2 (exact, so vectors can be reconstructed by id).
+
+    Replacing a manual only touches that manual's ids: unchanged chunks (same text
+    hash) keep their id and vector, chunks whose text already exists elsewhere
+    reuse that vector, and only genuinely new text is sent to the embedding server.
+    """
+
+    def __init__(self, index, entries, next_id):
+        self.index = index
+        self.entries = entries  # id -> {"file_name", "chunk_id", "hash", "text", "page_start", "page_end"}
+        self.next_id = next_id
+
+    @classmethod
+    def load(cls):
+        if not os.path.exists(REGISTRY_FILE):
+            return cls.seed()
+        with open(REGISTRY_FILE, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        entries = {int(e.pop("id")): e for e in state["entries"]}
+        return cls(faiss.read_index(MASTER_INDEX_FILE), entries, state["next_id"])
+
+    @classmethod
+    def seed(cls):
+        """First run: adopt the published index and metadata, using index positions as ids."""
+        _, paths = rag_pipeline.VERSION_STORE.current()
+        index = faiss.read_index(paths.index)
+        with open(paths.metadata, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        texts = load_chunk_texts(paths)
+
+        vectors = None
+        if os.path.exists(paths.vectors):
+            # the exact rows published next to a compressed index; its own codes are lossy
+            vectors = np.load(paths.vectors)
+        if vectors is None or vectors.shape != (index.ntotal, index.d):
+            vectors = reconstruct_all(index)
+        master = faiss.IndexIDMap2(faiss.IndexFlatL2(index.d))
+        master.add_with_ids(np.ascontiguousarray(vectors, dtype="float32"), np.arange(index.ntotal, dtype="int64"))
+        entries = {}
+        for pos, meta in enumerate(metadata):
+            text = texts.get((meta["file_name"], meta["chunk_id"]), "")
+            entries[pos] = {
+                "file_name": meta["file_name"],
+                "chunk_id": meta["chunk_id"],
+                # chunks with unknown text get an empty hash and are re-embedded on their next ingest
+                "hash": chunk_hash(text) if text else "",
+                "text": text,
+                "page_start": meta.get("page_start", 0),
+                "page_end": meta.get("page_end", 0),
+            }
+        return cls(master, entries, len(metadata))
+
+    def save(self):
+        os.makedirs(INGEST_DIR, exist_ok=True)
+        replace_file(MASTER_INDEX_FILE, lambda tmp: faiss.write_index(self.index, tmp))
+        state = {
+            "next_id": self.next_id,
+            "entries": [dict(e, id=i) for i, e in sorted(self.entries.items())],
+        }
+
+        def write(tmp):
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+        replace_file(REGISTRY_FILE, write)
+
+    def manual_ids(self, file_name):
+        return [i for i, e in self.entries.items() if e["file_name"] == file_name]
+
+    def remove_manual(self, file_name):
+        ids = self.manual_ids(file_name)
+        if ids:
+            self.index.remove_ids(np.asarray(ids, dtype="int64"))
+            for i in ids:
+                del self.entries[i]
+        return len(ids)
+
+    def replace_manual(self, file_name, chunks, embed=embed_passages):
+        """Make `chunks` (chunk_manual() output, chunk ids 1..n in order) those of `file_name`; returns counts."""
+        stale = {}  # hash -> [ids] among this manual's current chunks
+        for i in sorted(self.manual_ids(file_name)):
+            stale.setdefault(self.entries[i]["hash"], []).append(i)
+        known = {e["hash"]: i for i, e in self.entries.items() if e["hash"]}
+
+        stats = {"chunks": len(chunks), "unchanged": 0, "reused": 0, "embedded": 0, "removed": 0}
+        new_rows = []
+        for chunk_id, chunk in enumerate(chunks, 1):
+            h = chunk_hash(chunk["text"])
+            row = {"chunk_id": chunk_id, "page_start": chunk.get("page_start", 0), "page_end": chunk.get("page_end", 0)}
+            if stale.get(h):
+                self.entries[stale[h].pop(0)].update(row)
+                stats["unchanged"] += 1
+            else:
+                new_rows.append(dict(row, file_name=file_name, hash=h, text=chunk["text"]))
+
+        vectors = [None] * len(new_rows)
+        to_embed = []
+        for n, row in enumerate(new_rows):
+            if row["hash"] in known:
+                vectors[n] = self.index.reconstruct(known[row["hash"]])
+                stats["reused"] += 1
+            else:
+                to_embed.append(n)
+        if to_embed:
+            embedded = embed([new_rows[n]["text"] for n in to_embed])
+            for n, vec in zip(to_embed, embedded):
+                vectors[n] = vec
+            stats["embedded"] = len(to_embed)
+
+        gone = [i for ids in stale.values() for i in ids]
+        if gone:
+            self.index.remove_ids(np.asarray(gone, dtype="int64"))
+            for i in gone:
+                del self.entries[i]
+        stats["removed"] = len(gone)
+
+        if new_rows:
+            ids = np.arange(self.next_id, self.next_id + len(new_rows), dtype="int64")
+            self.index.add_with_ids(np.asarray(vectors, dtype="float32"), ids)
+            for i, row in zip(ids.tolist(), new_rows):
+                self.entries[i] = row
+            self.next_id += len(new_rows)
+        return stats
+
+    def ordered(self):
+        """(ids, vectors, entries) in id order, i.e. the order the serving index is written in."""
+        ids = faiss.vector_to_array(self.index.id_map).astype("int64")
+        vectors = self.index.index.reconstruct_n(0, self.index.ntotal)
+        order = np.argsort(ids)
+        ids = ids[order]
+        return ids, vectors[order], [self.entries[i] for i in ids.tolist()]
+
+
+def metadata_entry(entry):
+    """faiss_metadata.json row: file and chunk id, plus the page range when known."""
+    meta = {"file_name": entry["file_name"], "chunk_id": entry["chunk_id"]}
+    if entry.get("page_start"):
+        meta.update(page_start=entry["page_start"], page_end=entry["page_end"])
+    return meta
+
+
+def published_index_type():
+    """The index type the current version was published as (RAG_INDEX_TYPE for the legacy layout)."""
+    return rag_pipeline.VERSION_STORE.current()[1].index_type or rag_pipeline.INDEX_TYPE
+
+
+def publish(registry, index_type=None, params=None):
+    """
+    Publish the registry as a new index version: index, metadata, chunk store,
+    partitions and (for compressed types) float vectors, all written into a fresh
+    version directory that the manifest then points at. `index_type` defaults to
+    the current version's. Returns (version, index, partitions).
+    """
+    index_type = index_type or published_index_type()
+    params = dict(rag_pipeline.INDEX_BUILD_PARAMS, **(params or {}))
+    _, vectors, entries = registry.ordered()
+    metadata = [metadata_entry(e) for e in entries]
+
+    index = build_index(vectors, index_type, params)
+    partitions = PartitionedIndex.build(index, metadata, index_type, params, vectors=vectors)
+
+    store = rag_pipeline.VERSION_STORE
+    version, staging = store.stage()
+    try:
+        write_version(staging, index, metadata, partitions,
+                      ((e["file_name"], e["chunk_id"], e["text"], e.get("page_start", 0), e.get("page_end", 0))
+                       for e in entries),
+                      vectors if index_type in COMPRESSED_TYPES else None)
+    except Exception:
+        store.discard(staging)
+        raise
+    store.commit(version, staging, index_type=index_type, ntotal=int(index.ntotal), source="ingest_manual")
+    return version, index, partitions
+
+
+def write_version(paths, index, metadata, partitions, chunk_rows, vectors=None):
+    """Write a complete set of serving files into a (staging) version directory."""
+    faiss.write_index(index, paths.index)
+    with open(paths.metadata, "w", encoding="utf-8") as f:
+        json.dump(metadata, f)
+    write_chunk_store(paths.chunk_store, chunk_rows)
+    shutil.rmtree(paths.partitions, ignore_errors=True)
+    partitions.save(paths.partitions)
+    if vectors is not None:
+        # exact float rows for re-ranking; read back with mmap_mode="r"
+        np.save(paths.vectors, vectors)
+    elif os.path.exists(paths.vectors):
+        # rows no longer match the new index
+        os.remove(paths.vectors)
@@ -0,0 +1,210 @@
+# backend/chat/jobs.py
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Exists, F, OuterRef
+from django.utils import timezone
+
+from .admission import Overloaded
+from .metrics import CHAT_REQUESTS, Timings
+from .models import ChatJob
+from .rag_pipeline import FALLBACK_ANSWER
+
+logger = logging.getLogger(__name__)
+
+# answer every POST /api/chat/ in the background (clients can also opt in per request
+# with the "Prefer: respond-async" header)
+ASYNC_JOBS = os.environ.get("RAG_CHAT_ASYNC_JOBS", "0") != "0"
+# worker threads started inside the web process on the first queued job; set to 0
+# when `manage.py run_chat_workers` runs the queue in separate processes
+INLINE_WORKERS = int(os.environ.get("RAG_CHAT_INLINE_WORKERS", "2"))
+# idle workers check the table this often (inline workers are also woken on enqueue)
+POLL_SECONDS = float(os.environ.get("RAG_CHAT_JOB_POLL_SECONDS", "0.5"))
+# a job "running" for longer than this is assumed lost with its worker and re-queued
+STALE_SECONDS = int(os.environ.get("RAG_CHAT_JOB_STALE_SECONDS", "300"))
+MAX_ATTEMPTS = int(os.environ.get("RAG_CHAT_JOB_MAX_ATTEMPTS", "3"))
+# queued jobs looked at per claim attempt
+CLAIM_BATCH = 20
+
+_wakeup = threading.Event()
+_inline = {"pid": None, "workers": []}
+_inline_lock = threading.Lock()
+
+
+def enqueue(chat, appliance, brand):
+    """Queue a background answer for a pending ChatMessage. Call inside the transaction that saved it."""
+    job = ChatJob.objects.create(
+        message=chat, session_id=chat.session_id or "", appliance=appliance, brand=brand,
+    )
+    transaction.on_commit(_wakeup.set)
+    if INLINE_WORKERS > 0:
+        transaction.on_commit(start_inline_workers)
+    return job
+
+
+def requeue_stale():
+    """Put jobs whose worker died back on the queue; give up after MAX_ATTEMPTS. Returns jobs touched."""
+    cutoff = timezone.now() - timedelta(seconds=STALE_SECONDS)
+    stale = ChatJob.objects.filter(status="running", started_at__lt=cutoff)
+    touched = stale.filter(attempts__lt=MAX_ATTEMPTS).update(status="queued", worker="")
+    for job in stale.select_related("message"):
+        finish(job, None, [], {}, error="worker lost the job %d times" % job.attempts)
+        touched += 1
+    return touched
+
+
+def claim_next(worker):
+    """
+    Claim the oldest queued job and mark it running, or return None.
+
+    Jobs of one session run in order, one at a time: a follow-up needs the answer
+    before it. The claim is one conditional UPDATE that also requires no running and
+    no older queued job in the same session, so workers in other threads or processes
+    cannot both claim from one session. (SQLite runs UPDATEs one at a time; on a
+    database with concurrent writers this needs SERIALIZABLE isolation.)
+    """
+    same_session = ChatJob.objects.filter(session_id=OuterRef("session_id"))
+    running = same_session.filter(status="running")
+    older = same_session.filter(status="queued", id__lt=OuterRef("id"))
+    # skips sessions that were busy when the candidates were read; the UPDATE re-checks
+    busy = set(ChatJob.objects.filter(status="running").values_list("session_id", flat=True))
+    candidates = ChatJob.objects.filter(status="queued").order_by("id").values_list("id", "session_id")
+    for job_id, session_id in candidates[:CLAIM_BATCH]:
+        if session_id in busy:
+            continue
+        # a later job of the same session waits for this one
+        busy.add(session_id)
+        claimed = ChatJob.objects.filter(id=job_id, status="queued").filter(~Exists(running), ~Exists(older)).update(
+            status="running", worker=worker, started_at=timezone.now(), attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return ChatJob.objects.select_related("message").get(id=job_id)
+    return None
+
+
+def finish(job, answer, sources, usage, error=""):
+    """Store the answer (or the fallback answer when `answer` is None) on the message and close the job."""
+    chat = job.message
+    chat.response = FALLBACK_ANSWER if answer is None else answer
+    chat.sources = sources
+    chat.prompt_tokens = usage.get("prompt_tokens")
+    chat.completion_tokens = usage.get("completion_tokens")
+    chat.status = "failed" if error else "done"
+    job.status = chat.status
+    job.error = error
+    job.finished_at = timezone.now()
+    with transaction.atomic():
+        # updated_at must be listed for auto_now to apply; it invalidates the history ETag
+        chat.save(update_fields=[
+            "response", "sources", "prompt_tokens", "completion_tokens", "status", "updated_at",
+        ])
+        job.save(update_fields=["status", "error", "finished_at"])
+
+
+def run_job(job):
+    from .views import count_outcome, rag, store_timings
+
+    chat = job.message
+    usage = {}
+    timings = Timings()
+    timings.record("queue_wait", (job.started_at - job.created_at).total_seconds())
+    try:
+        answer, sources = rag.answer_query(
+            chat.message,
+            appliance=job.appliance,
+            brand=job.brand,
+            session_id=job.session_id,
+            usage=usage,
+            timings=timings,
+        )
+    except Overloaded as e:
+        # back on the queue without using up an attempt; this worker holds off meanwhile
+        CHAT_REQUESTS.inc(endpoint="job", outcome="busy")
+        ChatJob.objects.filter(id=job.pk).update(status="queued", worker="", attempts=F("attempts") - 1)
+        job.status = "queued"
+        time.sleep(min(e.retry_after, POLL_SECONDS * 10))
+        return
+    except Exception as e:
+        count_outcome("job", timings, e)
+        with timings.span("save"):
+            finish(job, None, [], usage, error=f"{type(e).__name__}: {e}")
+        store_timings(chat, timings)
+        timings.finish()
+        return
+    count_outcome("job", timings)
+    with timings.span("save"):
+        finish(job, answer, sources, usage)
+    store_timings(chat, timings)
+    timings.finish()
+
+
+class JobWorker(threading.Thread):
+    """Claims and answers queued ChatJobs until stop() is called."""
+
+    def __init__(self, index=0, poll_seconds=POLL_SECONDS):
+        super().__init__(name=f"chat-worker-{index}", daemon=True)
+        self.poll_seconds = poll_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{self.name}"
+        self._stop_event = threading.Event()
+        self.done = self.failed = 0
+
+    def stop(self):
+        self._stop_event.set()
+        _wakeup.set()
+
+    def run(self):
+        idle_polls = 0
+        while not self._stop_event.is_set():
+            close_old_connections()
+            try:
+                job = claim_next(self.worker_id)
+                if job is None and idle_polls % 100 == 0:
+                    requeue_stale()
+            except Exception:
+                logger.exception("Claiming a chat job failed")
+                job = None
+            if job is None:
+                idle_polls += 1
+                _wakeup.wait(self.poll_seconds)
+                _wakeup.clear()
+                continue
+            idle_polls = 0
+            try:
+                run_job(job)
+            except Exception:
+                # e.g. the database went away mid-save; the job goes stale and is retried
+                logger.exception("Saving chat job %s failed", job.pk)
+            if job.status == "done":
+                self.done += 1
+            elif job.status == "failed":
+                self.failed += 1
+        close_old_connections()
+
+
+def start_workers(count, poll_seconds=POLL_SECONDS):
+    workers = [JobWorker(i, poll_seconds) for i in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers
+
+
+def start_inline_workers():
+    """Start INLINE_WORKERS job threads in this process, once per process."""
+    with _inline_lock:
+        if _inline["pid"] == os.getpid():
+            return
+        _inline["pid"] = os.getpid()
+        _inline["workers"] = start_workers(INLINE_WORKERS)
+        logger.info("Started %d inline chat job workers", INLINE_WORKERS)
+
+
+def queue_stats():
+    """Job counts by status."""
+    counts = dict.fromkeys(("queued", "running", "done", "failed"), 0)
+    counts.update(ChatJob.objects.order_by().values_list("status").annotate(n=Count("id")))
+    return counts
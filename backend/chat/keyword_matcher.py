@@ -0,0 +1,93 @@
+# backend/chat/keyword_matcher.py
+import json
+import re
+
+
+def load_keyword_tables(path):
+    """
+    Read keyword tables from JSON: {category: {key: [phrases]}} or {category: [phrases]}
+    (the phrase is then its own key). Keys starting with "_" are comments.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    tables = {}
+    for category, table in raw.items():
+        if category.startswith("_"):
+            continue
+        if isinstance(table, list):
+            table = {phrase: [phrase] for phrase in table}
+        tables[category] = {key: list(phrases) for key, phrases in table.items()}
+    return tables
+
+
+def _trie_pattern(phrases):
+    """
+    One regex for a set of normalised phrases, with shared prefixes factored out
+    ("wash(?:er(?:s)?|ing...)"), so matching at a position costs about the length of
+    the longest phrase there, however many phrases the tables hold.
+    """
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for ch in phrase:
+            node = node.setdefault(ch, {})
+        node[""] = {}  # end of a phrase
+    return _node_pattern(trie)
+
+
+def _node_pattern(node):
+    # "washing machine" also matches "washing-machine" and "washing  machine"
+    branches = [
+        (r"[\s\-]+" if ch == " " else re.escape(ch)) + _node_pattern(child)
+        for ch, child in sorted(node.items()) if ch
+    ]
+    if not branches:
+        return ""
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    # optional (greedy) continuation: the longest phrase wins, shorter ones on backtracking
+    return f"(?:{body})?" if "" in node else body
+
+
+class KeywordMatcher:
+    """
+    Every keyword table compiled into one case-insensitive, word-bounded regex.
+
+    `match(text)` makes one pass over the text and returns {category: {keys}} for all
+    tables at once, so adding phrases, appliances or categories grows the automaton
+    built at startup rather than the per-request work. Whole words only: "this"
+    does not match "thistle". A phrase inside a longer match does not count on its
+    own, so "dish washers" is a dishwasher, not also a washer.
+    """
+
+    def __init__(self, tables):
+        self.categories = list(tables)
+        # normalised phrase -> [(category, key)]
+        self.phrases = {}
+        for category, table in tables.items():
+            for key, phrases in table.items():
+                for phrase in phrases:
+                    self.phrases.setdefault(self._normalise(phrase), []).append((category, key))
+        # the lookahead lets matches that start at different positions overlap
+        trie = _trie_pattern(self.phrases)
+        self.regex = re.compile(rf"(?=(?<!\w)({trie})(?!\w))", re.IGNORECASE) if self.phrases else None
+
+    @staticmethod
+    def _normalise(text):
+        return " ".join(text.lower().replace("-", " ").split())
+
+    def match(self, text):
+        found = {category: set() for category in self.categories}
+        if self.regex is None or not text:
+            return found
+        covered = 0  # end of the furthest match so far; finditer yields matches by start
+        for m in self.regex.finditer(text):
+            if m.end(1) <= covered:
+                continue
+            covered = m.end(1)
+            for category, key in self.phrases[self._normalise(m.group(1))]:
+                found[category].add(key)
+        return found
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(load_keyword_tables(path))
@@ -0,0 +1,156 @@
+# backend/chat/lexical_index.py
+import re
+from collections import Counter
+
+import numpy as np
+
+WORD_RE = re.compile(r"[A-Za-z0-9]+")
+# two-letter words that look like display codes when typed in capitals
+NOT_CODES = {
+    "AM", "AN", "AT", "BE", "BY", "DO", "EN", "ES", "FR", "GO", "HI", "IF", "IN", "IS", "IT", "LG",
+    "ME", "MY", "NO", "OF", "OK", "ON", "OR", "PM", "QR", "SO", "TO", "TV", "UP", "US", "WE",
+}
+# where the manuals print display codes: a troubleshooting table's code column (a line
+# holding only codes, e.g. "dE1 / dEz") in a passage about errors or codes, or running
+# text such as 'the "4C" code' / "the OE message"
+CODE_CONTEXT_RE = re.compile(r"\b(errors?|codes?|displays?|troubleshoot\w*)\b", re.I)
+CODE_LINE_RE = re.compile(r"^\s*[A-Za-z0-9]{2,4}(\s*[/,]\s*[A-Za-z0-9]{2,4})*\s*$")
+CODE_MENTION_RE = re.compile(r"\b([A-Za-z0-9]{2,4}(?:\s*/\s*[A-Za-z0-9]{2,4})*)[\"\u201d']?\s+(?:error\s+)?(?:code|message)s?\b")
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def is_code(word):
+    """
+    Words shaped like a code on an appliance display: "OE", "dE", "LE", "4C", "1E", "E21".
+    Letters-only codes are two characters, all caps or with a capital after a small letter;
+    codes with digits have a capital letter, so "3rd", "10mm" and "v1" are not codes.
+    Only the shape: whether the manuals use it as a code is up to display_codes().
+    """
+    if not 2 <= len(word) <= 4 or word in NOT_CODES:
+        return False
+    if any(c.isdigit() for c in word):
+        return any(c.isupper() for c in word)
+    return len(word) == 2 and (word.isupper() or (word[0].islower() and word[1].isupper()))
+
+
+def display_codes(text):
+    """Code-shaped words that `text` (a chunk of a manual) prints as display codes."""
+    codes = set()
+    in_context = CODE_CONTEXT_RE.search(text) is not None
+    for line in text.split("\n"):
+        if in_context and CODE_LINE_RE.match(line):
+            codes.update(w for w in WORD_RE.findall(line) if is_code(w))
+        for m in CODE_MENTION_RE.finditer(line):
+            codes.update(w for w in WORD_RE.findall(m.group(1)) if is_code(w))
+    return codes
+
+
+def tokenize(text):
+    """
+    Lowercased alphanumeric words. Code-like words also get a case-preserving
+    "#" token, so "dE" (door error) does not match every Spanish "de".
+    """
+    tokens = []
+    for word in WORD_RE.findall(text):
+        tokens.append(word.lower())
+        if is_code(word):
+            tokens.append("#" + word)
+    return tokens
+
+
+def reciprocal_rank_fusion(ranked_lists, k=60):
+    """Merge ranked lists of row ids: score(row) = sum of 1 / (k + rank). Returns rows, best first."""
+    scores = {}
+    for ranked in ranked_lists:
+        for rank, row in enumerate(ranked, 1):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (k + rank)
+    return sorted(scores, key=lambda row: -scores[row])
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the chunk texts, with rows numbered like the FAISS index and metadata.
+
+    Postings for every term live in two flat arrays (row ids, term frequencies)
+    sliced by `offsets`, so the index is a vocabulary dict plus a few numpy arrays.
+    `codes` are the display codes the indexed manuals print (see display_codes).
+    """
+
+    def __init__(self, vocab, offsets, rows, tfs, doc_lens, k1=BM25_K1, b=BM25_B, codes=()):
+        self.vocab = vocab  # term -> term id
+        self.codes = frozenset(codes)
+        self.offsets = offsets  # postings of term t: rows[offsets[t]:offsets[t + 1]]
+        self.rows = rows
+        self.tfs = tfs
+        self.ntotal = len(doc_lens)
+        df = np.diff(offsets).astype("float32")
+        self.idf = np.log1p((self.ntotal - df + 0.5) / (df + 0.5)).astype("float32")
+        avg_len = float(doc_lens.mean()) if self.ntotal and doc_lens.mean() > 0 else 1.0
+        # per-row length normalisation, the part of the BM25 denominator that doesn't depend on tf
+        self.norm = (k1 * (1 - b + b * doc_lens / avg_len)).astype("float32")
+        self.k1 = k1
+
+    @classmethod
+    def build(cls, texts, k1=BM25_K1, b=BM25_B):
+        postings = {}
+        lengths = []
+        codes = set()
+        for row, text in enumerate(texts):
+            codes.update(display_codes(text or ""))
+            counts = Counter(tokenize(text or ""))
+            lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings.setdefault(term, []).append((row, tf))
+
+        vocab, offsets, rows, tfs = {}, [0], [], []
+        for term_id, (term, plist) in enumerate(postings.items()):
+            vocab[term] = term_id
+            rows.extend(row for row, _ in plist)
+            tfs.extend(tf for _, tf in plist)
+            offsets.append(len(rows))
+        return cls(
+            vocab, np.asarray(offsets, dtype="int64"), np.asarray(rows, dtype="int32"),
+            np.asarray(tfs, dtype="float32"), np.asarray(lengths, dtype="float32"), k1, b, codes,
+        )
+
+    def scores(self, query):
+        return self.term_scores(set(tokenize(query)))
+
+    def term_scores(self, terms):
+        scores = np.zeros(self.ntotal, dtype="float32")
+        for term in terms:
+            t = self.vocab.get(term)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            rows, tf = self.rows[start:end], self.tfs[start:end]
+            scores[rows] += self.idf[t] * tf * (self.k1 + 1) / (tf + self.norm[rows])
+        return scores
+
+    def search(self, query, k, rows=None):
+        """
+        Top-k (rows, scores) for `query`, best first, optionally only among `rows`
+        (e.g. one brand/appliance partition). Rows that share no term are left out.
+        """
+        return self._top(self.scores(query), k, rows)
+
+    def code_search(self, codes, k, rows=None):
+        """Top-k (rows, scores) of the rows that print any of the display `codes`, best first."""
+        return self._top(self.term_scores({"#" + code for code in codes}), k, rows)
+
+    def _top(self, scores, k, rows):
+        candidates = np.arange(self.ntotal) if rows is None else np.asarray(rows, dtype="int64")
+        sub = scores[candidates]
+        if k < len(sub):
+            top = np.argpartition(-sub, k)[:k]
+        else:
+            top = np.arange(len(sub))
+        top = top[np.argsort(-sub[top], kind="stable")]
+        top = top[sub[top] > 0]
+        return candidates[top], sub[top]
+
+    def code_terms(self, query):
+        """Words of `query` that the indexed manuals print as display codes ("OE", "4C")."""
+        return [w for w in WORD_RE.findall(query) if w in self.codes]
@@ -0,0 +1,116 @@
+import time
+
+import faiss
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from chat import rag_pipeline
+from chat.index_factory import (
+    COMPRESSED_TYPES, INDEX_TYPES, build_index, bytes_per_vector, reconstruct_all, rerank_exact, set_search_params,
+)
+
+
+def exact_neighbours(corpus, queries, k):
+    flat = faiss.IndexFlatL2(corpus.shape[1])
+    flat.add(corpus)
+    return flat.search(queries, k)[1]
+
+
+def recall_at_k(found, truth):
+    k = truth.shape[1]
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / float(truth.shape[0] * k)
+
+
+def synthetic_corpus(n, dim, n_queries, rng, n_clusters=200):
+    # clustered gaussians look more like real embeddings than uniform noise
+    centers = rng.standard_normal((n_clusters, dim)).astype("float32")
+    corpus = centers[rng.integers(0, n_clusters, n)] + 0.3 * rng.standard_normal((n, dim)).astype("float32")
+    queries = centers[rng.integers(0, n_clusters, n_queries)] + 0.3 * rng.standard_normal((n_queries, dim)).astype("float32")
+    return corpus, queries
+
+
+class Command(BaseCommand):
+    help = (
+        "Recall@k, recall loss, bytes per vector and single-query latency (p50/p99) of each "
+        "index type against the exact flat index. Compressed types are also measured with exact "
+        "re-ranking from a float store (rows marked +rr)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--types", default=",".join(INDEX_TYPES))
+        parser.add_argument("--k", type=int, default=4)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--synthetic-sizes", default="10000,100000",
+                            help="comma separated corpus sizes; empty string to skip")
+        parser.add_argument("--dim", type=int, default=None,
+                            help="synthetic vector dimension (defaults to the real index dimension)")
+        parser.add_argument("--nlist", type=int, help="IVF cells")
+        parser.add_argument("--pq-m", type=int, help="PQ sub-quantizers")
+        parser.add_argument("--pq-nbits", type=int, help="bits per PQ code")
+        parser.add_argument("--hnsw-m", type=int, help="HNSW neighbours per node")
+        parser.add_argument("--nprobe", type=int, default=rag_pipeline.SEARCH_NPROBE)
+        parser.add_argument("--ef-search", type=int, default=rag_pipeline.SEARCH_EF)
+        parser.add_argument("--rerank-factor", type=int, default=rag_pipeline.RERANK_FACTOR,
+                            help="candidates fetched per result for the +rr rows; 1 skips them")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        rng = np.random.default_rng(opts["seed"])
+        types = [t for t in opts["types"].split(",") if t]
+        k, n_queries = opts["k"], opts["queries"]
+        params = dict(rag_pipeline.INDEX_BUILD_PARAMS)
+        for name in ("nlist", "pq_m", "pq_nbits", "hnsw_m"):
+            if opts[name] is not None:
+                params[name] = opts[name]
+
+        # real corpus: vectors from faiss_index.bin, queries are perturbed corpus rows
+        real = reconstruct_all(faiss.read_index(rag_pipeline.VERSION_STORE.current()[1].index))
+        noise = 0.1 * real.std() * rng.standard_normal((n_queries, real.shape[1])).astype("float32")
+        real_queries = real[rng.integers(0, len(real), n_queries)] + noise
+        corpora = [("faiss_metadata", real, real_queries)]
+
+        dim = opts["dim"] or real.shape[1]
+        for size in [int(s) for s in opts["synthetic_sizes"].split(",") if s]:
+            corpus, queries = synthetic_corpus(size, dim, n_queries, rng)
+            corpora.append((f"synthetic-{size}", corpus, queries))
+
+        self.stdout.write(
+            f"{'corpus':<18}{'n':>8}{'type':>12}{'build s':>9}{'bytes/vec':>11}"
+            f"{'recall@' + str(k):>10}{'loss':>8}{'p50 ms':>9}{'p99 ms':>9}"
+        )
+        rerank = opts["rerank_factor"]
+        for name, corpus, queries in corpora:
+            truth = exact_neighbours(corpus, queries, k)
+            for index_type in types:
+                t0 = time.perf_counter()
+                index = build_index(corpus, index_type, params, min_vectors=0)
+                build_s = time.perf_counter() - t0
+                set_search_params(index, nprobe=opts["nprobe"], ef_search=opts["ef_search"])
+
+                runs = [(index_type, None)]
+                if index_type in COMPRESSED_TYPES and rerank > 1:
+                    # the float store lives on disk, so it adds nothing to resident bytes/vector
+                    runs.append((index_type + "+rr", rerank))
+                for label, factor in runs:
+                    found, latencies = self.run_queries(index, corpus, queries, k, factor)
+                    recall = recall_at_k(found, truth)
+                    self.stdout.write(
+                        f"{name:<18}{len(corpus):>8}{label:>12}{build_s:>9.2f}{bytes_per_vector(index):>11.0f}"
+                        f"{recall:>10.3f}{1 - recall:>8.3f}"
+                        f"{np.percentile(latencies, 50):>9.3f}{np.percentile(latencies, 99):>9.3f}"
+                    )
+                del index
+
+    def run_queries(self, index, corpus, queries, k, rerank_factor=None):
+        found = np.empty((len(queries), k), dtype="int64")
+        latencies = np.empty(len(queries))
+        for i in range(len(queries)):
+            q = queries[i:i + 1]
+            t0 = time.perf_counter()
+            if rerank_factor:
+                found[i] = rerank_exact(corpus, q, index.search(q, k * rerank_factor)[1], k)[1][0]
+            else:
+                found[i] = index.search(q, k)[1][0]
+            latencies[i] = (time.perf_counter() - t0) * 1000
+        return found, latencies
@@ -0,0 +1,53 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import rag_pipeline
+from chat.chunk_store import ChunkStore, write_chunk_store
+from chat.ingest import load_chunk_texts
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the mmap-able binary chunk store (metadata + chunk text) in faiss_metadata.json order "
+        "and publish it as a new index version."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunks", default=None,
+            help="chunks.json with file_name / chunk_id / text (default: the known chunk/embedding files)",
+        )
+
+    def handle(self, *args, **opts):
+        store = rag_pipeline.VERSION_STORE
+        _, current = store.current()
+        if not os.path.exists(current.metadata):
+            raise CommandError(f"{current.metadata} not found")
+        with open(current.metadata, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+
+        lookup = load_chunk_texts(current, extra_sources=[opts["chunks"]])
+        if not lookup:
+            raise CommandError("No chunk text found; pass --chunks path/to/chunks.json")
+
+        missing = sum(1 for m in metadata if (m["file_name"], m["chunk_id"]) not in lookup)
+        version, staging = store.stage()
+        try:
+            write_chunk_store(
+                staging.chunk_store,
+                ((m["file_name"], m["chunk_id"], lookup.get((m["file_name"], m["chunk_id"]), ""),
+                  m.get("page_start", 0), m.get("page_end", 0)) for m in metadata),
+            )
+        except Exception:
+            store.discard(staging)
+            raise
+        published = store.commit(version, staging, ntotal=len(metadata), source="build_chunk_store")
+
+        chunks = ChunkStore(published.chunk_store)
+        size = os.path.getsize(published.chunk_store)
+        self.stdout.write(self.style.SUCCESS(
+            f"Published version {version}: {len(chunks)} chunks ({size / 1e6:.1f} MB, "
+            f"{missing} without text) in {published.chunk_store}"
+        ))
@@ -0,0 +1,82 @@
+import json
+import os
+
+import faiss
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import rag_pipeline
+from chat.ingest import load_chunk_texts, write_version
+from chat.index_factory import COMPRESSED_TYPES, INDEX_TYPES, build_index, bytes_per_vector, reconstruct_all
+from chat.index_partitions import PartitionedIndex
+
+
+class Command(BaseCommand):
+    help = "Build the FAISS index (flat / IVF / HNSW / quantized) from embeddings.json or the current index file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--type", default=rag_pipeline.INDEX_TYPE, choices=INDEX_TYPES)
+        parser.add_argument("--nlist", type=int, help="IVF cells")
+        parser.add_argument("--pq-m", type=int, help="PQ sub-quantizers")
+        parser.add_argument("--pq-nbits", type=int, help="bits per PQ code")
+        parser.add_argument("--hnsw-m", type=int, help="HNSW neighbours per node")
+        parser.add_argument("--ef-construction", type=int, help="HNSW build beam width")
+        parser.add_argument(
+            "--source", choices=["embeddings", "index"], default=None,
+            help="read vectors from embeddings.json (default if present) or from the existing index file",
+        )
+
+    def handle(self, *args, **opts):
+        store = rag_pipeline.VERSION_STORE
+        _, current = store.current()
+        source = opts["source"] or ("embeddings" if os.path.exists(rag_pipeline.EMB_JSON) else "index")
+
+        if source == "embeddings":
+            if not os.path.exists(rag_pipeline.EMB_JSON):
+                raise CommandError(f"{rag_pipeline.EMB_JSON} not found")
+            with open(rag_pipeline.EMB_JSON, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            vectors = np.array([d["embedding"] for d in data], dtype="float32")
+            metadata = [{"file_name": d["file_name"], "chunk_id": d["chunk_id"]} for d in data]
+        else:
+            if not os.path.exists(current.index):
+                raise CommandError(f"{current.index} not found")
+            old = faiss.read_index(current.index)
+            vectors = reconstruct_all(old)
+            with open(current.metadata, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+
+        params = dict(rag_pipeline.INDEX_BUILD_PARAMS)
+        for name in ("nlist", "pq_m", "pq_nbits", "hnsw_m", "ef_construction"):
+            if opts[name] is not None:
+                params[name] = opts[name]
+
+        index = build_index(vectors, opts["type"], params)
+        # per brand/appliance sub-indexes, so workers mmap them instead of rebuilding at load
+        partitions = PartitionedIndex.build(index, metadata, opts["type"], params, vectors=vectors)
+        texts = load_chunk_texts(current)
+        rows = [
+            (m["file_name"], m["chunk_id"], texts.get((m["file_name"], m["chunk_id"]), ""),
+             m.get("page_start", 0), m.get("page_end", 0))
+            for m in metadata
+        ]
+
+        # publish as a new version; running workers pick it up on their next reload check
+        version, staging = store.stage()
+        try:
+            write_version(staging, index, metadata, partitions, rows,
+                          vectors if opts["type"] in COMPRESSED_TYPES else None)
+        except Exception:
+            store.discard(staging)
+            raise
+        published = store.commit(version, staging, index_type=opts["type"], ntotal=int(index.ntotal),
+                                 source="build_index")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Published version {version}: {type(faiss.downcast_index(index)).__name__} with "
+            f"{index.ntotal} vectors ({bytes_per_vector(index):.0f} bytes/vector) "
+            f"and {len(partitions.partitions)} partitions to {published.root}"
+        ))
+        missing = sum(1 for r in rows if not r[2])
+        if missing:
+            self.stdout.write(f"{missing} chunks have no text; run `manage.py build_chunk_store --chunks ...`.")
@@ -0,0 +1,100 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import ingest, pdf_extract
+
+MANUALS_DIR = os.path.join(ingest.DATA_ROOT, "manuals")
+CACHE_DIR = os.path.join(ingest.DATA_ROOT, "extract_cache")
+
+
+class Command(BaseCommand):
+    help = (
+        "Extract text from manual PDFs in parallel (pdfplumber, with tesseract OCR for image-only pages) "
+        "into data/extracted_texts, reusing cached pages of unchanged PDFs."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("pdfs", nargs="*", help="PDF files (default: every PDF in data/manuals)")
+        parser.add_argument("--output", default=ingest.EXTRACTED_DIR, help="folder for the .txt files")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+        parser.add_argument("--pages-per-task", type=int, default=8, help="pages a worker extracts per PDF open")
+        parser.add_argument("--no-ocr", action="store_true", help="skip OCR; image-only pages are left empty")
+        parser.add_argument("--zoom", type=float, default=2.0, help="render scale for OCR")
+        parser.add_argument("--lang", default="eng", help="tesseract language(s), e.g. eng+spa")
+        parser.add_argument("--tesseract-cmd", help="path to the tesseract binary if it is not on PATH")
+        parser.add_argument("--cache-dir", default=CACHE_DIR)
+        parser.add_argument("--no-cache", action="store_true", help="re-extract every page")
+
+    def handle(self, *args, **opts):
+        ocr = not opts["no_ocr"]
+        missing = pdf_extract.missing_dependencies(ocr)
+        if missing:
+            raise CommandError(f"Missing packages: pip install {' '.join(missing)}")
+
+        pdfs = opts["pdfs"] or sorted(
+            os.path.join(MANUALS_DIR, n) for n in os.listdir(MANUALS_DIR) if n.lower().endswith(".pdf")
+        )
+        if not pdfs:
+            raise CommandError(f"No PDFs found in {MANUALS_DIR}")
+        os.makedirs(opts["output"], exist_ok=True)
+
+        cache = pdf_extract.PageCache(opts["cache_dir"])
+        settings = {"ocr": ocr, "zoom": opts["zoom"], "lang": opts["lang"]}
+        start = time.perf_counter()
+
+        # plan: cached pages are reused, the rest is split into runs of pages per task
+        jobs = []
+        for path in pdfs:
+            digest = pdf_extract.file_hash(path)
+            done = {} if opts["no_cache"] else cache.load(digest, settings)
+            todo = [p for p in range(1, pdf_extract.page_count(path) + 1) if p not in done]
+            jobs.append({
+                "path": path, "digest": digest, "pages": done, "todo": todo, "cached": len(done), "failures": {},
+            })
+
+        extracted = 0
+        with ProcessPoolExecutor(max_workers=max(1, opts["workers"])) as pool:
+            futures = {}
+            step = max(1, opts["pages_per_task"])
+            for job in jobs:
+                for i in range(0, len(job["todo"]), step):
+                    future = pool.submit(
+                        pdf_extract.extract_pages, job["path"], job["todo"][i:i + step],
+                        ocr, opts["zoom"], opts["lang"], opts["tesseract_cmd"],
+                    )
+                    futures[future] = job
+            for future in as_completed(futures):
+                job = futures[future]
+                results, failures = future.result()
+                for page, kind, text in results:
+                    job["pages"][page] = (kind, text)
+                    extracted += 1
+                job["failures"].update(failures)
+
+        total_pages = 0
+        for job in jobs:
+            pages = job["pages"]
+            # failed OCR is retried next run instead of being cached
+            cache.save(job["digest"], settings, {p: v for p, v in pages.items() if v[0] != "OCR FAILED"})
+            name = os.path.splitext(os.path.basename(job["path"]))[0] + ".txt"
+            with open(os.path.join(opts["output"], name), "w", encoding="utf-8") as f:
+                f.write(pdf_extract.format_pages((p, k, t) for p, (k, t) in pages.items()))
+            total_pages += len(pages)
+            kinds = [k for k, _ in pages.values()]
+            self.stdout.write(
+                f"{name}: {len(pages)} pages ({job['cached']} cached, {kinds.count('OCR')} OCR, "
+                f"{kinds.count('OCR FAILED')} OCR failed)"
+            )
+            # failed pages are left out of the .txt; list them so they can be re-run or fixed by hand
+            for page, error in sorted(job["failures"].items()):
+                self.stderr.write(f"{name}: page {page} OCR failed: {error}")
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"{total_pages} pages from {len(jobs)} PDFs in {elapsed:.1f}s: "
+            f"{extracted / elapsed if elapsed else 0:.1f} pages/sec extracted, "
+            f"{total_pages / elapsed if elapsed else 0:.1f} pages/sec overall"
+        ))
@@ -0,0 +1,81 @@
+import os
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import ingest
+from chat.index_factory import INDEX_TYPES
+
+
+class Command(BaseCommand):
+    help = (
+        "Add, replace or remove one manual's chunks without re-embedding the rest of the corpus, "
+        "then publish the updated index."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "manuals", nargs="+",
+            help="extracted text files (e.g. data/extracted_texts/LG_Fridge_3.txt) or their file names",
+        )
+        parser.add_argument("--remove", action="store_true", help="drop these manuals from the index")
+        parser.add_argument(
+            "--type", choices=INDEX_TYPES,
+            help="index type to publish (default: the published version's type, else RAG_INDEX_TYPE)",
+        )
+        parser.add_argument(
+            "--chunker", choices=ingest.CHUNKERS, default="tokens",
+            help="tokens: structure-aware, token-budgeted chunks with page numbers; words: the notebook's word windows",
+        )
+        parser.add_argument("--chunk-size", type=int, help="tokens (or words) per chunk")
+        parser.add_argument("--overlap", type=int, help="tokens (or words) shared by consecutive chunks")
+        parser.add_argument("--dry-run", action="store_true", help="report what would change without embedding or writing")
+
+    def resolve(self, manual):
+        path = manual if os.path.exists(manual) else os.path.join(ingest.EXTRACTED_DIR, manual)
+        return os.path.basename(path), path
+
+    def handle(self, *args, **opts):
+        start = time.perf_counter()
+        registry = ingest.ChunkRegistry.load()
+        changed = False
+
+        for manual in opts["manuals"]:
+            file_name, path = self.resolve(manual)
+            if opts["remove"]:
+                removed = len(registry.manual_ids(file_name)) if opts["dry_run"] else registry.remove_manual(file_name)
+                self.stdout.write(f"{file_name}: {removed} chunks removed")
+                changed = changed or removed > 0
+                continue
+
+            if not os.path.exists(path):
+                raise CommandError(f"{path} not found")
+            chunks = ingest.chunk_manual(path, opts["chunker"], opts["chunk_size"], opts["overlap"])
+            if opts["dry_run"]:
+                stats = registry.replace_manual(file_name, chunks, embed=self.fake_embed(registry))
+            else:
+                stats = registry.replace_manual(file_name, chunks)
+            self.stdout.write(
+                f"{file_name}: {stats['chunks']} chunks, {stats['unchanged']} unchanged, "
+                f"{stats['reused']} reused by hash, {stats['embedded']} embedded, {stats['removed']} removed"
+            )
+            changed = changed or stats["embedded"] or stats["reused"] or stats["removed"]
+
+        if opts["dry_run"]:
+            self.stdout.write("Dry run: nothing written.")
+            return
+        registry.save()
+        if not changed:
+            self.stdout.write("No chunk changes; index not republished.")
+            return
+        version, index, partitions = ingest.publish(registry, opts["type"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Published version {version}: {index.ntotal} vectors and {len(partitions.partitions)} partitions "
+            f"in {time.perf_counter() - start:.1f}s"
+        ))
+
+    @staticmethod
+    def fake_embed(registry):
+        # dry runs only count: zero vectors of the right width stand in for the embedding call
+        return lambda texts: np.zeros((len(texts), registry.index.d), dtype="float32")
@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import jobs
+from chat.warmup import warm
+
+
+class Command(BaseCommand):
+    help = (
+        "Answer queued chat jobs (POST /api/chat/ with Prefer: respond-async) in this process. "
+        "Run any number of these next to the web servers; set RAG_CHAT_INLINE_WORKERS=0 there."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=2, help="worker threads (concurrent LLM calls)")
+        parser.add_argument("--poll", type=float, default=jobs.POLL_SECONDS, help="seconds between queue checks when idle")
+        parser.add_argument("--no-warmup", action="store_true", help="load the index on the first job instead")
+
+    def handle(self, *args, **opts):
+        if not opts["no_warmup"]:
+            from chat.views import rag
+            warm(rag)
+        requeued = jobs.requeue_stale()
+        if requeued:
+            self.stdout.write(f"re-queued {requeued} stale job(s)")
+
+        workers = jobs.start_workers(opts["workers"], opts["poll"])
+        self.stdout.write(f"{len(workers)} chat worker(s) running; Ctrl-C to stop")
+        try:
+            while any(w.is_alive() for w in workers):
+                time.sleep(1.0)
+        except KeyboardInterrupt:
+            pass
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            # a running job finishes first; its LLM call is bounded by the client timeout
+            worker.join()
+        self.stdout.write(
+            f"stopped: {sum(w.done for w in workers)} done, {sum(w.failed for w in workers)} failed; "
+            f"queue {jobs.queue_stats()}"
+        )
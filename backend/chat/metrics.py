@@ -0,0 +1,287 @@
+# backend/chat/metrics.py
+import bisect
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+# latency buckets (seconds): sub-millisecond cache lookups up to LLM calls near the 60 s timeout
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+TOKEN_BUCKETS = (64, 128, 256, 512, 768, 1024, 1536, 2048, 3072, 4096)
+# keep each message's stage breakdown (ms) in ChatMessage.timings, for debugging slow answers
+STORE_TIMINGS = os.environ.get("RAG_STORE_TIMINGS", "0") != "0"
+# when set, GET /metrics needs "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get("RAG_METRICS_TOKEN", "")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        '%s="%s"' % (n, str(v).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for n, v in zip(names, values)
+    )
+    return "{%s}" % pairs
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @abstractmethod
+    def samples(self):
+        """Exposition lines for the current values, without the HELP/TYPE header."""
+
+    def render(self):
+        return self.header() + list(self.samples())
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label key -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def samples(self):
+        names = self.label_names + ("le",)
+        for key, row in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, row):
+                cumulative += n
+                yield f"{self.name}_bucket{_labels(names, key + (_number(bound),))} {cumulative}"
+            yield f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {row[-1]}"
+            yield f"{self.name}_sum{_labels(self.label_names, key)} {_number(row[-2])}"
+            yield f"{self.name}_count{_labels(self.label_names, key)} {row[-1]}"
+
+
+class Collected(Metric):
+    """Gauge or counter read at scrape time: `collect()` returns {label values tuple: value}."""
+
+    def __init__(self, name, help, labels=(), collect=None, kind="gauge"):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def samples(self):
+        for key, value in sorted(self.collect().items()):
+            yield f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus text exposition format (0.0.4). A collector that fails is skipped."""
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} not collected: {type(e).__name__}")
+        return "\n".join(lines) + "\n"
+
+
+# Values are per worker process: scrape every process (or run one) to see the whole service.
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.add(Histogram(
+    "companion_stage_seconds", "Time spent in each stage of answering a chat message.", ["stage"],
+))
+CHAT_REQUESTS = REGISTRY.add(Counter(
+    "companion_chat_requests_total",
+    "Chat messages handled, by endpoint and outcome (answered, cached, blocked, queued, busy, error).",
+    ["endpoint", "outcome"],
+))
+CHAT_ERRORS = REGISTRY.add(Counter(
+    "companion_chat_errors_total", "Chat messages answered with the fallback reply, by exception type.", ["type"],
+))
+PROMPT_TOKENS = REGISTRY.add(Histogram(
+    "companion_prompt_tokens", "Prompt size sent to the LLM, in tokens.", buckets=TOKEN_BUCKETS,
+))
+COMPLETION_TOKENS = REGISTRY.add(Histogram(
+    "companion_completion_tokens", "Completion size returned by the LLM, in tokens.", buckets=TOKEN_BUCKETS,
+))
+
+
+class Timings:
+    """
+    Per-request stage timer. Every span is observed in companion_stage_seconds; the
+    breakdown of one request (stage -> ms, in order) is kept in `stages`.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.started = time.perf_counter()
+        # set by the pipeline: "answered", "cached" or "blocked"
+        self.outcome = None
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        self.stages[stage] = round(self.stages.get(stage, 0.0) + seconds * 1000.0, 2)
+
+    def breakdown(self):
+        """
+        Stage -> ms so far, plus "total" (time since creation), for ChatMessage.timings;
+        None unless RAG_STORE_TIMINGS is on. `stages` always has the raw figures.
+        """
+        if not STORE_TIMINGS:
+            return None
+        return dict(self.stages, total=round((time.perf_counter() - self.started) * 1000.0, 2))
+
+    def finish(self, stage="total"):
+        """Record the time since this Timings was created as `stage` (for /metrics only)."""
+        self.record(stage, time.perf_counter() - self.started)
+
+
+def _counts(stats, skip=("entries",)):
+    return {k: v for k, v in stats.items() if k not in skip and isinstance(v, (int, float)) and not isinstance(v, bool)}
+
+
+def register_collectors(pipeline, registry=REGISTRY):
+    """Scrape-time metrics read from the pipeline's guards, caches, HTTP pool, batcher and the job queue."""
+    guards = {"embed": pipeline.embed_guard, "llm": pipeline.llm_guard}
+    caches = {"embedding": pipeline.embed_cache, "answer": pipeline.answer_cache, "session": pipeline.session_contexts}
+
+    def upstream(field):
+        return lambda: {(name,): g.limiter.stats()[field] for name, g in guards.items()}
+
+    def rejected():
+        out = {}
+        for name, g in guards.items():
+            out[(name, "queue_full")] = g.limiter.rejected
+            out[(name, "circuit_open")] = g.breaker.refused
+        return out
+
+    def cache_events():
+        out = {}
+        for name, cache in caches.items():
+            for event, n in _counts(cache.stats()).items():
+                out[(name, event)] = n
+        return out
+
+    def cache_entries():
+        return {(name,): cache.stats().get("entries", 0) for name, cache in caches.items()}
+
+    def embed_batches():
+        stats = pipeline.embed_batcher.stats() if pipeline.embed_batcher is not None else {}
+        return {("batches",): stats.get("batches", 0), ("items",): stats.get("items", 0)}
+
+    def rerank():
+        stats = pipeline.reranker.stats() if pipeline.reranker is not None else {}
+        return {("reranked",): stats.get("reranked", 0), ("bypassed",): stats.get("bypassed", 0)}
+
+    def connections():
+        stats = pipeline.http.stats()
+        return {("opened",): stats["connections_opened"], ("reused",): stats["connections_reused"]}
+
+    def chat_jobs():
+        from .jobs import queue_stats
+        return {(status,): n for status, n in queue_stats().items()}
+
+    registry.add(Collected(
+        "companion_upstream_in_flight", "Calls to the upstream server running now.", ["upstream"], upstream("active"),
+    ))
+    registry.add(Collected(
+        "companion_upstream_waiting", "Calls queued for an upstream slot.", ["upstream"], upstream("waiting"),
+    ))
+    registry.add(Collected(
+        "companion_upstream_rejected_total", "Calls refused by admission control.", ["upstream", "reason"],
+        rejected, kind="counter",
+    ))
+    registry.add(Collected(
+        "companion_upstream_errors_total", "Failed upstream calls by error type.", ["upstream", "type"],
+        lambda: {(name, kind): n for name, g in guards.items() for kind, n in list(g.errors.items())},
+        kind="counter",
+    ))
+    registry.add(Collected(
+        "companion_upstream_connections_total",
+        "Keep-alive pool connections to the upstream servers: opened, or reused for a later request.", ["event"],
+        connections, kind="counter",
+    ))
+    registry.add(Collected(
+        "companion_circuit_open", "1 while the upstream's circuit breaker refuses calls.", ["upstream"],
+        lambda: {(name,): int(g.breaker.state == "open") for name, g in guards.items()},
+    ))
+    registry.add(Collected(
+        "companion_cache_events_total", "Cache hits, misses, evictions ... by cache.", ["cache", "event"],
+        cache_events, kind="counter",
+    ))
+    registry.add(Collected(
+        "companion_cache_entries", "Entries held by each cache in this process.", ["cache"], cache_entries,
+    ))
+    registry.add(Collected(
+        "companion_embed_batcher_total", "Embedding micro-batches sent and queries in them.", ["kind"],
+        embed_batches, kind="counter",
+    ))
+    registry.add(Collected(
+        "companion_rerank_total", "Re-rank calls, finished or bypassed over budget.", ["result"], rerank, kind="counter",
+    ))
+    registry.add(Collected(
+        "companion_chat_jobs", "Background chat jobs by status (whole queue).", ["status"], chat_jobs,
+    ))
+    registry.add(Collected(
+        "companion_index_loaded", "1 once the vector index is loaded in this process.", (),
+        lambda: {(): int(pipeline.is_loaded)},
+    ))
@@ -3,12 +3,33 @@ from django.contrib.auth.models import User
 import uuid
 
 class ChatMessage(models.Model):
+    # "pending" while a background job (ChatJob) is producing the response
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     session_id = models.CharField(max_length=100, blank=True, null=True)
     message = models.TextField()
     response = models.TextField(blank=True, null=True)
     sources = models.JSONField(blank=True, null=True) 
+    # LLM token usage for this answer; null when no LLM call was made (cached / refused / failed)
+    prompt_tokens = models.PositiveIntegerField(blank=True, null=True)
+    completion_tokens = models.PositiveIntegerField(blank=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="done")
+    # stage -> milliseconds for this answer (metrics.Timings); only kept with RAG_STORE_TIMINGS=1
+    timings = models.JSONField(blank=True, null=True)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # bumped by every save (e.g. a background job filling in the response); part of the list ETag
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # chat history: one user's session, paged by time
+            models.Index(fields=["user", "session_id", "timestamp"], name="chat_msg_user_sess_ts_idx"),
+        ]
 
     def __str__(self):
         return f"{self.user.username}: {self.message[:30]}"
@@ -31,11 +52,52 @@ class ChatSession(models.Model):
     class Meta:
         # ✅ FIXED: Add composite unique constraint to prevent duplicate sessions per user
         unique_together = ['user', 'appliance', 'company']
+        indexes = [
+            # session list: one user's sessions, newest first (a fixed order, so cursors stay valid)
+            models.Index(fields=["user", "created_at"], name="chat_sess_user_created_idx"),
+        ]
 
     def __str__(self):
         return f"{self.user.username} - {self.title or self.session_id}"
 
 
+class ChatJob(models.Model):
+    """
+    Queue entry for a ChatMessage answered in the background (see chat/jobs.py).
+
+    Workers claim the oldest queued job with a conditional UPDATE, so any number of
+    worker threads / processes can share the table without a separate broker.
+    """
+    STATUS_CHOICES = [
+        ("queued", "Queued"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
+    message = models.OneToOneField(ChatMessage, on_delete=models.CASCADE, related_name="job")
+    session_id = models.CharField(max_length=100)
+    appliance = models.CharField(max_length=50)
+    brand = models.CharField(max_length=100)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="queued")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # workers: oldest queued job first; stale running jobs by start time
+            models.Index(fields=["status", "id"], name="chat_job_status_idx"),
+            models.Index(fields=["status", "started_at"], name="chat_job_status_started_idx"),
+        ]
+
+    def __str__(self):
+        return f"job {self.pk} for message {self.message_id}: {self.status}"
+
+
 # from django.db import models
 # from django.contrib.auth.models import User
 
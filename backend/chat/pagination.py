@@ -0,0 +1,25 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ChatMessageCursorPagination(CursorPagination):
+    """
+    Newest messages first, PAGE_SIZE at a time; follow `next` for older ones.
+    Served by the (user, session_id, timestamp) index; `id` breaks ties between
+    messages saved in the same instant, so none is repeated or skipped across pages.
+    """
+    ordering = ("-timestamp", "-id")
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+
+
+class ChatSessionCursorPagination(CursorPagination):
+    """
+    Newest sessions first; served by the (user, created_at) index. Not ordered by
+    last_activity: it changes on every message, which would move sessions across
+    pages mid-walk and repeat or skip them. `id` breaks ties within one timestamp.
+    """
+    ordering = ("-created_at", "-id")
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
@@ -0,0 +1,126 @@
+# backend/chat/pdf_extract.py
+import hashlib
+import json
+import os
+
+# PDF / OCR libraries are only needed by `manage.py extract_manuals`
+try:
+    import pdfplumber
+except ImportError:  # pragma: no cover - optional dependency
+    pdfplumber = None
+try:
+    import fitz  # PyMuPDF
+except ImportError:  # pragma: no cover - optional dependency
+    fitz = None
+try:
+    import pytesseract
+    from PIL import Image
+except ImportError:  # pragma: no cover - optional dependency
+    pytesseract = Image = None
+
+# page header written before each page's text, as in data/extracted_texts/*.txt:
+#   --- PAGE 3 (TEXT) ---   text layer from pdfplumber
+#   --- PAGE 4 (OCR) ---    image-only page, text from tesseract
+PAGE_MARKER = "\n--- PAGE {page} ({kind}) ---\n{text}\n"
+
+
+def missing_dependencies(ocr=True):
+    missing = []
+    if pdfplumber is None:
+        missing.append("pdfplumber")
+    if ocr and fitz is None:
+        missing.append("pymupdf")
+    if ocr and pytesseract is None:
+        missing.append("pytesseract pillow")
+    return missing
+
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def page_count(path):
+    with pdfplumber.open(path) as pdf:
+        return len(pdf.pages)
+
+
+def extract_pages(path, pages, ocr=True, zoom=2.0, lang="eng", tesseract_cmd=None):
+    """
+    Extract the given 1-based page numbers of one PDF; runs in a worker process.
+
+    The PDF is opened once per call, so callers hand each worker a run of pages.
+    Returns ([(page, kind, text)], {page: error}) with kind "TEXT", "OCR", "OCR FAILED"
+    or "NO TEXT". A failed page has empty text; the error is only for reporting and
+    must never end up in the manual's text.
+    """
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    results = []
+    failures = {}
+    doc = None
+    try:
+        with pdfplumber.open(path) as pdf:
+            for page in pages:
+                text = pdf.pages[page - 1].extract_text() or ""
+                if text.strip():
+                    results.append((page, "TEXT", text))
+                    continue
+                if not ocr:
+                    results.append((page, "NO TEXT", ""))
+                    continue
+                # image-only page: render it and OCR
+                try:
+                    if doc is None:
+                        doc = fitz.open(path)
+                    pix = doc.load_page(page - 1).get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+                    results.append((page, "OCR", pytesseract.image_to_string(img, lang=lang)))
+                except Exception as e:
+                    results.append((page, "OCR FAILED", ""))
+                    failures[page] = f"{type(e).__name__}: {e}"
+    finally:
+        if doc is not None:
+            doc.close()
+    return results, failures
+
+
+def format_pages(results):
+    """Join [(page, kind, text)] into the extracted-text file format, in page order; failed pages are left out."""
+    return "".join(
+        PAGE_MARKER.format(page=p, kind=k, text=t) for p, k, t in sorted(results) if k != "OCR FAILED"
+    )
+
+
+class PageCache:
+    """
+    Extracted pages on disk, one JSON file per (PDF content hash, OCR settings).
+
+    Renaming or re-copying a manual keeps its cache; changing its content does not.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, digest, settings):
+        tag = hashlib.sha1(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()[:8]
+        return os.path.join(self.directory, f"{digest}-{tag}.json")
+
+    def load(self, digest, settings):
+        """{page: (kind, text)} for pages already extracted with these settings."""
+        try:
+            with open(self.path(digest, settings), "r", encoding="utf-8") as f:
+                return {int(p): tuple(v) for p, v in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, digest, settings, pages):
+        path = self.path(digest, settings)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({str(p): list(v) for p, v in pages.items()}, f)
+        os.replace(tmp, path)
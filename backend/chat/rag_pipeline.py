@@ -1,13 +1,40 @@
 # backend/chat/rag_pipeline.py
 import os
 import json
-import requests
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from functools import partial
 import numpy as np
 import faiss
 
+from .admission import UpstreamGuard
+from . import metrics
+from .answer_cache import AnswerCache
+from .chunk_store import ChunkStore, metadata_arrays, page_arrays
+from .chunker import CHUNK_TOKENS
+from .embed_batcher import EmbeddingBatcher
+from .embed_cache import EmbeddingCache
+from .http_client import get_async_session, get_session
+from .index_factory import COMPRESSED_TYPES, set_search_params
+from .index_partitions import PartitionedIndex
+from .index_versions import IndexPaths, VersionStore
+from .keyword_matcher import KeywordMatcher
+from .lexical_index import BM25Index, reciprocal_rank_fusion
+from .metrics import Timings
+from .reranker import METHODS as RERANK_METHODS, Reranker
+from .session_store import session_store
+from .token_budget import PromptBudget, TokenCounter
+
+logger = logging.getLogger(__name__)
+
 SERVER_HOST = "172.16.5.50"
 EMBED_URL = f"http://{SERVER_HOST}:8000/v1/embeddings"
 LLM_URL = f"http://{SERVER_HOST}:8003/v1/chat/completions"
+EMBED_MODEL = "nvidia/llama-3.2-nv-embedqa-1b-v2"
+LLM_MODEL = "meta/llama-3.1-8b-instruct"
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 DATA_DIR = os.path.join(BASE_DIR, "..", "data", "vectorstore")
@@ -16,6 +43,114 @@ INDEX_FILE = os.path.abspath(os.path.join(DATA_DIR, "faiss_index.bin"))
 META_FILE = os.path.abspath(os.path.join(DATA_DIR, "faiss_metadata.json"))
 EMB_JSON = os.path.abspath(os.path.join(DATA_DIR, "embeddings.json"))
 CHUNKS_JSON = os.path.abspath(os.path.join(DATA_DIR, "chunks.json"))
+# full-precision vectors (float32 .npy), written next to compressed indexes for exact re-ranking
+VECTORS_FILE = os.path.abspath(os.path.join(DATA_DIR, "faiss_vectors.npy"))
+# per brand/appliance sub-indexes written by `manage.py build_index`
+PARTITIONS_DIR = os.path.abspath(os.path.join(DATA_DIR, "partitions"))
+# binary metadata + chunk text store written by `manage.py build_chunk_store`
+CHUNK_STORE_FILE = os.path.abspath(os.path.join(DATA_DIR, "chunk_store.bin"))
+# the files above are the legacy flat layout; once something publishes a versioned
+# index (manifest.json + versions/<v>/) workers load the version the manifest names
+VERSION_STORE = VersionStore(DATA_DIR)
+# how often (seconds) a worker checks for a newer published index; 0 disables hot reload
+RELOAD_CHECK_SECONDS = float(os.environ.get("RAG_RELOAD_CHECK_SECONDS", "5"))
+
+# open indexes with mmap so every worker shares one page-cache copy
+# (IO_FLAG_MMAP_IFC maps flat-code indexes: Flat, SQ, PQ and HNSW/IVF storage)
+INDEX_IO_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+# ANN settings. INDEX_TYPE is what `manage.py build_index` writes by default: "flat",
+# "ivf_flat", "ivf_pq", "hnsw", or one of the compressed "sq8" / "fp16" / "pq" types.
+# A published version is served as the type its manifest records; INDEX_TYPE only
+# applies to the legacy layout (and manifests written without one).
+INDEX_TYPE = os.environ.get("RAG_INDEX_TYPE", "flat")
+INDEX_BUILD_PARAMS = {}  # overrides for index_factory.DEFAULT_BUILD_PARAMS
+SEARCH_NPROBE = int(os.environ.get("RAG_SEARCH_NPROBE", "16"))   # IVF cells visited per query
+SEARCH_EF = int(os.environ.get("RAG_SEARCH_EF", "64"))           # HNSW beam width per query
+# with a compressed index (sq8 / fp16 / pq / ivf_pq) and VECTORS_FILE present, fetch
+# k * RERANK_FACTOR candidates and re-rank them exactly; 1 disables re-ranking
+RERANK_FACTOR = int(os.environ.get("RAG_RERANK_FACTOR", "4"))
+# OpenMP threads FAISS may use per worker process (batched searches fan out over them).
+# Defaults to cores / WEB_CONCURRENCY so several workers don't oversubscribe the CPU.
+FAISS_THREADS = int(os.environ.get(
+    "RAG_FAISS_THREADS",
+    str(max(1, (os.cpu_count() or 1) // max(1, int(os.environ.get("WEB_CONCURRENCY", "1"))))),
+))
+
+# query-embedding cache: per-worker LRU, plus an optional SQLite file shared by all workers
+EMBED_CACHE_SIZE = int(os.environ.get("RAG_EMBED_CACHE_SIZE", "2048"))
+EMBED_CACHE_TTL = int(os.environ.get("RAG_EMBED_CACHE_TTL", "86400"))  # seconds
+EMBED_CACHE_DB = os.environ.get("RAG_EMBED_CACHE_DB")  # e.g. /var/cache/companion_ai/embeddings.sqlite3
+
+# answer cache: skips the LLM for repeated questions on the same brand/appliance and chunks.
+# Off by default: RAG_ANSWER_CACHE_SIMILARITY > 0 also reuses answers for questions whose
+# embedding has at least that cosine similarity; 0.97 is a reasonable opt-in, but check that
+# near-duplicates on your manuals really want the same answer ("E1" vs "E2") before enabling it
+ANSWER_CACHE_SIZE = int(os.environ.get("RAG_ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = int(os.environ.get("RAG_ANSWER_CACHE_TTL", str(6 * 3600)))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("RAG_ANSWER_CACHE_SIMILARITY", "0"))
+ANSWER_CACHE_DB = os.environ.get("RAG_ANSWER_CACHE_DB")
+
+# follow-up context (the last answer per chat session): per-worker LRU + TTL, or a
+# SQLite file shared by all workers when RAG_SESSION_CONTEXT_DB is set, so a follow-up
+# served by another worker still sees it
+SESSION_CONTEXT_SIZE = int(os.environ.get("RAG_SESSION_CONTEXT_SIZE", "10000"))
+SESSION_CONTEXT_TTL = int(os.environ.get("RAG_SESSION_CONTEXT_TTL", "86400"))  # seconds
+SESSION_CONTEXT_MAX_CHARS = int(os.environ.get("RAG_SESSION_CONTEXT_MAX_CHARS", "4000"))
+SESSION_CONTEXT_DB = os.environ.get("RAG_SESSION_CONTEXT_DB")  # e.g. /var/cache/companion_ai/sessions.sqlite3
+
+# embedding micro-batching: concurrent query embeddings (cache misses) are collected for
+# up to EMBED_BATCH_WINDOW_MS and sent as one /v1/embeddings call of at most
+# EMBED_BATCH_MAX inputs. 0 ms sends every query on its own.
+EMBED_BATCH_WINDOW_MS = float(os.environ.get("RAG_EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_BATCH_MAX = int(os.environ.get("RAG_EMBED_BATCH_MAX", "32"))
+
+# hybrid retrieval: BM25 over the chunk texts (lexical_index.py) fused with the FAISS
+# results by reciprocal rank, taking HYBRID_CANDIDATES from each side. Queries naming a
+# display code the manuals print ("OE", "4C") also fuse in the chunks that contain it.
+HYBRID_SEARCH = os.environ.get("RAG_HYBRID_SEARCH", "1") != "0"
+HYBRID_CANDIDATES = int(os.environ.get("RAG_HYBRID_CANDIDATES", "20"))
+RRF_K = int(os.environ.get("RAG_RRF_K", "60"))
+# with hybrid search, a query embedding that fails or takes longer than this (seconds)
+# falls back to the BM25 results alone; 0 waits for the HTTP timeout
+EMBED_FALLBACK_SECONDS = float(os.environ.get("RAG_EMBED_FALLBACK_SECONDS", "3"))
+
+# chunks retrieved per question (and sent to the LLM) without a re-rank stage
+RETRIEVE_K = int(os.environ.get("RAG_RETRIEVE_K", "4"))
+# optional re-rank stage (reranker.py): retrieve RERANK_CANDIDATES chunks, re-score them on
+# the CPU and send only the best RERANK_TOP_K to the LLM. RAG_RERANKER is "" (off),
+# "lexical", "mmr" or "cross-encoder" (ONNX model + tokenizer.json in RAG_RERANK_MODEL_DIR).
+# A re-rank that takes longer than RERANK_BUDGET_MS keeps the retrieval order.
+RERANKER = os.environ.get("RAG_RERANKER", "")
+RERANK_CANDIDATES = int(os.environ.get("RAG_RERANK_CANDIDATES", "30"))
+RERANK_TOP_K = int(os.environ.get("RAG_RERANK_TOP_K", "3"))
+RERANK_BUDGET_MS = float(os.environ.get("RAG_RERANK_BUDGET_MS", "50"))
+RERANK_MMR_LAMBDA = float(os.environ.get("RAG_RERANK_MMR_LAMBDA", "0.7"))
+RERANK_MODEL_DIR = os.environ.get("RAG_RERANK_MODEL_DIR")
+
+# chunks from chunker.py fit this budget whole; older, larger chunks are cut at it
+PROMPT_CHUNK_TOKENS = int(os.environ.get("RAG_PROMPT_CHUNK_TOKENS", str(CHUNK_TOKENS + 50)))
+# prompt token budget (token_budget.py): context chunks, the question and the previous
+# answer a follow-up refers to (HISTORY_TOKENS) are cut to fit PROMPT_TOKENS. Tokens are
+# counted with the LLM's tokenizer.json when RAG_TOKENIZER_FILE is set, else estimated.
+PROMPT_TOKENS = int(os.environ.get("RAG_PROMPT_TOKENS", "2048"))
+HISTORY_TOKENS = int(os.environ.get("RAG_HISTORY_TOKENS", "256"))
+TOKENIZER_FILE = os.environ.get("RAG_TOKENIZER_FILE")
+
+# admission control toward the GPU server (admission.py), per worker process: at most
+# *_MAX_CONCURRENT calls in flight, *_MAX_WAITING more queued for up to *_QUEUE_SECONDS;
+# anyone else is told to come back later (429 + Retry-After) straight away.
+# MAX_CONCURRENT=0 turns the limit off.
+LLM_MAX_CONCURRENT = int(os.environ.get("RAG_LLM_MAX_CONCURRENT", "4"))
+LLM_MAX_WAITING = int(os.environ.get("RAG_LLM_MAX_WAITING", "16"))
+LLM_QUEUE_SECONDS = float(os.environ.get("RAG_LLM_QUEUE_SECONDS", "10"))
+EMBED_MAX_CONCURRENT = int(os.environ.get("RAG_EMBED_MAX_CONCURRENT", "8"))
+EMBED_MAX_WAITING = int(os.environ.get("RAG_EMBED_MAX_WAITING", "64"))
+EMBED_QUEUE_SECONDS = float(os.environ.get("RAG_EMBED_QUEUE_SECONDS", "5"))
+# circuit breaker: after CIRCUIT_FAILURES failed calls in a row an upstream is refused
+# (503 + Retry-After) for CIRCUIT_RESET_SECONDS, then one trial call is let through
+CIRCUIT_FAILURES = int(os.environ.get("RAG_CIRCUIT_FAILURES", "5"))
+CIRCUIT_RESET_SECONDS = float(os.environ.get("RAG_CIRCUIT_RESET_SECONDS", "30"))
 
 # ----- Support info mapping (realistic examples; edit to your real links/numbers) -----
 SUPPORT_INFO = {
@@ -46,80 +181,350 @@ SUPPORT_INFO = {
 }
 # --------------------------------------------------------------------------------------
 
-# quick appliance synonyms used for detection
-APPLIANCE_SYNONYMS = {
-    "refrigerator": ["refrigerator", "fridge", "fridges"],
-    "washing-machine": ["washing machine", "washing-machine", "washing", "washer", "washers"],
-    "dishwasher": ["dishwasher", "dish washers", "dishwashing"],
-    # add more if you index more appliance types
-}
+# keyword tables: appliance synonyms used for detection, follow-up phrases and phrases
+# that indicate a heavy repair. Edit data/keywords.json (add appliances there); all
+# tables are compiled into one matcher at startup and matched in one pass per query.
+KEYWORDS_FILE = os.environ.get(
+    "RAG_KEYWORDS_FILE", os.path.abspath(os.path.join(BASE_DIR, "..", "data", "keywords.json"))
+)
+KEYWORDS = KeywordMatcher.from_file(KEYWORDS_FILE)
+
+# the reply saved (and shown) when answering a chat message fails
+FALLBACK_ANSWER = "⚠️ Sorry, I'm facing technical difficulties. Please try again later."
+
+class IndexSnapshot:
+    """
+    Everything loaded for one index version. The pipeline swaps whole snapshots on
+    reload, so a query that picked one up keeps using it until it finishes.
+    """
+
+    def __init__(self, version, index, metadata, chunk_lookup, partitions):
+        self.version = version
+        self.index = index
+        self.metadata = metadata
+        self.chunk_lookup = chunk_lookup
+        # per (brand, appliance) sub-indexes over self.index
+        self.partitions = partitions
+        # metadata as arrays: row -> file_names[file_ids[row]], chunk_ids[row]
+        self.file_names, self.file_ids, self.chunk_ids = metadata_arrays(metadata)
+        self.page_starts, self.page_ends = page_arrays(metadata)
+        # BM25 over the same rows (None when hybrid search is off)
+        self.lexical = None
+
+    def chunk_text(self, idx, meta):
+        if self.chunk_lookup is None:
+            return self.metadata.text(idx)
+        return self.chunk_lookup.get((meta["file_name"], meta["chunk_id"]), "")
 
-# keywords that indicate a heavy repair
-BIG_REPAIR_KEYWORDS = [
-    "replace motor", "replace drum", "replace compressor", "replace motor",
-    "wiring", "electrical repair", "major repair", "cannot be fixed", "seized"
-]
 
 class RAGPipeline:
     def __init__(self):
-        self.index = None
-        self.metadata = None
-        self.chunk_lookup = None
+        # the loaded index version (IndexSnapshot); replaced as a whole on hot reload
+        self.snapshot = None
+        self._reloading = False
+        self._next_reload_check = 0.0
         # per-session small state so follow-ups work without DB changes
-        # mapping: session_id -> last assistant response (string)
-        self.session_contexts = {}
+        # mapping: session_id -> last assistant response (string), bounded and expiring
+        self.session_contexts = session_store(
+            SESSION_CONTEXT_SIZE, SESSION_CONTEXT_TTL, SESSION_CONTEXT_MAX_CHARS, SESSION_CONTEXT_DB
+        )
+        # the warm-up thread and the first requests may race to load
+        self._load_lock = threading.Lock()
+        # a fork while the warm-up thread holds the lock would leave it held forever in the child
+        os.register_at_fork(after_in_child=self._reset_lock_after_fork)
+        # pooled keep-alive connections to EMBED_URL / LLM_URL
+        self.http = get_session()
+        self.embed_guard = UpstreamGuard(
+            "embedding server", EMBED_MAX_CONCURRENT, EMBED_MAX_WAITING, EMBED_QUEUE_SECONDS,
+            CIRCUIT_FAILURES, CIRCUIT_RESET_SECONDS,
+        )
+        self.llm_guard = UpstreamGuard(
+            "LLM server", LLM_MAX_CONCURRENT, LLM_MAX_WAITING, LLM_QUEUE_SECONDS,
+            CIRCUIT_FAILURES, CIRCUIT_RESET_SECONDS,
+        )
+        self.embed_cache = EmbeddingCache(EMBED_CACHE_SIZE, EMBED_CACHE_TTL, EMBED_CACHE_DB)
+        self.answer_cache = AnswerCache(
+            ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY, ANSWER_CACHE_DB
+        )
+        self.tokens = TokenCounter(TOKENIZER_FILE)
+        self.prompt_budget = PromptBudget(self.tokens, PROMPT_TOKENS, HISTORY_TOKENS, PROMPT_CHUNK_TOKENS)
+        self.reranker = None
+        if RERANKER in RERANK_METHODS:
+            self.reranker = Reranker(RERANKER, RERANK_BUDGET_MS, RERANK_MMR_LAMBDA, RERANK_MODEL_DIR)
+        self.embed_batcher = None
+        if EMBED_BATCH_WINDOW_MS > 0 and EMBED_BATCH_MAX > 1:
+            self.embed_batcher = EmbeddingBatcher(
+                self.embed_texts, window=EMBED_BATCH_WINDOW_MS / 1000.0, max_batch=EMBED_BATCH_MAX
+            )
+        # a shared SQLite cache / session store does file I/O that must not run on the event loop
+        self.shared_stores = bool(EMBED_CACHE_DB or ANSWER_CACHE_DB or SESSION_CONTEXT_DB)
+
+    def _reset_lock_after_fork(self):
+        self._load_lock = threading.Lock()
+
+    @property
+    def is_loaded(self):
+        return self.snapshot is not None
+
+    # the loaded snapshot's parts, for callers that only need the current one
+    @property
+    def index(self):
+        return self.snapshot.index if self.snapshot else None
+
+    @property
+    def metadata(self):
+        return self.snapshot.metadata if self.snapshot else None
+
+    @property
+    def partitions(self):
+        return self.snapshot.partitions if self.snapshot else None
+
+    @property
+    def index_version(self):
+        """Identifies the loaded index + manuals; part of every answer-cache key."""
+        return self.snapshot.version if self.snapshot else None
 
     def ensure_loaded(self):
-        if self.index is None or self.metadata is None:
-            self.index, self.metadata = self.load_index_and_metadata()
-            self.chunk_lookup = self.build_chunk_lookup()
+        if self.is_loaded:
+            self.maybe_reload()
+            return
+        with self._load_lock:
+            if self.is_loaded:
+                return
+            faiss.omp_set_num_threads(FAISS_THREADS)
+            self.snapshot = self.load_snapshot(*self.current_version())
+            self._next_reload_check = time.monotonic() + RELOAD_CHECK_SECONDS
+
+    def current_version(self):
+        """(version, IndexPaths) of the index that should be served right now."""
+        version, paths = VERSION_STORE.current()
+        if version is None:
+            version = self.compute_index_version(paths)
+        return version, paths
+
+    def maybe_reload(self):
+        """
+        At most every RELOAD_CHECK_SECONDS, look for a newer published index and load it
+        in a background thread. Requests keep using the current snapshot meanwhile.
+        """
+        if RELOAD_CHECK_SECONDS <= 0 or self._reloading:
+            return
+        now = time.monotonic()
+        if now < self._next_reload_check:
+            return
+        self._next_reload_check = now + RELOAD_CHECK_SECONDS
+        version, paths = self.current_version()
+        if version == self.index_version:
+            return
+        with self._load_lock:
+            if self._reloading:
+                return
+            self._reloading = True
+        threading.Thread(target=self.reload, args=(version, paths), name="rag-reload", daemon=True).start()
+
+    def reload(self, version, paths):
+        try:
+            snapshot = self.load_snapshot(version, paths)
+        except Exception:
+            # keep serving the old version; the next check retries
+            logger.exception("Loading index version %s failed", version)
+        else:
+            old = self.index_version
+            self.snapshot = snapshot
+            # old keys can no longer match (the version is part of them); free the memory
+            self.answer_cache.invalidate()
+            logger.info("Swapped index version %s -> %s", old, version)
+        finally:
+            self._reloading = False
+
+    def compute_index_version(self, paths=None):
+        """Fingerprint (size + mtime) of the legacy layout's index, metadata and chunk text files."""
+        paths = paths or IndexPaths(os.path.abspath(DATA_DIR))
+        h = hashlib.sha1()
+        for path in (paths.index, paths.metadata, paths.chunk_store, paths.vectors,
+                     paths.embeddings_json, paths.chunks_json):
+            if os.path.exists(path):
+                st = os.stat(path)
+                h.update(f"{os.path.basename(path)}:{st.st_size}:{st.st_mtime_ns};".encode("utf-8"))
+        return h.hexdigest()[:16]
 
-    def load_index_and_metadata(self):
-        index = faiss.read_index(INDEX_FILE)
-        with open(META_FILE, "r", encoding="utf-8") as f:
+    def load_snapshot(self, version, paths):
+        index, metadata = self.load_index_and_metadata(paths)
+        chunk_lookup = self.build_chunk_lookup(paths, metadata)
+        partitions = self.load_partitions(paths, index, metadata)
+        for idx in partitions.indexes():
+            set_search_params(idx, nprobe=SEARCH_NPROBE, ef_search=SEARCH_EF)
+        snap = IndexSnapshot(version, index, metadata, chunk_lookup, partitions)
+        if HYBRID_SEARCH:
+            snap.lexical = BM25Index.build(snap.chunk_text(i, meta) for i, meta in enumerate(metadata))
+        return snap
+
+    def load_index_and_metadata(self, paths):
+        index = faiss.read_index(paths.index, INDEX_IO_FLAGS)
+        if os.path.exists(paths.chunk_store):
+            # mmap'd store doubles as the metadata list and the chunk text lookup
+            return index, ChunkStore(paths.chunk_store)
+        with open(paths.metadata, "r", encoding="utf-8") as f:
             metadata = json.load(f)
         return index, metadata
 
-    def build_chunk_lookup(self):
+    def load_partitions(self, paths, index, metadata):
+        vectors = self.load_vector_store(paths)
+        if os.path.isdir(paths.partitions) and os.listdir(paths.partitions):
+            return PartitionedIndex.load(paths.partitions, index, INDEX_IO_FLAGS, vectors, RERANK_FACTOR)
+        # legacy layout without saved sub-indexes: filter the shared (mmap'd) global index
+        # by id instead of building heap copies in every worker
+        return PartitionedIndex.filtered(index, metadata, vectors, RERANK_FACTOR)
+
+    def load_vector_store(self, paths):
+        # only compressed indexes need it; mmap so workers page in just the re-ranked rows
+        if (paths.index_type or INDEX_TYPE) not in COMPRESSED_TYPES or not os.path.exists(paths.vectors):
+            return None
+        return np.load(paths.vectors, mmap_mode="r")
+
+    def build_chunk_lookup(self, paths, metadata):
+        if isinstance(metadata, ChunkStore):
+            return None
         lookup = {}
-        if os.path.exists(EMB_JSON):
-            with open(EMB_JSON, "r", encoding="utf-8") as f:
+        if os.path.exists(paths.embeddings_json):
+            with open(paths.embeddings_json, "r", encoding="utf-8") as f:
                 embd = json.load(f)
             for item in embd:
                 lookup[(item["file_name"], item["chunk_id"])] = item.get("text", "")
-        if not lookup and os.path.exists(CHUNKS_JSON):
-            with open(CHUNKS_JSON, "r", encoding="utf-8") as f:
+        if not lookup and os.path.exists(paths.chunks_json):
+            with open(paths.chunks_json, "r", encoding="utf-8") as f:
                 chunks = json.load(f)
             for c in chunks:
                 lookup[(c["file_name"], c["chunk_id"])] = c.get("text", "")
         return lookup
 
-    def embed_query(self, query_text):
-        payload = {"model": "nvidia/llama-3.2-nv-embedqa-1b-v2",
-                   "input": [query_text], "input_type": "query"}
-        r = requests.post(EMBED_URL, json=payload, timeout=30)
-        r.raise_for_status()
-        return np.array(r.json()["data"][0]["embedding"], dtype="float32").reshape(1, -1)
-
-    def retrieve(self, qvec, k=4):
-        D, I = self.index.search(qvec, k)
-        results = []
-        for dist, idx in zip(D[0], I[0]):
-            meta = self.metadata[idx]
-            txt = self.chunk_lookup.get((meta["file_name"], meta["chunk_id"]), "")
-            results.append({
-                "file_name": meta["file_name"],
-                "chunk_id": meta["chunk_id"],
-                "distance": float(dist),
-                "text": txt
-            })
-        return results
+    def embed_texts(self, texts):
+        """Embed a list of queries in one call; returns a (len(texts), dim) float32 array."""
+        payload = {"model": EMBED_MODEL,
+                   "input": list(texts), "input_type": "query"}
+        with self.embed_guard.slot():
+            r = self.http.post("embed", EMBED_URL, json=payload)
+            r.raise_for_status()
+        return self.parse_embeddings(r.json())
+
+    @staticmethod
+    def parse_embeddings(body):
+        # rows carry their input position; don't rely on the response order
+        data = sorted(body["data"], key=lambda d: d.get("index", 0))
+        return np.array([d["embedding"] for d in data], dtype="float32")
+
+    def embed_query(self, query_text, timeout=None):
+        cached = self.embed_cache.get(EMBED_MODEL, query_text)
+        if cached is not None:
+            return cached.reshape(1, -1)
+        if self.embed_batcher is not None:
+            vec = self.embed_batcher.embed(query_text, timeout).reshape(1, -1)
+        else:
+            vec = self.embed_texts([query_text])
+        self.embed_cache.set(EMBED_MODEL, query_text, vec)
+        return vec
+
+    def embed_or_fallback(self, ctx):
+        """
+        Query vector for step 3, or None to retrieve with BM25 alone (hybrid search
+        only) when embedding fails or is slow.
+        """
+        if self.snapshot.lexical is None:
+            return self.embed_query(ctx["query_for_embedding"])
+        try:
+            return self.embed_query(ctx["query_for_embedding"], EMBED_FALLBACK_SECONDS or None)
+        except Exception:
+            logger.warning("Query embedding failed or timed out; retrieving with BM25 only", exc_info=True)
+            return None
+
+    def retrieve(self, qvec, k=RETRIEVE_K, brand=None, appliance=None, snapshot=None):
+        return self.retrieve_many(qvec, k, brand=brand, appliance=appliance, snapshot=snapshot)[0]
+
+    def retrieve_many(self, qvecs, k=RETRIEVE_K, brand=None, appliance=None, snapshot=None):
+        """
+        Search several query vectors in one FAISS call; returns one result list per row.
+
+        All rows are searched in the same brand/appliance partition (or the global index).
+        """
+        snap = snapshot or self.snapshot
+        qvecs = np.ascontiguousarray(qvecs, dtype="float32").reshape(-1, snap.index.d)
+        # only search the active brand/appliance manuals; falls back to the global index
+        D, I = snap.partitions.search(qvecs, k, brand=brand, appliance=appliance)
+        valid = I >= 0
+        return [
+            self.make_hits(snap, I[q][valid[q]], distance=D[q][valid[q]].tolist())
+            for q in range(len(I))
+        ]
+
+    def retrieve_hybrid(self, query_text, qvec, k=RETRIEVE_K, brand=None, appliance=None, snapshot=None,
+                        codes=()):
+        """
+        BM25, (when qvec is given) FAISS and (when the query names display `codes`)
+        exact code-match candidates from the brand/appliance partition, merged by
+        reciprocal rank fusion. Hits carry the FAISS `distance` and/or `bm25` score
+        of the side(s) that found them.
+        """
+        snap = snapshot or self.snapshot
+        n = max(k, HYBRID_CANDIDATES)
+        partition = snap.partitions.rows(brand, appliance)
+        lex_rows, lex_scores = snap.lexical.search(query_text, n, rows=partition)
+        bm25 = dict(zip(lex_rows.tolist(), lex_scores.tolist()))
+        ranked = [lex_rows.tolist()]
+        if codes:
+            ranked.append(snap.lexical.code_search(codes, n, rows=partition)[0].tolist())
+        dense = {}
+        if qvec is not None:
+            qvec = np.ascontiguousarray(qvec, dtype="float32").reshape(1, snap.index.d)
+            D, I = snap.partitions.search(qvec, n, brand=brand, appliance=appliance)
+            keep = I[0] >= 0
+            dense = dict(zip(I[0][keep].tolist(), D[0][keep].tolist()))
+            ranked.append(list(dense))
+        rows = reciprocal_rank_fusion(ranked, RRF_K)[:k] if len(ranked) > 1 else ranked[0][:k]
+        hits = self.make_hits(snap, np.asarray(rows, dtype="int64"))
+        for row, hit in zip(rows, hits):
+            if row in dense:
+                hit["distance"] = dense[row]
+            if row in bm25:
+                hit["bm25"] = bm25[row]
+        return hits
+
+    @staticmethod
+    def make_hits(snap, rows, **scores):
+        """Result dicts for global row ids; `scores` are per-row lists added under their own names."""
+        rows = np.asarray(rows, dtype="int64")
+        hits = []
+        for n, (idx, fid, cid, p0, p1) in enumerate(zip(
+            rows.tolist(), snap.file_ids[rows].tolist(), snap.chunk_ids[rows].tolist(),
+            snap.page_starts[rows].tolist(), snap.page_ends[rows].tolist(),
+        )):
+            meta = {"file_name": snap.file_names[fid], "chunk_id": cid}
+            if p0:
+                meta["pages"] = [p0, p1]
+            meta.update({name: values[n] for name, values in scores.items()})
+            meta["text"] = snap.chunk_text(idx, meta)
+            hits.append(meta)
+        return hits
+
+    @staticmethod
+    def source_label(r):
+        pages = r.get("pages")
+        if not pages:
+            return f"[SOURCE: {r['file_name']}#{r['chunk_id']}]"
+        where = f"page {pages[0]}" if pages[0] == pages[1] else f"pages {pages[0]}-{pages[1]}"
+        return f"[SOURCE: {r['file_name']}#{r['chunk_id']}] ({where})"
+
+    def fit_prompt(self, user_query, retrieved):
+        """(prompt, prompt tokens): build_prompt cut to PROMPT_TOKENS, best chunks first."""
+        sections = [(self.source_label(r), r["text"]) for r in retrieved if r["text"]]
+        prompt, tokens, _ = self.prompt_budget.fit(self.render_prompt, user_query, sections)
+        metrics.PROMPT_TOKENS.observe(tokens)
+        return prompt, tokens
 
     def build_prompt(self, user_query, retrieved):
-        context = "\n\n".join(
-            f"[SOURCE: {r['file_name']}#{r['chunk_id']}]\n{r['text'][:1500]}"
-            for r in retrieved if r['text']
-        )
+        return self.fit_prompt(user_query, retrieved)[0]
+
+    @staticmethod
+    def render_prompt(user_query, context):
         return f"""You are a helpful assistant for appliance manuals.
 
 CONTEXT:
@@ -135,90 +540,351 @@ INSTRUCTIONS:
 - If context lacks answer, reply: "I don't know" and suggest contacting support or checking the manual.
 """
 
-    def call_llm(self, prompt):
+    def record_usage(self, usage, prompt_tokens, completion, llm_usage):
+        """Fill `usage` with the server-reported token counts, or local counts when it sent none."""
+        completion_tokens = llm_usage.get("completion_tokens") or self.tokens.count(completion)
+        metrics.COMPLETION_TOKENS.observe(completion_tokens)
+        if usage is None:
+            return
+        usage["prompt_tokens"] = llm_usage.get("prompt_tokens") or prompt_tokens
+        usage["completion_tokens"] = completion_tokens
+
+    def call_llm(self, prompt, max_tokens=512, usage=None):
         payload = {
-            "model": "meta/llama-3.1-8b-instruct",
+            "model": LLM_MODEL,
             "messages": [
                 {"role": "system", "content": "You are a helpful assistant for appliance manuals."},
                 {"role": "user", "content": prompt}
             ],
-            "temperature": 0.2, "max_tokens": 512
+            "temperature": 0.2, "max_tokens": max_tokens
         }
-        r = requests.post(LLM_URL, json=payload, timeout=60)
-        r.raise_for_status()
-        return r.json()["choices"][0]["message"]["content"]
-
-    def _mentions_other_appliance(self, query_lower, active_appliance):
-        """Return True if the query mentions an appliance **different** from active_appliance."""
-        for ap_key, aliases in APPLIANCE_SYNONYMS.items():
-            if active_appliance and ap_key == active_appliance.lower():
-                continue
-            for alias in aliases:
-                if alias in query_lower:
-                    return True
-        return False
-
-    def answer_query(self, query, appliance=None, brand=None, session_id=None):
+        with self.llm_guard.slot():
+            r = self.http.post("llm", LLM_URL, json=payload)
+            r.raise_for_status()
+        body = r.json()
+        if usage is not None:
+            usage.update(body.get("usage") or {})
+        return body["choices"][0]["message"]["content"]
+
+    def call_llm_stream(self, prompt, max_tokens=512, usage=None):
         """
-        query: user text
-        appliance: the active appliance string e.g. "refrigerator" or "washing-machine"
-        brand: e.g. "LG"
-        session_id: session identifier (used for follow-up context)
+        Yield completion text pieces as the OpenAI-compatible server streams them (SSE).
+        The token counts the server sends in its last event are added to `usage`.
+        """
+        payload = {
+            "model": LLM_MODEL,
+            "messages": [
+                {"role": "system", "content": "You are a helpful assistant for appliance manuals."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.2, "max_tokens": max_tokens, "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+        # the slot is held until the last token: generation is what loads the GPU
+        with self.llm_guard.slot(), self.http.post("llm", LLM_URL, json=payload, stream=True) as r:
+            r.raise_for_status()
+            for line in r.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                event = json.loads(data)
+                if usage is not None and event.get("usage"):
+                    usage.update(event["usage"])
+                choices = event.get("choices") or [{}]
+                piece = (choices[0].get("delta") or {}).get("content")
+                if piece:
+                    yield piece
+
+    def admit(self):
+        """Raise Overloaded now, before any work, when the LLM call this request needs would be refused."""
+        self.llm_guard.check()
+
+    def _mentions_other_appliance(self, keywords, active_appliance):
+        """Return True if the query (its KEYWORDS.match hits) mentions an appliance **different** from active_appliance."""
+        return bool(keywords.get("appliance", set()) - {(active_appliance or "").lower()})
+
+    def start_query(self, query, appliance=None, brand=None, session_id=None, timings=None):
+        """
+        Steps 1-2 of answer_query (no network I/O).
+
+        Returns a dict with `blocked` (a ready reply when the query is refused) or
+        the `query_for_embedding` to embed next. Stage times go to ctx["timings"].
         """
-        self.ensure_loaded()
+        timings = timings if timings is not None else Timings()
+        with timings.span("load"):
+            self.ensure_loaded()
         q_lower = (query or "").lower().strip()
+        # every keyword category in one pass: appliances, follow-up and big-repair phrases
+        keywords = KEYWORDS.match(q_lower)
+        ctx = {"q_lower": q_lower, "keywords": keywords, "blocked": None, "cached": None, "timings": timings}
 
         # 1) block queries that explicitly mention a different appliance than the session
-        if appliance and self._mentions_other_appliance(q_lower, appliance):
-            return (
+        if appliance and self._mentions_other_appliance(keywords, appliance):
+            ctx["blocked"] = (
                 f"❌ You're currently in the {brand} {appliance} section. "
-                "Please ask questions related only to this appliance. For other appliances, start a new session.",
-                []
+                "Please ask questions related only to this appliance. For other appliances, start a new session."
             )
+            timings.outcome = "blocked"
+            return ctx
 
         # 2) handle follow-ups: if user asks 'more'/'explain' etc. prepend previous response
         prev = None
         if session_id:
             prev = self.session_contexts.get(session_id)
 
-        if prev and any(token in q_lower for token in ["more", "explain", "tell me more", "details", "detail", "this"]):
+        if prev and keywords.get("follow_up"):
             # attach previous assistant response before querying embeddings/LLM
-            query_for_embedding = f"{prev}\n\nUser follow-up: {query}"
+            ctx["query_for_embedding"] = f"{prev}\n\nUser follow-up: {query}"
         else:
-            query_for_embedding = query
+            ctx["query_for_embedding"] = query
+        # display codes the manuals print ("OE", "4C"): exact matches are fused into retrieval
+        lexical = self.snapshot.lexical
+        ctx["codes"] = lexical.code_terms(query or "") if lexical is not None else []
+        return ctx
+
+    def retrieve_for(self, ctx, qvec, appliance=None, brand=None):
+        """Step 3: search with the query vector, re-rank, then look the result up in the answer cache."""
+        # one snapshot for the whole query, even if a reload swaps in a new one meanwhile
+        snap = self.snapshot
+        timings = ctx["timings"]
+        k = RERANK_CANDIDATES if self.reranker is not None else RETRIEVE_K
+        with timings.span("retrieve"):
+            if snap.lexical is not None:
+                retrieved = self.retrieve_hybrid(
+                    ctx["query_for_embedding"], qvec, k, brand=brand, appliance=appliance, snapshot=snap,
+                    codes=ctx["codes"],
+                )
+            else:
+                retrieved = self.retrieve(qvec, k, brand=brand, appliance=appliance, snapshot=snap)
+        if self.reranker is not None:
+            with timings.span("rerank"):
+                retrieved = self.reranker.rerank(ctx["query_for_embedding"], retrieved, RERANK_TOP_K, snap.lexical)
+        ctx.update(qvec=qvec, retrieved=retrieved, version=snap.version)
+        with timings.span("answer_cache"):
+            ctx["cached"] = self.answer_cache.get(
+                snap.version, brand, appliance, retrieved, ctx["query_for_embedding"], qvec
+            )
+        timings.outcome = "answered" if ctx["cached"] is None else "cached"
+        return ctx
 
+    def prepare_query(self, query, appliance=None, brand=None, session_id=None, timings=None):
+        """
+        Steps 1-3 of answer_query, shared by the blocking and streaming paths.
+
+        Returns a dict with `blocked` (a ready reply when the query is refused), or the
+        `query_for_embedding`, `qvec`, `retrieved` chunks and a `cached` (answer, sources)
+        tuple when the answer cache already has this question.
+        """
+        ctx = self.start_query(query, appliance=appliance, brand=brand, session_id=session_id, timings=timings)
+        if ctx["blocked"]:
+            return ctx
         # 3) retrieve/RAG
-        qvec = self.embed_query(query_for_embedding)
-        retrieved = self.retrieve(qvec)
+        with ctx["timings"].span("embed"):
+            qvec = self.embed_or_fallback(ctx)
+        return self.retrieve_for(ctx, qvec, appliance=appliance, brand=brand)
 
-        prompt = self.build_prompt(query_for_embedding, retrieved)
-        llm_response = self.call_llm(prompt)
+    def finish_query(self, ctx, llm_response, appliance=None, brand=None, session_id=None):
+        """Steps 4-5: remember the answer, then return the support text to append to it."""
+        with ctx["timings"].span("finish"):
+            return self._finish_query(ctx, llm_response, appliance, brand, session_id)
+
+    def _finish_query(self, ctx, llm_response, appliance, brand, session_id):
+        if ctx["cached"] is None:
+            self.answer_cache.set(
+                ctx["version"], brand, appliance, ctx["retrieved"], ctx["query_for_embedding"],
+                llm_response, ctx["qvec"]
+            )
 
         # 4) store last assistant response for follow-ups (per-session)
         if session_id:
-            self.session_contexts[session_id] = llm_response
+            # only the leading sentences are kept, so follow-up prompts don't grow with each turn
+            self.session_contexts.set(session_id, self.prompt_budget.trim_history(llm_response))
 
         # 5) detect big repair and append support info if available
-        enriched = llm_response
+        suffix = ""
         info = {}
         if brand and appliance:
             info = SUPPORT_INFO.get(brand.lower(), {}).get(appliance.lower(), {})
 
         # If big repair keywords found in user query, strongly advise professional service
-        if any(kw in q_lower for kw in BIG_REPAIR_KEYWORDS):
-            enriched += "\n\n⚠️ This appears to be a major repair that likely requires a technician. " \
-                        "Please contact customer support or a certified technician."
+        if ctx["keywords"].get("big_repair"):
+            suffix += "\n\n⚠️ This appears to be a major repair that likely requires a technician. " \
+                      "Please contact customer support or a certified technician."
             if info.get("toll_free"):
-                enriched += f" 📞 {info['toll_free']}"
+                suffix += f" 📞 {info['toll_free']}"
 
         # Append support info (if any) to the response to make it actionable
         if info:
-            enriched += "\n\n---\nHelpful resources:\n"
+            suffix += "\n\n---\nHelpful resources:\n"
             if info.get("toll_free"):
-                enriched += f"📞 Support: {info['toll_free']}\n"
+                suffix += f"📞 Support: {info['toll_free']}\n"
             if info.get("manual_link"):
-                enriched += f"📘 Manual / docs: {info['manual_link']}\n"
+                suffix += f"📘 Manual / docs: {info['manual_link']}\n"
             if info.get("youtube"):
-                enriched += f"▶️ Troubleshooting video: {info['youtube']}\n"
+                suffix += f"▶️ Troubleshooting video: {info['youtube']}\n"
+
+        return suffix
+
+    def answer_query(self, query, appliance=None, brand=None, session_id=None, usage=None, timings=None):
+        """
+        query: user text
+        appliance: the active appliance string e.g. "refrigerator" or "washing-machine"
+        brand: e.g. "LG"
+        session_id: session identifier (used for follow-up context)
+        usage: optional dict that gets prompt_tokens / completion_tokens when the LLM is called
+        timings: optional metrics.Timings that gets the time spent in each stage
+        """
+        ctx = self.prepare_query(query, appliance=appliance, brand=brand, session_id=session_id, timings=timings)
+        if ctx["blocked"]:
+            return ctx["blocked"], []
+
+        if ctx["cached"] is not None:
+            llm_response, retrieved = ctx["cached"]
+        else:
+            retrieved = ctx["retrieved"]
+            with ctx["timings"].span("prompt"):
+                prompt, prompt_tokens = self.fit_prompt(ctx["query_for_embedding"], retrieved)
+            llm_usage = {}
+            with ctx["timings"].span("llm"):
+                llm_response = self.call_llm(prompt, usage=llm_usage)
+            self.record_usage(usage, prompt_tokens, llm_response, llm_usage)
+
+        enriched = llm_response + self.finish_query(
+            ctx, llm_response, appliance=appliance, brand=brand, session_id=session_id
+        )
+        return enriched, retrieved
+
+    def answer_query_stream(self, query, appliance=None, brand=None, session_id=None, usage=None, timings=None):
+        """
+        Streaming variant of answer_query.
+
+        Yields ("token", text) pieces as the LLM produces them, then one
+        ("done", (enriched_answer, sources)) event. The support-info suffix is sent
+        as a last token so the streamed text adds up to the final answer.
+        """
+        ctx = self.prepare_query(query, appliance=appliance, brand=brand, session_id=session_id, timings=timings)
+        if ctx["blocked"]:
+            yield "token", ctx["blocked"]
+            yield "done", (ctx["blocked"], [])
+            return
+
+        if ctx["cached"] is not None:
+            llm_response, retrieved = ctx["cached"]
+            yield "token", llm_response
+        else:
+            retrieved = ctx["retrieved"]
+            timings = ctx["timings"]
+            with timings.span("prompt"):
+                prompt, prompt_tokens = self.fit_prompt(ctx["query_for_embedding"], retrieved)
+            pieces = []
+            llm_usage = {}
+            # "llm" includes the time the client takes to read the stream
+            with timings.span("llm"):
+                start = time.perf_counter()
+                for piece in self.call_llm_stream(prompt, usage=llm_usage):
+                    if not pieces:
+                        timings.record("llm_first_token", time.perf_counter() - start)
+                    pieces.append(piece)
+                    yield "token", piece
+            llm_response = "".join(pieces)
+            self.record_usage(usage, prompt_tokens, llm_response, llm_usage)
 
+        suffix = self.finish_query(ctx, llm_response, appliance=appliance, brand=brand, session_id=session_id)
+        if suffix:
+            yield "token", suffix
+        yield "done", (llm_response + suffix, retrieved)
+
+    # ----- async (ASGI) path: same steps, non-blocking upstream calls -----
+
+    async def astore_call(self, func, *args, **kwargs):
+        """Run a step that reads or writes the caches / session store, off the loop if they are shared."""
+        if not self.shared_stores:
+            return func(*args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+    async def aembed_query(self, query_text, timeout=None):
+        cached = await self.astore_call(self.embed_cache.get, EMBED_MODEL, query_text)
+        if cached is not None:
+            return cached.reshape(1, -1)
+        if self.embed_batcher is not None:
+            # share batches with the sync path; the send happens on the batcher's threads
+            future = asyncio.wrap_future(self.embed_batcher.submit(query_text))
+            vec = (await asyncio.wait_for(future, timeout)).reshape(1, -1)
+        else:
+            payload = {"model": EMBED_MODEL,
+                       "input": [query_text], "input_type": "query"}
+            async with self.embed_guard.aslot():
+                r = await asyncio.wait_for(get_async_session().post("embed", EMBED_URL, json=payload), timeout)
+                r.raise_for_status()
+            vec = self.parse_embeddings(r.json())
+        await self.astore_call(self.embed_cache.set, EMBED_MODEL, query_text, vec)
+        return vec
+
+    async def aembed_or_fallback(self, ctx):
+        """Async embed_or_fallback."""
+        if self.snapshot.lexical is None:
+            return await self.aembed_query(ctx["query_for_embedding"])
+        try:
+            return await self.aembed_query(ctx["query_for_embedding"], EMBED_FALLBACK_SECONDS or None)
+        except Exception:
+            logger.warning("Query embedding failed or timed out; retrieving with BM25 only", exc_info=True)
+            return None
+
+    async def acall_llm(self, prompt, max_tokens=512, usage=None):
+        payload = {
+            "model": LLM_MODEL,
+            "messages": [
+                {"role": "system", "content": "You are a helpful assistant for appliance manuals."},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.2, "max_tokens": max_tokens
+        }
+        async with self.llm_guard.aslot():
+            r = await get_async_session().post("llm", LLM_URL, json=payload)
+            r.raise_for_status()
+        body = r.json()
+        if usage is not None:
+            usage.update(body.get("usage") or {})
+        return body["choices"][0]["message"]["content"]
+
+    async def aanswer_query(self, query, appliance=None, brand=None, session_id=None, usage=None, timings=None):
+        """
+        Async answer_query: the embed and LLM calls await the network instead of holding
+        a thread, and the CPU-bound steps (loading, FAISS search) run in the default executor,
+        as do the cache and session-store reads/writes when those are shared SQLite files.
+        """
+        loop = asyncio.get_running_loop()
+        timings = timings if timings is not None else Timings()
+        if not self.is_loaded:
+            with timings.span("load"):
+                await loop.run_in_executor(None, self.ensure_loaded)
+
+        ctx = await self.astore_call(
+            self.start_query, query, appliance=appliance, brand=brand, session_id=session_id, timings=timings
+        )
+        if ctx["blocked"]:
+            return ctx["blocked"], []
+
+        with timings.span("embed"):
+            qvec = await self.aembed_or_fallback(ctx)
+        ctx = await loop.run_in_executor(
+            None, partial(self.retrieve_for, ctx, qvec, appliance=appliance, brand=brand)
+        )
+
+        if ctx["cached"] is not None:
+            llm_response, retrieved = ctx["cached"]
+        else:
+            retrieved = ctx["retrieved"]
+            with timings.span("prompt"):
+                prompt, prompt_tokens = self.fit_prompt(ctx["query_for_embedding"], retrieved)
+            llm_usage = {}
+            with timings.span("llm"):
+                llm_response = await self.acall_llm(prompt, usage=llm_usage)
+            self.record_usage(usage, prompt_tokens, llm_response, llm_usage)
+
+        enriched = llm_response + await self.astore_call(
+            self.finish_query, ctx, llm_response, appliance=appliance, brand=brand, session_id=session_id
+        )
         return enriched, retrieved
@@ -0,0 +1,188 @@
+# backend/chat/reranker.py
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from .lexical_index import tokenize
+
+# the cross-encoder is optional: `pip install onnxruntime tokenizers` plus an exported model
+try:
+    import onnxruntime
+    from tokenizers import Tokenizer
+except ImportError:  # pragma: no cover - optional dependency
+    onnxruntime = Tokenizer = None
+
+logger = logging.getLogger(__name__)
+
+METHODS = ("lexical", "mmr", "cross-encoder")
+# share of the relevance score that comes from the candidate's original (retrieval) rank
+PRIOR_WEIGHT = 0.3
+CROSS_ENCODER_BATCH = 8
+
+
+class CrossEncoder:
+    """
+    Query/passage relevance from a small ONNX cross-encoder (e.g. an exported
+    ms-marco-MiniLM), loaded from `model_dir`/model.onnx and `model_dir`/tokenizer.json.
+    """
+
+    def __init__(self, model_dir, max_length=256, threads=1):
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+
+    def score(self, query, texts):
+        encodings = self.tokenizer.encode_batch([(query, t) for t in texts])
+        feed = {
+            "input_ids": np.array([e.ids for e in encodings], dtype="int64"),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype="int64"),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype="int64"),
+        }
+        logits = self.session.run(None, {k: v for k, v in feed.items() if k in self.input_names})[0]
+        return logits.reshape(len(texts), -1)[:, -1].tolist()
+
+
+class Reranker:
+    """
+    Re-scores a wide candidate list on the CPU and keeps the best k.
+
+      lexical        query-term coverage (idf-weighted when a BM25 index is given)
+                     blended with the candidate's retrieval rank
+      mmr            lexical relevance, picked by maximal marginal relevance so
+                     near-duplicate chunks (overlapping windows, repeated manuals)
+                     don't fill every slot
+      cross-encoder  CrossEncoder scores; falls back to lexical if onnxruntime,
+                     tokenizers or the model are missing
+
+    Every call has a time budget. When it runs out the candidates are returned in
+    retrieval order (top k), so a slow re-rank never delays an answer by more than
+    roughly the budget. A cross-encoder batch already running is not interrupted.
+    """
+
+    def __init__(self, method="lexical", budget_ms=50, mmr_lambda=0.7, model_dir=None):
+        self.method = method
+        self.budget = budget_ms / 1000.0
+        self.mmr_lambda = mmr_lambda
+        self.model_dir = model_dir
+        self._encoder = None
+        self._encoder_lock = threading.Lock()
+        self.reranked = self.bypassed = 0
+        self.total_ms = 0.0
+
+    def encoder(self):
+        """The CrossEncoder (loaded once), or None when not using / unable to load one."""
+        if self.method != "cross-encoder":
+            return None
+        if self._encoder is None:
+            with self._encoder_lock:
+                if self._encoder is None:
+                    self._encoder = self._load_encoder()
+        return self._encoder or None
+
+    def _load_encoder(self):
+        if onnxruntime is None or not self.model_dir:
+            logger.warning("Cross-encoder re-ranking needs onnxruntime, tokenizers and RAG_RERANK_MODEL_DIR; using lexical")
+            return False
+        try:
+            return CrossEncoder(self.model_dir)
+        except Exception:
+            logger.exception("Loading the cross-encoder from %s failed; using lexical", self.model_dir)
+            return False
+
+    def rerank(self, query, hits, k, lexical=None):
+        """The best k of `hits` (best first) for `query`; `lexical` is the snapshot's BM25Index for idf weights."""
+        if len(hits) <= 1:
+            return hits[:k]
+        start = time.perf_counter()
+        deadline = start + self.budget
+        try:
+            order = self._order(query, hits, k, lexical, deadline)
+        except TimeoutError:
+            order = None
+        elapsed = time.perf_counter() - start
+        self.total_ms += elapsed * 1000.0
+        if order is None or elapsed > self.budget:
+            self.bypassed += 1
+            return hits[:k]
+        self.reranked += 1
+        return [hits[i] for i in order]
+
+    def _order(self, query, hits, k, lexical, deadline):
+        n = len(hits)
+        prior = [1.0 - rank / n for rank in range(n)]
+        encoder = self.encoder()
+        if encoder is not None:
+            scores = []
+            for start in range(0, n, CROSS_ENCODER_BATCH):
+                scores.extend(encoder.score(query, [h["text"] for h in hits[start:start + CROSS_ENCODER_BATCH]]))
+                if time.perf_counter() > deadline:
+                    raise TimeoutError
+            return sorted(range(n), key=lambda i: -scores[i])[:k]
+
+        weights = self._term_weights(query, lexical)
+        total = sum(weights.values()) or 1.0
+        token_sets = []
+        relevance = []
+        for i, hit in enumerate(hits):
+            tokens = set(tokenize(hit["text"]))
+            token_sets.append(tokens)
+            coverage = sum(w for term, w in weights.items() if term in tokens) / total
+            relevance.append(PRIOR_WEIGHT * prior[i] + (1 - PRIOR_WEIGHT) * coverage)
+            if time.perf_counter() > deadline:
+                raise TimeoutError
+        if self.method != "mmr":
+            return sorted(range(n), key=lambda i: -relevance[i])[:k]
+        return self._mmr(relevance, token_sets, k, deadline)
+
+    @staticmethod
+    def _term_weights(query, lexical):
+        terms = set(tokenize(query))
+        if lexical is None:
+            return dict.fromkeys(terms, 1.0)
+        # idf from the BM25 index; terms the manuals never use carry no signal
+        weights = {}
+        for term in terms:
+            t = lexical.vocab.get(term)
+            if t is not None:
+                weights[term] = float(lexical.idf[t])
+        return weights
+
+    def _mmr(self, relevance, token_sets, k, deadline):
+        remaining = list(range(len(relevance)))
+        chosen = []
+        while remaining and len(chosen) < k:
+            def gain(i):
+                if not chosen:
+                    return relevance[i]
+                overlap = max(_jaccard(token_sets[i], token_sets[j]) for j in chosen)
+                return self.mmr_lambda * relevance[i] - (1 - self.mmr_lambda) * overlap
+            best = max(remaining, key=gain)
+            chosen.append(best)
+            remaining.remove(best)
+            if time.perf_counter() > deadline:
+                raise TimeoutError
+        return chosen
+
+    def stats(self):
+        calls = self.reranked + self.bypassed
+        return {
+            "method": self.method,
+            "reranked": self.reranked,
+            "bypassed": self.bypassed,
+            "mean_ms": round(self.total_ms / calls, 2) if calls else 0.0,
+        }
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
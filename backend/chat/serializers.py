@@ -6,10 +6,15 @@ class ChatMessageSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = ChatMessage
-        fields = ['id', 'user', 'username', 'session_id', 'message', 'response','sources','timestamp']
+        fields = ['id', 'user', 'username', 'session_id', 'message', 'response','sources',
+                  'prompt_tokens', 'completion_tokens', 'status', 'timings', 'timestamp']
         extra_kwargs = {
             'user': {'read_only': True},
             'session': {'read_only': True},
+            'prompt_tokens': {'read_only': True},
+            'completion_tokens': {'read_only': True},
+            'status': {'read_only': True},
+            'timings': {'read_only': True},
         }
 
 
@@ -0,0 +1,90 @@
+# backend/chat/session_store.py
+from abc import ABC, abstractmethod
+
+from .cache_backends import LRUCache, SQLiteCache
+
+
+class SessionContextStore(ABC):
+    """
+    Follow-up context per chat session: the last assistant answer, which the next
+    "tell me more" is asked about. Entries expire after `ttl` seconds, at most
+    `max_entries` are kept, and values longer than `max_chars` are cut.
+    """
+
+    def __init__(self, max_entries=10000, ttl=86400, max_chars=4000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_chars = max_chars
+
+    @abstractmethod
+    def get(self, session_id):
+        """The stored context, or None when missing or expired."""
+
+    @abstractmethod
+    def set(self, session_id, text):
+        """Store `text` (clipped to max_chars) for the session."""
+
+    @abstractmethod
+    def delete(self, session_id):
+        """Forget the session's context."""
+
+    @abstractmethod
+    def stats(self):
+        """Counters for /metrics and the health endpoint."""
+
+    def _clip(self, text):
+        return text[:self.max_chars] if self.max_chars > 0 and text else text
+
+
+class LocalSessionStore(SessionContextStore):
+    """Per-process LRU + TTL store; memory is bounded by max_entries * max_chars."""
+
+    def __init__(self, max_entries=10000, ttl=86400, max_chars=4000):
+        super().__init__(max_entries, ttl, max_chars)
+        self.cache = LRUCache(max_entries=max_entries, ttl=ttl)
+
+    def get(self, session_id):
+        return self.cache.get(session_id)
+
+    def set(self, session_id, text):
+        self.cache.set(session_id, self._clip(text))
+
+    def delete(self, session_id):
+        self.cache.delete(session_id)
+
+    def stats(self):
+        return dict(self.cache.stats(), backend="local")
+
+
+class SharedSessionStore(SessionContextStore):
+    """
+    Store in a SQLite file shared by every worker on the box, so a follow-up that
+    lands on another worker still finds its context. Not cached per process: the
+    next answer in a session may be written by any worker.
+    """
+
+    def __init__(self, path, max_entries=10000, ttl=86400, max_chars=4000):
+        super().__init__(max_entries, ttl, max_chars)
+        self.cache = SQLiteCache(
+            path, table="session_contexts", max_entries=max_entries, ttl=ttl,
+            encode=lambda v: v.encode("utf-8"), decode=lambda b: bytes(b).decode("utf-8"),
+        )
+
+    def get(self, session_id):
+        return self.cache.get(session_id)
+
+    def set(self, session_id, text):
+        self.cache.set(session_id, self._clip(text))
+
+    def delete(self, session_id):
+        self.cache.delete(session_id)
+
+    def stats(self):
+        return dict(self.cache.stats(), entries=len(self.cache), backend="sqlite")
+
+
+def session_store(max_entries=10000, ttl=86400, max_chars=4000, shared_path=None):
+    """SharedSessionStore when a SQLite path is configured, else LocalSessionStore."""
+    if shared_path:
+        return SharedSessionStore(shared_path, max_entries, ttl, max_chars)
+    return LocalSessionStore(max_entries, ttl, max_chars)
@@ -1,3 +1,1381 @@
-from django.test import TestCase
+import asyncio
+import io
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import faiss
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import ingest, jobs, pdf_extract, warmup
+from .admission import CircuitBreaker, CircuitOpen, ConcurrencyLimiter, Overloaded, QueueFull, UpstreamGuard
+from .cache_backends import LRUCache, SQLiteCache
+from .chunk_store import ChunkStore, metadata_arrays, page_arrays, write_chunk_store
+from .chunker import chunk_lines, count_tokens
+from .embed_batcher import EmbeddingBatcher
+from .embed_cache import EmbeddingCache
+from .index_factory import build_index, bytes_per_vector, factory_string, rerank_exact, set_search_params
+from .index_partitions import PartitionedIndex
+from .index_versions import IndexPaths, VersionStore
+from .keyword_matcher import KeywordMatcher
+from .management.commands.bench_index import exact_neighbours, recall_at_k, synthetic_corpus
+from .lexical_index import BM25Index, display_codes, is_code, reciprocal_rank_fusion
+from .metrics import Collected, Counter, Histogram, Registry, Timings, register_collectors
+from .models import ChatJob, ChatMessage, ChatSession
+from .rag_pipeline import FALLBACK_ANSWER, IndexSnapshot, RAGPipeline
+from .reranker import Reranker
+from .session_store import LocalSessionStore, SessionContextStore, SharedSessionStore, session_store
+from .throttling import ChatRateThrottle, TokenBucket
+from .token_budget import MIN_CHUNK_TOKENS, PromptBudget, TokenCounter
+from .views import UpstreamBusy
+
+
+def make_snapshot(texts, vectors, file_name="LG_WM_1.txt", version="v1"):
+    """An in-memory IndexSnapshot over `texts` (one chunk each) with a flat index and BM25."""
+    vectors = np.asarray(vectors, dtype="float32")
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+    metadata = [{"file_name": file_name, "chunk_id": i} for i in range(len(texts))]
+    lookup = {(file_name, i): text for i, text in enumerate(texts)}
+    snap = IndexSnapshot(version, index, metadata, lookup, PartitionedIndex.build(index, metadata))
+    snap.lexical = BM25Index.build(texts)
+    return snap
+
+
+def make_pipeline(snapshot):
+    """A RAGPipeline serving `snapshot` that never looks for a newer index version."""
+    pipeline = RAGPipeline()
+    pipeline.snapshot = snapshot
+    pipeline._next_reload_check = float("inf")
+    return pipeline
+
+
+class KeywordMatcherTests(SimpleTestCase):
+    def setUp(self):
+        self.matcher = KeywordMatcher({
+            "appliance": {
+                "dishwasher": ["dishwasher", "dish washer"],
+                "washing-machine": ["washer", "washing machine"],
+            },
+            "brand": {"lg": ["lg"], "samsung": ["samsung"]},
+        })
+
+    def test_matches_every_table_in_one_pass(self):
+        found = self.matcher.match("My Samsung washing machine leaks")
+        self.assertEqual(found, {"appliance": {"washing-machine"}, "brand": {"samsung"}})
+
+    def test_whole_words_only(self):
+        self.assertEqual(self.matcher.match("washers? no, washerwoman"), {"appliance": set(), "brand": set()})
+        self.assertEqual(self.matcher.match("LG."), {"appliance": set(), "brand": {"lg"}})
+
+    def test_hyphens_and_spacing_match_phrases(self):
+        for text in ("washing-machine", "Washing   Machine", "WASHING\tmachine"):
+            self.assertEqual(self.matcher.match(text)["appliance"], {"washing-machine"}, text)
+
+    def test_longest_match_wins(self):
+        # "washer" inside "dish washer" does not count on its own
+        self.assertEqual(self.matcher.match("the dish washer")["appliance"], {"dishwasher"})
+        self.assertEqual(
+            self.matcher.match("dish washer and washer")["appliance"], {"dishwasher", "washing-machine"},
+        )
+
+    def test_empty(self):
+        self.assertEqual(self.matcher.match(""), {"appliance": set(), "brand": set()})
+        self.assertEqual(KeywordMatcher({}).match("anything"), {})
+
+
+class ChatHistoryETagTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.chat = ChatMessage.objects.create(user=self.user, session_id="s1", message="hi", response="hello")
+
+    def get(self, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get("/api/chat/", {"session_id": "s1"}, **headers)
+
+    def test_unchanged_page_is_304(self):
+        first = self.get()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(len(first.data["results"]), 1)
+        again = self.get(first["ETag"])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again["ETag"], first["ETag"])
+
+    def test_new_or_updated_message_changes_etag(self):
+        etag = self.get()["ETag"]
+        self.chat.response = "updated"
+        self.chat.save()
+        changed = self.get(etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.data["results"][0]["response"], "updated")
+        ChatMessage.objects.create(user=self.user, session_id="s1", message="more")
+        self.assertEqual(self.get(changed["ETag"]).status_code, 200)
+
+    def test_pages_with_equal_timestamps_neither_repeat_nor_skip(self):
+        for n in range(4):
+            ChatMessage.objects.create(user=self.user, session_id="s1", message=f"m{n}")
+        ChatMessage.objects.filter(session_id="s1").update(timestamp=self.chat.timestamp)
+        seen, url, params = [], "/api/chat/", {"session_id": "s1", "page_size": 2}
+        while url:
+            page = self.client.get(url, params).json()
+            seen.extend(row["message"] for row in page["results"])
+            url, params = page["next"], None
+        self.assertEqual(seen, ["m3", "m2", "m1", "m0", "hi"])
+
+    def test_etag_is_per_user(self):
+        etag = self.get()["ETag"]
+        bob = User.objects.create_user("bob", password="pw")
+        self.client.force_authenticate(bob)
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["results"], [])
+
+
+class ChatSessionPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.sessions = [
+            ChatSession.objects.create(user=self.user, appliance="refrigerator", company=f"brand{i}", session_id=f"s{i}")
+            for i in range(5)
+        ]
+
+    def walk(self, touch_after_first_page=None):
+        seen, url, params = [], "/api/sessions/", {"page_size": 2}
+        while url:
+            page = self.client.get(url, params).json()
+            seen.extend(row["session_id"] for row in page["results"])
+            if touch_after_first_page is not None:
+                touch_after_first_page.save()  # bumps last_activity
+                touch_after_first_page = None
+            url, params = page["next"], None
+        return seen
+
+    def test_newest_first(self):
+        self.assertEqual(self.walk(), ["s4", "s3", "s2", "s1", "s0"])
+
+    def test_activity_during_walk_neither_repeats_nor_skips(self):
+        self.assertEqual(self.walk(touch_after_first_page=self.sessions[0]), ["s4", "s3", "s2", "s1", "s0"])
+
+
+@mock.patch("chat.jobs.INLINE_WORKERS", 0)
+@mock.patch("chat.throttling.USER_RATE_PER_MINUTE", 0)
+class ChatJobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def post(self, message):
+        response = self.client.post(
+            "/api/chat/", {"message": message, "appliance": "refrigerator", "brand": "lg"},
+            format="json", HTTP_PREFER="respond-async",
+        )
+        self.assertEqual(response.status_code, 202)
+        return response
+
+    def test_lifecycle(self):
+        response = self.post("why is it warm?")
+        self.assertEqual(response["Location"], f"/api/chat/{response.data['id']}/")
+        self.assertEqual(response.data["status"], "pending")
+        session_id = response.data["session_id"]
+        history = self.client.get("/api/chat/", {"session_id": session_id})
+
+        job = jobs.claim_next("w1")
+        self.assertEqual((job.status, job.worker, job.attempts), ("running", "w1", 1))
+        self.assertIsNone(jobs.claim_next("w2"))
+
+        with mock.patch("chat.views.rag.answer_query", return_value=("Check the door seal.", [])) as answer:
+            jobs.run_job(job)
+        self.assertEqual(answer.call_args.kwargs["session_id"], session_id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "done")
+        self.assertEqual(jobs.queue_stats(), {"queued": 0, "running": 0, "done": 1, "failed": 0})
+
+        detail = self.client.get(response["Location"])
+        self.assertEqual((detail.data["status"], detail.data["response"]), ("done", "Check the door seal."))
+        # the answer invalidates the history page the client polled before
+        again = self.client.get(
+            "/api/chat/", {"session_id": session_id}, HTTP_IF_NONE_MATCH=history["ETag"],
+        )
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.data["results"][0]["response"], "Check the door seal.")
+
+    def test_job_timings_include_the_save(self):
+        self.post("why is it warm?")
+        job = jobs.claim_next("w1")
+        with mock.patch("chat.views.rag.answer_query", return_value=("Check the door seal.", [])), \
+                mock.patch("chat.metrics.STORE_TIMINGS", True):
+            jobs.run_job(job)
+        self.assertEqual(set(ChatMessage.objects.get().timings), {"queue_wait", "save", "total"})
+
+    def test_one_job_per_session_at_a_time(self):
+        self.post("first")
+        self.post("second")
+        first = jobs.claim_next("w1")
+        self.assertEqual(first.message.message, "first")
+        self.assertIsNone(jobs.claim_next("w2"))
+        with mock.patch("chat.views.rag.answer_query", return_value=("ok", [])):
+            jobs.run_job(first)
+        self.assertEqual(jobs.claim_next("w2").message.message, "second")
+
+    def test_failure_stores_fallback_answer(self):
+        self.post("hello")
+        job = jobs.claim_next("w1")
+        with mock.patch("chat.views.rag.answer_query", side_effect=ValueError("bad response")), \
+                self.assertLogs("chat.views", "ERROR"):
+            jobs.run_job(job)
+        job.refresh_from_db()
+        job.message.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.error, "ValueError: bad response")
+        self.assertEqual(job.message.status, "failed")
+
+    def test_overloaded_job_is_requeued_without_using_an_attempt(self):
+        self.post("hello")
+        job = jobs.claim_next("w1")
+        with mock.patch("chat.views.rag.answer_query", side_effect=QueueFull("llm is busy", 0)), \
+                mock.patch("chat.jobs.time.sleep"):
+            jobs.run_job(job)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ("queued", 0))
+
+    def test_stale_jobs_are_requeued_then_given_up(self):
+        self.post("hello")
+        job = jobs.claim_next("w1")
+        ChatJob.objects.filter(id=job.id).update(
+            started_at=timezone.now() - timedelta(seconds=jobs.STALE_SECONDS + 1),
+        )
+        self.assertEqual(jobs.requeue_stale(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "queued")
+
+        ChatJob.objects.filter(id=job.id).update(
+            status="running", attempts=jobs.MAX_ATTEMPTS,
+            started_at=timezone.now() - timedelta(seconds=jobs.STALE_SECONDS + 1),
+        )
+        self.assertEqual(jobs.requeue_stale(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, "failed")
+
+
+class WarmupTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(warmup._state, {
+            "status": "cold", "pid": None, "error": None, "load_seconds": None, "embed_ping": None, "llm_ping": None,
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pipeline = mock.Mock(is_loaded=False, reranker=None)
+
+    def readiness(self):
+        is_ready, info = warmup.readiness(self.pipeline)
+        return is_ready, info["status"]
+
+    def test_warm_loads_and_pings_upstreams(self):
+        self.pipeline.call_llm.side_effect = ConnectionError("refused")
+        warmup.warm(self.pipeline)
+        self.pipeline.ensure_loaded.assert_called_once_with()
+        self.assertEqual(warmup._state["status"], "ready")
+        self.assertEqual(warmup._state["embed_ping"], "ok")
+        self.assertEqual(warmup._state["llm_ping"], "ConnectionError: refused")
+
+    def test_failed_load_is_reported(self):
+        self.pipeline.ensure_loaded.side_effect = FileNotFoundError("faiss_index.bin")
+        with self.assertLogs("chat.warmup", "ERROR"):
+            warmup.warm(self.pipeline)
+        self.assertEqual(warmup._state["status"], "failed")
+        self.assertEqual(self.readiness(), (False, "failed"))
+        self.pipeline.embed_query.assert_not_called()
+
+    def test_starts_once_per_process(self):
+        with mock.patch("chat.warmup.WARMUP_PING_UPSTREAM", False):
+            thread = warmup.start_warmup(self.pipeline)
+            thread.join(5)
+            self.assertIsNone(warmup.start_warmup(self.pipeline))
+        self.pipeline.ensure_loaded.assert_called_once_with()
+        self.assertEqual(self.readiness(), (True, "ready"))
+
+    def test_forked_worker_warms_itself(self):
+        warmup._state.update(pid=-1, status="loading")
+        with mock.patch("chat.warmup.start_warmup") as start:
+            self.assertEqual(self.readiness(), (False, "loading"))
+        start.assert_called_once_with(self.pipeline)
+
+    def test_ready_endpoint(self):
+        with mock.patch("chat.views.rag", self.pipeline):
+            self.assertEqual(APIClient().get("/api/health/ready/").status_code, 503)
+            self.pipeline.is_loaded = True
+            response = APIClient().get("/api/health/ready/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "ready")
+
+
+@mock.patch("chat.throttling.USER_RATE_PER_MINUTE", 0)
+class ChatStreamTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("alice", password="pw")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def stream(self, *steps):
+        """POST to the SSE endpoint with answer_query_stream yielding `steps` (an exception is raised)."""
+        def answer_query_stream(*args, **kwargs):
+            for step in steps:
+                if isinstance(step, Exception):
+                    raise step
+                yield step
+
+        with mock.patch("chat.views.rag.answer_query_stream", side_effect=answer_query_stream), \
+                mock.patch("chat.views.rag.admit"):
+            response = self.client.post(
+                "/api/chat/stream/", {"message": "why is it warm?", "appliance": "refrigerator", "brand": "lg"},
+                format="json",
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            body = b"".join(response.streaming_content).decode("utf-8")
+        events = []
+        for block in body.strip().split("\n\n"):
+            event, data = block.split("\n")
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+        return events
+
+    def test_tokens_then_saved_message(self):
+        sources = [{"file_name": "LG_Fridge_1.txt", "chunk_id": 3}]
+        events = self.stream(("token", "Check "), ("token", "the seal."), ("done", ("Check the seal.", sources)))
+        self.assertEqual(events[:2], [("token", {"text": "Check "}), ("token", {"text": "the seal."})])
+        kind, saved = events[2]
+        self.assertEqual((kind, saved["response"], saved["sources"]), ("done", "Check the seal.", sources))
+        self.assertEqual(ChatMessage.objects.get().response, "Check the seal.")
+
+    def test_failure_mid_stream_saves_the_fallback(self):
+        with self.assertLogs("chat.views", "ERROR"):
+            events = self.stream(("token", "Check "), ConnectionError("LLM went away"))
+        self.assertEqual(events[1], ("token", {"text": "\n\n" + FALLBACK_ANSWER}))
+        self.assertEqual(events[2][0], "done")
+        self.assertEqual(ChatMessage.objects.get().response, FALLBACK_ANSWER)
+
+    def test_disconnect_mid_stream_still_saves_the_turn(self):
+        def answer_query_stream(*args, **kwargs):
+            yield "token", "Check "
+            yield "token", "the seal."
+            yield "done", ("Check the seal.", [])
+
+        with mock.patch("chat.views.rag.answer_query_stream", side_effect=answer_query_stream), \
+                mock.patch("chat.views.rag.admit"):
+            response = self.client.post(
+                "/api/chat/stream/", {"message": "why is it warm?", "appliance": "refrigerator", "brand": "lg"},
+                format="json",
+            )
+            first = next(iter(response.streaming_content))
+            self.assertFalse(ChatMessage.objects.exists())
+            # the client goes away after the first token
+            response.close()
+        self.assertEqual(first, b'event: token\ndata: {"text": "Check "}\n\n')
+        saved = ChatMessage.objects.get()
+        self.assertEqual((saved.message, saved.response), ("why is it warm?", "Check "))
+
+    def test_stored_timings_include_the_save(self):
+        with mock.patch("chat.metrics.STORE_TIMINGS", True):
+            events = self.stream(("token", "Check the seal."), ("done", ("Check the seal.", [])))
+        self.assertIn("save", events[-1][1]["timings"])
+        self.assertIn("save", ChatMessage.objects.get().timings)
+
+    def test_busy_after_admission_saves_nothing(self):
+        events = self.stream(Overloaded("LLM queue full", retry_after=2))
+        self.assertEqual(events, [("busy", {"detail": UpstreamBusy.default_detail, "retry_after": 2})])
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_missing_fields(self):
+        response = self.client.post("/api/chat/stream/", {"message": "hi"}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class ConcurrencyLimiterTests(SimpleTestCase):
+    def test_full_queue_is_refused_at_once(self):
+        limiter = ConcurrencyLimiter("llm", max_concurrent=1, max_waiting=0, queue_seconds=5)
+        limiter.acquire()
+        with self.assertRaises(QueueFull) as cm:
+            limiter.check()
+        self.assertGreaterEqual(cm.exception.retry_after, 1)
+        with self.assertRaises(QueueFull):
+            limiter.acquire()
+        self.assertEqual((limiter.active, limiter.rejected), (1, 2))
+        limiter.release()
+        limiter.acquire()
+        self.assertEqual(limiter.stats()["admitted"], 2)
+
+    def test_waiter_gives_up_after_queue_seconds(self):
+        limiter = ConcurrencyLimiter("llm", max_concurrent=1, max_waiting=1, queue_seconds=0.05)
+        limiter.acquire()
+        with self.assertRaises(QueueFull):
+            limiter.acquire()
+        self.assertEqual(limiter.waiting, 0)
+
+    def test_disabled(self):
+        limiter = ConcurrencyLimiter("llm", max_concurrent=0)
+        for _ in range(10):
+            limiter.acquire()
+        limiter.check()
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("chat.admission.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker("llm", failure_threshold=2, reset_seconds=30)
+
+    def open(self):
+        for _ in range(2):
+            self.breaker.before()
+            self.breaker.failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, "closed")
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, "open")
+        with self.assertRaises(CircuitOpen) as cm:
+            self.breaker.before()
+        self.assertEqual(cm.exception.status_code, 503)
+        self.assertEqual(cm.exception.retry_after, 30)
+
+    def test_half_open_lets_one_trial_through(self):
+        self.open()
+        self.now += 30
+        self.assertEqual(self.breaker.state, "half-open")
+        self.breaker.before()
+        with self.assertRaises(CircuitOpen):
+            self.breaker.before()
+        with self.assertRaises(CircuitOpen):
+            self.breaker.check()
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, "closed")
+        self.breaker.before()
+
+    def test_failed_trial_opens_again(self):
+        self.open()
+        self.now += 30
+        self.breaker.before()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.breaker.opens, 2)
+
+    def test_cancelled_trial_frees_the_slot(self):
+        self.open()
+        self.now += 30
+        self.breaker.before()
+        self.breaker.cancel()
+        self.breaker.before()
+
+
+class UpstreamGuardTests(SimpleTestCase):
+    def test_client_errors_do_not_open_the_circuit(self):
+        guard = UpstreamGuard("llm", failure_threshold=1)
+        bad_request = ValueError("bad")
+        bad_request.response = mock.Mock(status_code=400)
+        with self.assertRaises(ValueError), guard.slot():
+            raise bad_request
+        self.assertEqual(guard.breaker.state, "closed")
+        with self.assertRaises(ConnectionError), guard.slot():
+            raise ConnectionError("refused")
+        self.assertEqual(guard.breaker.state, "open")
+        self.assertEqual(guard.errors, {"http_400": 1, "ConnectionError": 1})
+        self.assertEqual(guard.limiter.active, 0)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch("chat.throttling.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=0.5, burst=3)
+        self.assertEqual([bucket.take("u1") for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(bucket.take("u1"), 2.0)
+        # other keys have their own bucket
+        self.assertEqual(bucket.take("u2"), 0.0)
+        self.now += 2
+        self.assertEqual(bucket.take("u1"), 0.0)
+        self.assertGreater(bucket.take("u1"), 0.0)
+
+    def test_refill_is_capped_at_burst(self):
+        bucket = TokenBucket(rate=1.0, burst=2)
+        bucket.take("u1")
+        self.now += 3600
+        self.assertEqual([bucket.take("u1") for _ in range(2)], [0.0, 0.0])
+        self.assertGreater(bucket.take("u1"), 0.0)
+
+    def test_chat_throttle_limits_posts_only(self):
+        throttle = ChatRateThrottle()
+        request = mock.Mock(method="POST", user=User(pk=1, username="alice"))
+        with mock.patch("chat.throttling._buckets", TokenBucket(rate=1.0 / 60, burst=1)):
+            self.assertTrue(throttle.allow_request(request, None))
+            self.assertFalse(throttle.allow_request(request, None))
+            self.assertEqual(throttle.wait(), 60)
+            request.method = "GET"
+            self.assertTrue(throttle.allow_request(request, None))
+
+
+class ChunkerTests(SimpleTestCase):
+    def manual(self):
+        lines = []
+        for page in range(1, 7):
+            lines += [f"--- PAGE {page} ---", "ENGLISH", f"{page} SECTION {page}", ""]
+            for para in range(4):
+                lines += [f"Page {page} paragraph {para}: " + "clean the filter and check the seal " * 4, ""]
+        return lines
+
+    def test_chunks_stay_within_the_token_bound(self):
+        chunks = list(chunk_lines(self.manual(), max_tokens=80, overlap=10))
+        self.assertGreater(len(chunks), 6)
+        for chunk in chunks:
+            self.assertLessEqual(count_tokens(chunk["text"]), 80)
+            self.assertNotIn("ENGLISH", chunk["text"].split("\n"))
+
+    def test_long_line_is_split(self):
+        chunks = list(chunk_lines(["--- PAGE 1 ---", "word " * 500], max_tokens=60, overlap=0))
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(count_tokens(c["text"]) <= 60 for c in chunks))
+        self.assertEqual(sum(c["text"].count("word") for c in chunks), 500)
+
+    def test_page_ranges(self):
+        chunks = list(chunk_lines(self.manual(), max_tokens=300, overlap=20))
+        for chunk in chunks:
+            self.assertLessEqual(chunk["page_start"], chunk["page_end"])
+            pages = {int(w.split()[1]) for w in chunk["text"].split("\n") if w.startswith("Page ")}
+            # overlap lines carried from the previous chunk do not widen its range
+            self.assertGreaterEqual(chunk["page_start"], min(pages))
+            self.assertEqual(chunk["page_end"], max(pages))
+        self.assertEqual(chunks[0]["page_start"], 1)
+        self.assertEqual(chunks[-1]["page_end"], 6)
+        self.assertTrue(any(c["page_start"] < c["page_end"] for c in chunks))
+
+    def test_chunk_inside_a_section_leads_with_its_heading(self):
+        lines = ["--- PAGE 3 ---", "TROUBLESHOOTING", "Problem Possible cause Solution", ""]
+        lines += [f"Noise {i}: " + "the fan is blocked so clear it " * 3 for i in range(20)]
+        chunks = list(chunk_lines(lines, max_tokens=60, overlap=0))
+        self.assertGreater(len(chunks), 2)
+        for chunk in chunks:
+            head = chunk["text"].split("\n")[:2]
+            self.assertEqual(head, ["TROUBLESHOOTING", "Problem Possible cause Solution"])
+            self.assertEqual((chunk["section"], chunk["page_start"], chunk["page_end"]), ("TROUBLESHOOTING", 3, 3))
+
+
+class PromptBudgetTests(SimpleTestCase):
+    def setUp(self):
+        self.counter = TokenCounter()
+        self.budget = PromptBudget(self.counter, max_prompt_tokens=300, history_tokens=12, chunk_tokens=100)
+
+    def test_counter_estimates_without_a_tokenizer(self):
+        with self.assertLogs("chat.token_budget", "WARNING"):
+            counter = TokenCounter("/missing/tokenizer.json")
+        self.assertFalse(counter.exact)
+        self.assertEqual(counter.count("Press Start, then wait."), count_tokens("Press Start, then wait."))
+        self.assertEqual(counter.count(""), 0)
+
+    def test_history_keeps_leading_whole_sentences(self):
+        answer = "Unplug the washer. Open the filter door. Drain the water into a tray. Refit the filter."
+        self.assertEqual(self.budget.trim_history(answer), "Unplug the washer. Open the filter door.")
+        self.assertEqual(self.budget.trim_history("Short answer."), "Short answer.")
+        long_sentence = " ".join(["word"] * 50)
+        self.assertEqual(self.counter.count(self.budget.trim_history(long_sentence)), 12)
+
+    def test_fit_adds_best_chunks_until_the_budget_is_spent(self):
+        sections = [(f"[SOURCE: LG_WM_1.txt#{i}]", " ".join([f"step{i}"] * 150)) for i in range(5)]
+        prompt, tokens, used = self.budget.fit(RAGPipeline.render_prompt, "Why won't it drain?", sections)
+        self.assertLessEqual(tokens, 300)
+        self.assertEqual(tokens, self.counter.count(prompt))
+        self.assertGreaterEqual(used, 1)
+        self.assertLess(used, 5)
+        self.assertIn("[SOURCE: LG_WM_1.txt#0]", prompt)
+        self.assertNotIn(f"[SOURCE: LG_WM_1.txt#{used}]", prompt)
+        # every chunk was cut to chunk_tokens
+        self.assertLessEqual(prompt.count("step0"), 100)
+
+    def test_fit_skips_context_that_no_longer_fits(self):
+        budget = PromptBudget(self.counter, max_prompt_tokens=MIN_CHUNK_TOKENS + 120)
+        question = " ".join(["why"] * 1000)
+        prompt, tokens, used = budget.fit(RAGPipeline.render_prompt, question, [("[SOURCE: a#0]", "text " * 50)])
+        # the question is cut to half the budget, which leaves too little room for a chunk
+        self.assertEqual(used, 0)
+        self.assertLessEqual(prompt.count("why"), budget.max_prompt_tokens // 2)
+
+    def test_usage_prefers_the_server_counts(self):
+        pipeline = make_pipeline(None)
+        usage = {}
+        pipeline.record_usage(usage, 120, "Clean the filter.", {"prompt_tokens": 131, "completion_tokens": 5})
+        self.assertEqual(usage, {"prompt_tokens": 131, "completion_tokens": 5})
+        pipeline.record_usage(usage, 120, "Clean the filter.", {})
+        self.assertEqual(usage, {"prompt_tokens": 120, "completion_tokens": count_tokens("Clean the filter.")})
+
+
+class EmbeddingBatcherTests(SimpleTestCase):
+    def test_concurrent_texts_share_one_request(self):
+        calls = []
+
+        def embed_batch(texts):
+            calls.append(texts)
+            return [[float(len(t))] for t in texts]
+
+        batcher = EmbeddingBatcher(embed_batch, window=0.2)
+        futures = [batcher.submit(t) for t in ("ice", "water", "ice")]
+        self.assertEqual([f.result(5) for f in futures], [[3.0], [5.0], [3.0]])
+        self.assertEqual(calls, [["ice", "water"]])
+        self.assertEqual(batcher.stats()["items"], 3)
+
+    def test_short_response_fails_the_whole_batch(self):
+        batcher = EmbeddingBatcher(lambda texts: [[0.0]], window=0.2)
+        futures = [batcher.submit(t) for t in ("a", "b")]
+        for future in futures:
+            with self.assertRaises(ValueError):
+                future.result(5)
+
+    def test_timed_out_caller_is_dropped_from_its_batch(self):
+        calls, release = [], threading.Event()
+
+        def embed_batch(texts):
+            calls.append(texts)
+            release.wait(5)
+            return [[0.0] for _ in texts]
+
+        batcher = EmbeddingBatcher(embed_batch, window=0, max_in_flight=1)
+        first = batcher.submit("first")
+        while not calls:
+            release.wait(0.01)
+        # the only sender is busy, so "second" waits for it and times out
+        with self.assertRaises(FutureTimeout):
+            batcher.embed("second", timeout=0.1)
+        release.set()
+        self.assertEqual(first.result(5), [0.0])
+        batcher._senders.shutdown(wait=True)
+        self.assertEqual(calls, [["first"]])
+
+
+MANUAL_CHUNKS = [
+    "TROUBLESHOOTING\nError codes\nOE\nThe washer is not draining. Clean the drain pump filter.",
+    "The washer displays the \u201c4C\u201d code when the water supply is blocked.",
+    "Keep the door open after washing to dry the gasket. Use 3rd party cleaners with care.",
+    "Noise while spinning: level the washer, remove the shipping bolts (10mm).",
+]
+
+
+class CacheBackendTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.path = os.path.join(self.root, "cache.sqlite3")
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = LRUCache(max_entries=2, ttl=0)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_lru_entries_expire(self):
+        cache = LRUCache(max_entries=10, ttl=60)
+        with mock.patch("chat.cache_backends.time.monotonic", return_value=1000.0):
+            cache.set("a", 1)
+        with mock.patch("chat.cache_backends.time.monotonic", return_value=1061.0):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["expirations"], 1)
+
+    def test_sqlite_is_shared_between_instances(self):
+        writer = SQLiteCache(self.path, table="t", ttl=60)
+        reader = SQLiteCache(self.path, table="t", ttl=60)
+        writer.set("k", {"answer": "Clean the filter."})
+        self.assertEqual(reader.get("k"), {"answer": "Clean the filter."})
+        with mock.patch("chat.cache_backends.time.time", return_value=time.time() + 61):
+            self.assertIsNone(reader.get("k"))
+
+    def test_sqlite_prune_keeps_the_newest_rows(self):
+        cache = SQLiteCache(self.path, max_entries=3, ttl=0)
+        for i in range(5):
+            with mock.patch("chat.cache_backends.time.time", return_value=1000.0 + i):
+                cache.set(f"k{i}", i)
+        cache.prune()
+        self.assertEqual(len(cache), 3)
+        self.assertEqual([cache.get(f"k{i}") for i in range(5)], [None, None, 2, 3, 4])
+        self.assertEqual(cache.stats()["evictions"], 2)
+
+    def test_sqlite_errors_are_misses(self):
+        cache = SQLiteCache(self.path)
+        with mock.patch.object(cache, "_conn", side_effect=sqlite3.OperationalError("database is locked")):
+            self.assertEqual(cache.get("k", "default"), "default")
+            cache.set("k", 1)
+        self.assertEqual(cache.stats()["errors"], 2)
+
+    def test_embedding_cache_normalises_queries_and_fills_the_local_lru(self):
+        EmbeddingCache(shared_path=self.path).set("m", "Fridge not cooling?", [1, 2])
+        cache = EmbeddingCache(shared_path=self.path)
+        np.testing.assert_array_equal(cache.get("m", "  fridge NOT cooling "), [1, 2])
+        self.assertIsNone(cache.get("other-model", "fridge not cooling"))
+        cache.get("m", "fridge not cooling")
+        self.assertEqual(cache.stats(), {"hits": 2, "shared_hits": 1, "misses": 1, "entries": 1, "evictions": 0})
+
+    def test_repeated_query_is_embedded_once(self):
+        pipeline = make_pipeline(None)
+        pipeline.embed_batcher = None
+        with mock.patch.object(pipeline, "embed_texts", return_value=np.ones((1, 4), dtype="float32")) as embed:
+            first = pipeline.embed_query("Door won't lock")
+            second = pipeline.embed_query("door won't lock.")
+        embed.assert_called_once_with(["Door won't lock"])
+        np.testing.assert_array_equal(first, second)
+        self.assertEqual(second.shape, (1, 4))
+
+
+class SessionStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.path = os.path.join(self.root, "sessions.sqlite3")
+
+    def test_backend_follows_the_configuration(self):
+        self.assertIsInstance(session_store(), LocalSessionStore)
+        self.assertIsInstance(session_store(shared_path=self.path), SharedSessionStore)
+        with self.assertRaises(TypeError):
+            SessionContextStore()
+
+    def test_local_store_is_bounded_and_clipped(self):
+        store = LocalSessionStore(max_entries=2, max_chars=5)
+        for session_id in ("s1", "s2", "s3"):
+            store.set(session_id, f"answer for {session_id}")
+        self.assertIsNone(store.get("s1"))
+        self.assertEqual(store.get("s3"), "answe")
+        store.delete("s3")
+        self.assertIsNone(store.get("s3"))
+        self.assertEqual(store.stats()["backend"], "local")
+        self.assertEqual(store.stats()["evictions"], 1)
+
+    def test_shared_store_is_seen_by_every_worker(self):
+        first, second = SharedSessionStore(self.path, ttl=60), SharedSessionStore(self.path, ttl=60)
+        first.set("s1", "Unplug the fridge for 5 minutes.")
+        self.assertEqual(second.get("s1"), "Unplug the fridge for 5 minutes.")
+        self.assertEqual(second.stats()["entries"], 1)
+        second.delete("s1")
+        self.assertIsNone(first.get("s1"))
+        first.set("s2", "Reset the breaker.")
+        with mock.patch("chat.cache_backends.time.time", return_value=time.time() + 61):
+            self.assertIsNone(second.get("s2"))
+
+    def test_follow_up_on_another_worker_sees_the_previous_answer(self):
+        snapshot = make_snapshot(MANUAL_CHUNKS, np.eye(4, dtype="float32"))
+        with mock.patch("chat.rag_pipeline.SESSION_CONTEXT_DB", self.path):
+            worker_a, worker_b = make_pipeline(snapshot), make_pipeline(snapshot)
+        ctx = worker_a.start_query("my washer is loud")
+        ctx.update(cached=None, retrieved=[], qvec=None, version="v1")
+        worker_a.finish_query(ctx, "Check the drain pump filter.", session_id="s1")
+        follow_up = worker_b.start_query("tell me more", session_id="s1")
+        self.assertEqual(follow_up["query_for_embedding"], "Check the drain pump filter.\n\nUser follow-up: tell me more")
+        self.assertEqual(worker_b.start_query("tell me more", session_id="s2")["query_for_embedding"], "tell me more")
+
+
+class DisplayCodeTests(SimpleTestCase):
+    def test_code_shapes(self):
+        for word in ("OE", "dE", "4C", "1E", "dE1", "LE1", "AC", "UV"):
+            self.assertTrue(is_code(word), word)
+        for word in ("3rd", "10mm", "3sec", "v1", "cm2", "de", "Ok", "EN", "E", "ERROR"):
+            self.assertFalse(is_code(word), word)
+
+    def test_codes_come_from_the_manuals(self):
+        self.assertEqual(display_codes(MANUAL_CHUNKS[0]), {"OE"})
+        self.assertEqual(display_codes(MANUAL_CHUNKS[1]), {"4C"})
+        # a line of code-shaped words outside an error/code passage is not a code table
+        self.assertEqual(display_codes("UV\nThe lamp keeps the water tank clean."), set())
+        lexical = BM25Index.build(MANUAL_CHUNKS)
+        self.assertEqual(lexical.codes, {"OE", "4C"})
+        self.assertEqual(lexical.code_terms("What does OE mean? And 4C?"), ["OE", "4C"])
+        self.assertEqual(lexical.code_terms("my AC makes a noise at 10mm, is it UV or dB? oe"), [])
+
+    def test_code_search_matches_codes_only(self):
+        lexical = BM25Index.build(MANUAL_CHUNKS + ["oe is also a word here"])
+        rows, _ = lexical.code_search(["OE"], 5)
+        self.assertEqual(rows.tolist(), [0])
+
+    def test_reciprocal_rank_fusion(self):
+        self.assertEqual(reciprocal_rank_fusion([[1, 2, 3], [2, 3, 4]]), [2, 3, 1, 4])
+
+
+class HybridRetrievalTests(SimpleTestCase):
+    def setUp(self):
+        # the dense side ranks chunk 3 (spinning noise) first for every query
+        self.snapshot = make_snapshot(MANUAL_CHUNKS, np.eye(4, dtype="float32"))
+        self.pipeline = make_pipeline(self.snapshot)
+        patcher = mock.patch.object(
+            self.pipeline, "embed_query", return_value=np.array([[0, 0, 0, 1]], dtype="float32"),
+        )
+        self.embed = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def retrieve(self, query):
+        with mock.patch("chat.rag_pipeline.RETRIEVE_K", 2), mock.patch.object(self.pipeline, "reranker", None):
+            return self.pipeline.prepare_query(query)
+
+    def test_ordinary_question_is_embedded(self):
+        ctx = self.retrieve("my AC makes a noise at 10mm")
+        self.assertEqual(ctx["codes"], [])
+        self.embed.assert_called_once()
+        self.assertEqual(ctx["retrieved"][0]["chunk_id"], 3)
+        self.assertIn("distance", ctx["retrieved"][0])
+
+    def test_code_question_fuses_code_hits_with_dense_results(self):
+        ctx = self.retrieve("what does OE mean")
+        self.assertEqual(ctx["codes"], ["OE"])
+        self.embed.assert_called_once()
+        self.assertEqual([hit["chunk_id"] for hit in ctx["retrieved"]], [0, 3])
+
+    def test_falls_back_to_bm25_when_embedding_fails(self):
+        self.embed.side_effect = TimeoutError
+        with self.assertLogs("chat.rag_pipeline", "WARNING"):
+            ctx = self.retrieve("what does OE mean")
+        self.assertIsNone(ctx["qvec"])
+        self.assertEqual(ctx["retrieved"][0]["chunk_id"], 0)
+
+
+class RetrieveManyTests(SimpleTestCase):
+    def setUp(self):
+        self.snapshot = make_snapshot(MANUAL_CHUNKS, np.eye(4, dtype="float32"))
+        self.pipeline = make_pipeline(self.snapshot)
+
+    def test_batched_search_matches_single_queries(self):
+        qvecs = np.array([[1, 0, 0, 0], [0, 0, 0.9, 0.1], [0, 1, 0, 0]], dtype="float32")
+        batched = self.pipeline.retrieve_many(qvecs, k=2)
+        self.assertEqual(len(batched), 3)
+        for qvec, hits in zip(qvecs, batched):
+            self.assertEqual(hits, self.pipeline.retrieve(qvec, k=2))
+        self.assertEqual([hit["chunk_id"] for hit in batched[1]], [2, 3])
+        self.assertEqual(batched[0][0]["text"], MANUAL_CHUNKS[0])
+        self.assertAlmostEqual(batched[0][0]["distance"], 0.0)
+
+    def test_missing_neighbours_are_dropped(self):
+        hits = self.pipeline.retrieve(np.array([1, 0, 0, 0], dtype="float32"), k=10)
+        self.assertEqual(sorted(hit["chunk_id"] for hit in hits), [0, 1, 2, 3])
+
+    def test_hits_resolve_metadata_and_pages_from_arrays(self):
+        metadata = [
+            {"file_name": "LG_WM_1.txt", "chunk_id": 5, "page_start": 2, "page_end": 3},
+            {"file_name": "Sam_WM_1.txt", "chunk_id": 9},
+        ]
+        names, file_ids, chunk_ids = metadata_arrays(metadata)
+        self.assertEqual(names, ["LG_WM_1.txt", "Sam_WM_1.txt"])
+        np.testing.assert_array_equal(file_ids, [0, 1])
+        np.testing.assert_array_equal(chunk_ids, [5, 9])
+        index = faiss.IndexFlatL2(2)
+        index.add(np.eye(2, dtype="float32"))
+        lookup = {("LG_WM_1.txt", 5): "Drain the pump.", ("Sam_WM_1.txt", 9): "Level the feet."}
+        snap = IndexSnapshot("v1", index, metadata, lookup, PartitionedIndex(index))
+        hits = RAGPipeline.make_hits(snap, [1, 0], bm25=[1.5, 0.5])
+        self.assertEqual(hits, [
+            {"file_name": "Sam_WM_1.txt", "chunk_id": 9, "bm25": 1.5, "text": "Level the feet."},
+            {"file_name": "LG_WM_1.txt", "chunk_id": 5, "pages": [2, 3], "bm25": 0.5, "text": "Drain the pump."},
+        ])
+
+
+class AsyncStoreTests(SimpleTestCase):
+    """aanswer_query keeps shared cache / session-store I/O off the event loop."""
+
+    def setUp(self):
+        self.pipeline = make_pipeline(make_snapshot(MANUAL_CHUNKS, np.eye(4, dtype="float32")))
+        self.pipeline.reranker = None
+        self.threads = {}
+
+    def record(self, name, func):
+        def call(*args, **kwargs):
+            self.threads[name] = threading.get_ident()
+            return func(*args, **kwargs)
+        return call
+
+    def answer(self):
+        pipeline = self.pipeline
+        for name, store in (("session", pipeline.session_contexts), ("embed", pipeline.embed_cache)):
+            for op in ("get", "set"):
+                setattr(store, op, self.record(f"{name}.{op}", getattr(store, op)))
+        pipeline.answer_cache.set = self.record("answer.set", pipeline.answer_cache.set)
+
+        async def run():
+            self.threads["loop"] = threading.get_ident()
+            with mock.patch.object(pipeline, "acall_llm", mock.AsyncMock(return_value="Clean the filter.")), \
+                    mock.patch.object(pipeline, "embed_batcher", None), \
+                    mock.patch("chat.rag_pipeline.get_async_session") as session:
+                response = mock.Mock()
+                response.json.return_value = {"data": [{"embedding": [0, 0, 0, 1]}]}
+                session.return_value.post = mock.AsyncMock(return_value=response)
+                return await pipeline.aanswer_query("what does OE mean", session_id="s1")
+
+        with mock.patch("chat.rag_pipeline.RETRIEVE_K", 2):
+            return asyncio.run(run())
+
+    def test_shared_stores_are_called_off_the_loop(self):
+        self.pipeline.shared_stores = True
+        answer, _ = self.answer()
+        self.assertTrue(answer.startswith("Clean the filter."))
+        for name in ("session.get", "session.set", "embed.get", "embed.set", "answer.set"):
+            self.assertNotEqual(self.threads[name], self.threads["loop"], name)
+
+    def test_in_process_stores_are_called_inline(self):
+        self.pipeline.shared_stores = False
+        self.answer()
+        for name in ("session.get", "session.set", "embed.get", "embed.set", "answer.set"):
+            self.assertEqual(self.threads[name], self.threads["loop"], name)
+
+
+class MetricsTests(SimpleTestCase):
+    def test_counter_and_label_escaping(self):
+        counter = Counter("requests_total", "Requests.", ["outcome"])
+        counter.inc(outcome="ok")
+        counter.inc(2, outcome='say "hi"\n')
+        self.assertEqual(counter.render(), [
+            "# HELP requests_total Requests.",
+            "# TYPE requests_total counter",
+            'requests_total{outcome="ok"} 1',
+            'requests_total{outcome="say \\"hi\\"\\n"} 2',
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram("stage_seconds", "Stage time.", ["stage"], buckets=(0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, stage="llm")
+        self.assertEqual(list(histogram.samples()), [
+            'stage_seconds_bucket{stage="llm",le="0.1"} 1',
+            'stage_seconds_bucket{stage="llm",le="1"} 2',
+            'stage_seconds_bucket{stage="llm",le="+Inf"} 3',
+            'stage_seconds_sum{stage="llm"} 5.55',
+            'stage_seconds_count{stage="llm"} 3',
+        ])
+
+    def test_failing_collector_is_skipped(self):
+        registry = Registry()
+        registry.add(Collected("broken", "Raises.", (), collect=lambda: 1 / 0))
+        registry.add(Collected("loaded", "Works.", (), collect=lambda: {(): 1}))
+        self.assertEqual(registry.render(), "# broken not collected: ZeroDivisionError\n"
+                                            "# HELP loaded Works.\n# TYPE loaded gauge\nloaded 1\n")
+
+    def test_timings_breakdown_is_opt_in(self):
+        timings = Timings()
+        with timings.span("embed"):
+            pass
+        with timings.span("embed"):
+            pass
+        self.assertEqual(list(timings.stages), ["embed"])
+        with mock.patch("chat.metrics.STORE_TIMINGS", False):
+            self.assertIsNone(timings.breakdown())
+        with mock.patch("chat.metrics.STORE_TIMINGS", True):
+            breakdown = timings.breakdown()
+        self.assertEqual(set(breakdown), {"embed", "total"})
+        self.assertGreaterEqual(breakdown["total"], breakdown["embed"])
+
+    def test_metrics_endpoint(self):
+        with mock.patch("chat.views.METRICS_TOKEN", "secret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertIn("# TYPE companion_stage_seconds histogram", response.content.decode("utf-8"))
+
+    def test_upstream_connection_reuse_is_exported(self):
+        pipeline = make_pipeline(None)
+        registry = Registry()
+        register_collectors(pipeline, registry)
+        stats = {"requests": 7, "connections_opened": 2, "connections_reused": 5}
+        with mock.patch.object(pipeline.http, "stats", return_value=stats):
+            text = registry.render()
+        self.assertIn("# TYPE companion_upstream_connections_total counter", text)
+        self.assertIn('companion_upstream_connections_total{event="opened"} 2', text)
+        self.assertIn('companion_upstream_connections_total{event="reused"} 5', text)
+
+
+class IndexFactoryTests(SimpleTestCase):
+    def test_factory_strings(self):
+        self.assertEqual(factory_string("flat", 64, 10), "Flat")
+        self.assertEqual(factory_string("ivf_flat", 64, 100000), "IVF256,Flat")
+        # too few vectors to train 256 cells of ~39 points each
+        self.assertEqual(factory_string("ivf_flat", 64, 3900), "IVF100,Flat")
+        self.assertEqual(factory_string("ivf_pq", 64, 100000, {"pq_m": 16}), "IVF256,PQ16x8")
+        self.assertEqual(factory_string("hnsw", 64, 10, {"hnsw_m": 16}), "HNSW16")
+        self.assertEqual(factory_string("pq", 64, 100, {"pq_m": 8}), "PQ8x6")
+        with self.assertRaises(ValueError):
+            factory_string("pq", 60, 100000, {"pq_m": 64})
+        with self.assertRaises(ValueError):
+            factory_string("annoy", 64, 100)
+
+    def test_small_corpora_stay_flat(self):
+        vectors = np.random.default_rng(0).random((50, 8), dtype="float32")
+        for index_type in ("ivf_flat", "ivf_pq", "hnsw", "pq"):
+            index = build_index(vectors, index_type, {"pq_m": 4})
+            self.assertIsInstance(faiss.downcast_index(index), faiss.IndexFlat, index_type)
+            self.assertEqual(index.ntotal, 50)
+        self.assertIsInstance(faiss.downcast_index(build_index(vectors, "sq8")), faiss.IndexScalarQuantizer)
+
+    def test_ann_types_keep_recall_against_flat(self):
+        rng = np.random.default_rng(0)
+        corpus, queries = synthetic_corpus(4000, 32, 50, rng, n_clusters=40)
+        truth = exact_neighbours(corpus, queries, 4)
+        for index_type in ("ivf_flat", "hnsw"):
+            index = build_index(corpus, index_type, {"nlist": 32, "hnsw_m": 16})
+            set_search_params(index, nprobe=8, ef_search=64)
+            self.assertGreaterEqual(recall_at_k(index.search(queries, 4)[1], truth), 0.9, index_type)
+
+    def test_recall_at_k_ignores_empty_slots(self):
+        truth = np.array([[1, 2], [3, 4]])
+        self.assertEqual(recall_at_k(np.array([[2, 1], [3, -1]]), truth), 0.75)
+
+
+class CompressedIndexTests(SimpleTestCase):
+    def test_rerank_exact_scores_candidates_against_the_float_store(self):
+        vectors = np.array([[0, 0], [1, 0], [3, 0], [10, 0]], dtype="float32")
+        qvecs = np.array([[2.9, 0], [0, 0]], dtype="float32")
+        # duplicates and -1 padding are dropped; the second query has fewer candidates than k
+        candidates = np.array([[0, 2, 2, 1, -1], [3, -1, -1, -1, -1]])
+        D, I = rerank_exact(vectors, qvecs, candidates, 2)
+        np.testing.assert_array_equal(I, [[2, 1], [3, -1]])
+        np.testing.assert_allclose(D[0], [0.01, 3.61], rtol=1e-5)
+        self.assertEqual(D[1, 0], 100)
+
+    def test_reranked_compressed_search_recovers_exact_neighbours(self):
+        rng = np.random.default_rng(1)
+        corpus, queries = synthetic_corpus(2000, 32, 50, rng, n_clusters=20)
+        truth = exact_neighbours(corpus, queries, 4)
+        metadata = [{"file_name": "Other_1.txt", "chunk_id": i} for i in range(len(corpus))]
+        for index_type in ("sq8", "pq"):
+            index = build_index(corpus, index_type, {"pq_m": 16, "pq_nbits": 5}, min_vectors=0)
+            self.assertLess(bytes_per_vector(index), corpus.shape[1] * 4)
+            plain = recall_at_k(index.search(queries, 4)[1], truth)
+            reranked = PartitionedIndex(index, vectors=corpus, rerank_factor=8)
+            recall = recall_at_k(reranked.search(queries, 4)[1], truth)
+            self.assertGreaterEqual(recall, plain, index_type)
+            self.assertGreaterEqual(recall, 0.95, index_type)
+
+    def test_rerank_needs_a_float_store(self):
+        index = build_index(np.eye(4, dtype="float32"), "sq8")
+        self.assertEqual(PartitionedIndex(index, rerank_factor=4).rerank_factor, 1)
+
+
+class VersionStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.store = VersionStore(self.root, keep=2)
+
+    def publish(self, texts, **info):
+        """Publish a flat index over one-hot vectors with `texts` as its chunk store."""
+        version, staging = self.store.stage()
+        index = faiss.IndexFlatL2(len(texts))
+        index.add(np.eye(len(texts), dtype="float32"))
+        faiss.write_index(index, staging.index)
+        write_chunk_store(staging.chunk_store, [("LG_WM_1.txt", i, text) for i, text in enumerate(texts)])
+        self.store.commit(version, staging, **info)
+        return version
+
+    def test_without_a_manifest_the_legacy_layout_is_used(self):
+        version, paths = self.store.current()
+        self.assertIsNone(version)
+        self.assertEqual((paths.root, paths.index_type), (os.path.abspath(self.root), None))
+
+    def test_publish_stages_a_copy_and_swaps_the_manifest(self):
+        first = self.publish(["Drain the pump."], index_type="sq8")
+        version, paths = self.store.current()
+        self.assertEqual((version, paths.index_type), (first, "sq8"))
+
+        second, staging = self.store.stage()
+        # the staged copy starts from the current version's files, and is not visible yet
+        self.assertTrue(os.path.exists(staging.chunk_store))
+        self.assertEqual(self.store.current()[0], first)
+        self.store.commit(second, staging)
+        version, paths = self.store.current()
+        self.assertEqual((version, paths.index_type), (second, "sq8"))
+
+    def test_old_versions_are_pruned(self):
+        versions = []
+        for i in range(4):
+            versions.append(self.publish([f"text {i}"]))
+            # commit orders versions by mtime
+            os.utime(os.path.join(self.store.versions_dir, versions[-1]), (1000 + i, 1000 + i))
+        self.assertEqual(sorted(os.listdir(self.store.versions_dir)), sorted(versions[-2:]))
+
+    def test_workers_hot_reload_a_new_version(self):
+        first = self.publish(["Drain the pump.", "Level the feet."])
+        pipeline = RAGPipeline()
+        with mock.patch("chat.rag_pipeline.VERSION_STORE", self.store), \
+                mock.patch("chat.rag_pipeline.RELOAD_CHECK_SECONDS", 0.01):
+            pipeline.ensure_loaded()
+            self.assertEqual(pipeline.index_version, first)
+            old = pipeline.snapshot
+            second = self.publish(["Clean the filter.", "Drain the pump.", "Level the feet."])
+            pipeline._next_reload_check = 0
+            with mock.patch.object(pipeline.answer_cache, "invalidate") as invalidate, \
+                    mock.patch("chat.rag_pipeline.threading.Thread") as thread:
+                pipeline.ensure_loaded()
+                # the request that noticed the new version keeps the old snapshot
+                self.assertIs(pipeline.snapshot, old)
+                thread.assert_called_once()
+                pipeline.reload(*thread.call_args.kwargs["args"])
+            invalidate.assert_called_once_with()
+        self.assertEqual(pipeline.index_version, second)
+        self.assertEqual(pipeline.retrieve(np.array([1, 0, 0], dtype="float32"), k=1)[0]["text"], "Clean the filter.")
+        self.assertFalse(pipeline._reloading)
+
+    def test_failed_reload_keeps_serving_the_old_version(self):
+        first = self.publish(["Drain the pump."])
+        pipeline = RAGPipeline()
+        with mock.patch("chat.rag_pipeline.VERSION_STORE", self.store):
+            pipeline.ensure_loaded()
+            with self.assertLogs("chat.rag_pipeline", "ERROR"):
+                pipeline.reload("broken", IndexPaths(os.path.join(self.root, "missing")))
+        self.assertEqual(pipeline.index_version, first)
+        self.assertFalse(pipeline._reloading)
+
+
+class ChunkStoreTests(SimpleTestCase):
+    ROWS = [
+        ("LG_WM_1.txt", 0, "Clean the drain pump filter.", 3, 4),
+        ("LG_WM_1.txt", 1, "", 0, 0),
+        ("Sam_Fridge_1.txt", 7, "Température: réglez 3 °C ❄", 12, 12),
+    ]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.path = os.path.join(self.root, "chunk_store.bin")
+        write_chunk_store(self.path, self.ROWS)
+
+    def test_round_trip(self):
+        store = ChunkStore(self.path)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(store[0], {"file_name": "LG_WM_1.txt", "chunk_id": 0, "page_start": 3, "page_end": 4})
+        self.assertEqual(store[1], {"file_name": "LG_WM_1.txt", "chunk_id": 1})
+        self.assertEqual([store.text(i) for i in range(3)], [row[2] for row in self.ROWS])
+        self.assertEqual(store.file_names, ["LG_WM_1.txt", "Sam_Fridge_1.txt"])
+
+    def test_arrays_match_the_json_metadata(self):
+        store = ChunkStore(self.path)
+        metadata = list(store)
+        for from_store, from_list in zip(metadata_arrays(store), metadata_arrays(metadata)):
+            np.testing.assert_array_equal(from_store, from_list)
+        for from_store, from_list in zip(page_arrays(store), page_arrays(metadata)):
+            np.testing.assert_array_equal(from_store, from_list)
+
+    def test_rejects_other_files(self):
+        with open(self.path, "r+b") as f:
+            f.write(b"NOTASTOR")
+        with self.assertRaises(ValueError):
+            ChunkStore(self.path)
+
+    def test_pipeline_serves_text_from_the_store(self):
+        paths = IndexPaths(self.root)
+        index = faiss.IndexFlatL2(2)
+        index.add(np.eye(3, 2, dtype="float32"))
+        faiss.write_index(index, paths.index)
+        snap = make_pipeline(None).load_snapshot("v1", paths)
+        self.assertIsInstance(snap.metadata, ChunkStore)
+        self.assertIsNone(snap.chunk_lookup)
+        self.assertEqual(snap.chunk_text(2, snap.metadata[2]), self.ROWS[2][2])
+
+
+class PartitionedIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = rng.random((400, 16), dtype="float32")
+        self.queries = rng.random((5, 16), dtype="float32")
+        names = ["LG_WM_1.txt", "Sam_Fridge_1.txt", "LG_Fridge_2.txt", "Other_1.txt"]
+        self.metadata = [{"file_name": names[i % 4], "chunk_id": i} for i in range(400)]
+
+    def index(self, index_type):
+        index = build_index(self.vectors, index_type, {"nlist": 4}, min_vectors=1)
+        set_search_params(index, nprobe=4, ef_search=64)
+        return index
+
+    def test_filtered_partitions_match_built_sub_indexes(self):
+        for index_type in ("flat", "ivf_flat", "hnsw"):
+            index = self.index(index_type)
+            built = PartitionedIndex.build(index, self.metadata, "flat", vectors=self.vectors)
+            filtered = PartitionedIndex.filtered(index, self.metadata)
+            self.assertEqual(filtered.indexes(), [index])
+            for brand, appliance in (("lg", "washing-machine"), ("samsung", "refrigerator")):
+                rows = set(filtered.rows(brand, appliance).tolist())
+                D, I = filtered.search(self.queries, 5, brand=brand, appliance=appliance)
+                self.assertTrue(set(I.ravel().tolist()) <= rows, index_type)
+                if index_type == "flat":
+                    _, expected = built.search(self.queries, 5, brand=brand, appliance=appliance)
+                    np.testing.assert_array_equal(I, expected)
+
+    def test_legacy_layout_filters_the_global_index(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        paths = IndexPaths(root)
+        faiss.write_index(self.index("flat"), paths.index)
+        with open(paths.metadata, "w", encoding="utf-8") as f:
+            json.dump(self.metadata, f)
+        snap = make_pipeline(None).load_snapshot("legacy", paths)
+        self.assertEqual(len(snap.partitions.indexes()), 1)
+        self.assertEqual(len(snap.partitions.rows("lg", "refrigerator")), 100)
+
+
+class RerankerTests(SimpleTestCase):
+    HITS = [
+        {"chunk_id": 0, "text": "Installation: remove the shipping bolts before use."},
+        {"chunk_id": 1, "text": "If the drain pump filter is clogged the washer will not drain."},
+        {"chunk_id": 2, "text": "If the drain pump filter is clogged the washer will not drain water."},
+        {"chunk_id": 3, "text": "Drain hose kinked? The washer will not drain."},
+    ]
+
+    def order(self, reranker, k=3):
+        return [hit["chunk_id"] for hit in reranker.rerank("washer will not drain, filter clogged", self.HITS, k)]
+
+    def test_lexical_promotes_chunks_covering_the_query(self):
+        reranker = Reranker("lexical", budget_ms=1000)
+        self.assertEqual(self.order(reranker), [1, 2, 3])
+        self.assertEqual(reranker.stats()["reranked"], 1)
+
+    def test_mmr_skips_near_duplicates(self):
+        hits = [
+            {"chunk_id": 0, "text": "Washer will not drain: clean the drain pump filter."},
+            {"chunk_id": 1, "text": "Washer will not drain: clean the drain pump filter!"},
+            {"chunk_id": 2, "text": "Washer will not drain when the hose is kinked."},
+        ]
+        lexical = Reranker("lexical", budget_ms=1000).rerank("washer will not drain", hits, 2)
+        self.assertEqual([hit["chunk_id"] for hit in lexical], [0, 1])
+        mmr = Reranker("mmr", budget_ms=1000, mmr_lambda=0.7).rerank("washer will not drain", hits, 2)
+        self.assertEqual([hit["chunk_id"] for hit in mmr], [0, 2])
+
+    def test_over_budget_keeps_retrieval_order(self):
+        reranker = Reranker("cross-encoder", budget_ms=50)
+        encoder = mock.Mock()
+        encoder.score.side_effect = lambda query, texts: [float(len(t)) for t in texts]
+        clock = itertools.count(0, 0.03)
+        hits = self.HITS * 5
+        with mock.patch.object(reranker, "encoder", return_value=encoder), \
+                mock.patch("chat.reranker.time.perf_counter", side_effect=lambda: next(clock)):
+            self.assertEqual(reranker.rerank("drain", hits, 3), hits[:3])
+        # stopped after the second batch instead of scoring all 20 candidates
+        self.assertEqual(encoder.score.call_count, 2)
+        self.assertEqual((reranker.stats()["reranked"], reranker.stats()["bypassed"]), (0, 1))
+
+    def test_cross_encoder_without_a_model_falls_back_to_lexical(self):
+        reranker = Reranker("cross-encoder", budget_ms=1000, model_dir=None)
+        with self.assertLogs("chat.reranker", "WARNING"):
+            self.assertIsNone(reranker.encoder())
+        self.assertEqual(self.order(reranker), [1, 2, 3])
+
+
+class IngestTests(SimpleTestCase):
+    """ingest_manual against a private data directory published as sq8."""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.store = VersionStore(os.path.join(root, "vectorstore"))
+        ingest_dir = os.path.join(root, "vectorstore", "ingest")
+        missing = os.path.join(root, "missing.json")
+        for target, value in [
+            ("chat.rag_pipeline.VERSION_STORE", self.store),
+            ("chat.rag_pipeline.CHUNKS_JSON", missing),
+            ("chat.rag_pipeline.EMB_JSON", missing),
+            ("chat.ingest.SOURCE_CHUNKS_JSON", missing),
+            ("chat.ingest.INGEST_DIR", ingest_dir),
+            ("chat.ingest.MASTER_INDEX_FILE", os.path.join(ingest_dir, "chunks.index")),
+            ("chat.ingest.REGISTRY_FILE", os.path.join(ingest_dir, "registry.json")),
+        ]:
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        rng = np.random.default_rng(0)
+        self.vectors = rng.standard_normal((6, 8)).astype("float32")
+        self.entries = [
+            {"file_name": name, "chunk_id": n, "text": f"{name} chunk {n}"}
+            for name in ("LG_WM_1.txt", "Sam_WM_1.txt") for n in (1, 2, 3)
+        ]
+        metadata = [ingest.metadata_entry(e) for e in self.entries]
+        index = build_index(self.vectors, "sq8")
+        version, staging = self.store.stage()
+        ingest.write_version(
+            staging, index, metadata, PartitionedIndex.build(index, metadata, "sq8", vectors=self.vectors),
+            ((e["file_name"], e["chunk_id"], e["text"], 0, 0) for e in self.entries), self.vectors,
+        )
+        self.store.commit(version, staging, index_type="sq8")
+
+    def published(self):
+        version, paths = self.store.current()
+        self.assertEqual(self.store.manifest()["index_type"], "sq8")
+        self.assertEqual(paths.index_type, "sq8")
+        return paths, np.load(paths.vectors)
+
+    def test_seed_keeps_the_exact_vectors(self):
+        registry = ingest.ChunkRegistry.load()
+        _, vectors, entries = registry.ordered()
+        np.testing.assert_array_equal(vectors, self.vectors)
+        self.assertEqual([e["text"] for e in entries], [e["text"] for e in self.entries])
+
+    def test_replace_keeps_the_published_type(self):
+        registry = ingest.ChunkRegistry.load()
+        new_vector = np.full((1, 8), 7.0, dtype="float32")
+        chunks = [{"text": "LG_WM_1.txt chunk 1"}, {"text": "a new chunk"}]
+        stats = registry.replace_manual("LG_WM_1.txt", chunks, embed=lambda texts: new_vector)
+        self.assertEqual((stats["unchanged"], stats["embedded"], stats["removed"]), (1, 1, 2))
+        ingest.publish(registry)
+
+        _, vectors = self.published()
+        np.testing.assert_array_equal(vectors, np.vstack([self.vectors[[0, 3, 4, 5]], new_vector]))
+
+    def test_remove_keeps_the_published_type(self):
+        call_command("ingest_manual", "Sam_WM_1.txt", "--remove", stdout=io.StringIO())
+        paths, vectors = self.published()
+        np.testing.assert_array_equal(vectors, self.vectors[:3])
+        self.assertEqual(faiss.read_index(paths.index).ntotal, 3)
+
+        # the saved registry is the starting point of the next run
+        registry = ingest.ChunkRegistry.load()
+        self.assertEqual(sorted(registry.entries), [0, 1, 2])
+        np.testing.assert_array_equal(registry.ordered()[1], self.vectors[:3])
+
+
+class PdfExtractTests(SimpleTestCase):
+    def test_failed_ocr_never_becomes_page_text(self):
+        pdf = mock.MagicMock()
+        pdf.__enter__.return_value.pages = [
+            mock.Mock(**{"extract_text.return_value": "Clean the filter."}),
+            mock.Mock(**{"extract_text.return_value": ""}),
+        ]
+        pix = mock.Mock(width=1, height=1, samples=b"\0\0\0")
+        doc = mock.Mock(**{"load_page.return_value.get_pixmap.return_value": pix})
+        with mock.patch.object(pdf_extract, "pdfplumber", mock.Mock(**{"open.return_value": pdf})), \
+                mock.patch.object(pdf_extract, "fitz", mock.Mock(**{"open.return_value": doc})), \
+                mock.patch.object(pdf_extract, "Image", mock.Mock()), \
+                mock.patch.object(pdf_extract, "pytesseract", mock.Mock(**{
+                    "image_to_string.side_effect": RuntimeError("tesseract is not installed"),
+                })):
+            results, failures = pdf_extract.extract_pages("manual.pdf", [1, 2])
+
+        self.assertEqual(results, [(1, "TEXT", "Clean the filter."), (2, "OCR FAILED", "")])
+        self.assertEqual(failures, {2: "RuntimeError: tesseract is not installed"})
+        text = pdf_extract.format_pages(results)
+        self.assertIn("--- PAGE 1 (TEXT) ---\nClean the filter.", text)
+        self.assertNotIn("PAGE 2", text)
+        self.assertNotIn("tesseract", text)
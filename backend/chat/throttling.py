@@ -0,0 +1,70 @@
+# backend/chat/throttling.py
+import math
+import os
+import threading
+import time
+
+from rest_framework.throttling import BaseThrottle
+
+from .cache_backends import LRUCache
+
+# chat messages a user may send per minute on average, and how many in a quick burst;
+# RAG_USER_RATE_PER_MINUTE=0 turns the limit off. Buckets live in each worker
+# process, so with N processes a user can get up to N times this.
+USER_RATE_PER_MINUTE = float(os.environ.get("RAG_USER_RATE_PER_MINUTE", "10"))
+USER_BURST = int(os.environ.get("RAG_USER_BURST", "5"))
+# users tracked per process; an evicted (idle) user starts again with a full bucket
+USER_BUCKETS = int(os.environ.get("RAG_USER_BUCKETS", "10000"))
+
+
+class TokenBucket:
+    """
+    Token buckets per key: each holds up to `burst` tokens and refills at `rate`
+    tokens per second. take(key) spends one token, or says how long until one is free.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = LRUCache(max_entries=max_keys, ttl=0)  # key -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """0.0 if a token was spent, else seconds until the next one."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key) or (float(self.burst), now)
+            tokens = min(float(self.burst), tokens + (now - updated_at) * self.rate)
+            if tokens >= 1.0:
+                self._buckets.set(key, (tokens - 1.0, now))
+                return 0.0
+            self._buckets.set(key, (tokens, now))
+            return (1.0 - tokens) / self.rate
+
+
+_buckets = TokenBucket(USER_RATE_PER_MINUTE / 60.0, USER_BURST, USER_BUCKETS)
+
+
+def take_chat_token(key):
+    """0 if `key` (a user) may send a chat message now, else whole seconds to wait."""
+    if USER_RATE_PER_MINUTE <= 0:
+        return 0
+    return math.ceil(_buckets.take(key))
+
+
+class ChatRateThrottle(BaseThrottle):
+    """
+    Per-user token bucket on sending chat messages (POST only; reading history is
+    not limited). DRF answers a refusal with 429 and a Retry-After header.
+    """
+
+    def allow_request(self, request, view):
+        self.retry_after = 0
+        if request.method != "POST":
+            return True
+        key = f"user:{request.user.pk}" if request.user.is_authenticated else self.get_ident(request)
+        self.retry_after = take_chat_token(key)
+        return not self.retry_after
+
+    def wait(self):
+        return self.retry_after
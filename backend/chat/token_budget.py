@@ -0,0 +1,103 @@
+# backend/chat/token_budget.py
+import logging
+import re
+
+from .chunker import count_tokens, truncate_tokens
+
+# exact counts are optional: `pip install tokenizers` and point RAG_TOKENIZER_FILE at the
+# LLM's tokenizer.json; otherwise chunker.py's word/punctuation estimate is used
+try:
+    from tokenizers import Tokenizer
+except ImportError:  # pragma: no cover - optional dependency
+    Tokenizer = None
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+# a context chunk cut to fewer tokens than this is dropped instead
+MIN_CHUNK_TOKENS = 40
+
+
+class TokenCounter:
+    """Counts and truncates text in LLM tokens (tokenizer.json) or in estimated tokens."""
+
+    def __init__(self, tokenizer_file=None):
+        self.tokenizer = None
+        if tokenizer_file and Tokenizer is not None:
+            try:
+                self.tokenizer = Tokenizer.from_file(tokenizer_file)
+            except Exception:
+                logger.exception("Loading tokenizer %s failed; estimating token counts", tokenizer_file)
+        elif tokenizer_file:
+            logger.warning("RAG_TOKENIZER_FILE needs the tokenizers package; estimating token counts")
+
+    @property
+    def exact(self):
+        return self.tokenizer is not None
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.tokenizer is None:
+            return count_tokens(text)
+        return len(self.tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def truncate(self, text, max_tokens):
+        """The prefix of `text` that fits in max_tokens."""
+        if self.tokenizer is None:
+            return truncate_tokens(text, max_tokens)
+        encoding = self.tokenizer.encode(text, add_special_tokens=False)
+        if len(encoding.ids) <= max_tokens:
+            return text
+        return text[:encoding.offsets[max_tokens][0]].rstrip()
+
+
+class PromptBudget:
+    """
+    Keeps prompts within max_prompt_tokens.
+
+    - history (the previous answer a follow-up is asked about) is cut to its
+      leading whole sentences within history_tokens, so follow-up chains stay flat
+    - the question takes at most half the budget
+    - context chunks are added best first, each cut to chunk_tokens, until the
+      budget is used up; the last one may be shortened, the rest are left out
+    """
+
+    def __init__(self, counter, max_prompt_tokens=2048, history_tokens=256, chunk_tokens=400):
+        self.counter = counter
+        self.max_prompt_tokens = max_prompt_tokens
+        self.history_tokens = history_tokens
+        self.chunk_tokens = chunk_tokens
+
+    def trim_history(self, text):
+        """Leading sentences of `text` within history_tokens (a hard cut if the first sentence is longer)."""
+        if not text or self.counter.count(text) <= self.history_tokens:
+            return text
+        kept, used = [], 0
+        for sentence in SENTENCE_END_RE.split(text):
+            tokens = self.counter.count(sentence)
+            if used + tokens > self.history_tokens:
+                break
+            kept.append(sentence)
+            used += tokens
+        return " ".join(kept) if kept else self.counter.truncate(text, self.history_tokens)
+
+    def fit(self, render, question, sections):
+        """
+        Build the largest prompt that fits: `render(question, context)` formats the
+        prompt and `sections` are (label, text) context chunks, best first.
+        Returns (prompt, prompt_tokens, number of sections used).
+        """
+        question = self.counter.truncate(question, self.max_prompt_tokens // 2)
+        used = self.counter.count(render(question, ""))
+        parts = []
+        for label, text in sections:
+            remaining = self.max_prompt_tokens - used - self.counter.count(label) - 2
+            if remaining < MIN_CHUNK_TOKENS:
+                break
+            text = self.counter.truncate(text, min(self.chunk_tokens, remaining))
+            part = f"{label}\n{text}"
+            parts.append(part)
+            used += self.counter.count(part) + 2
+        prompt = render(question, "\n\n".join(parts))
+        return prompt, self.counter.count(prompt), len(parts)
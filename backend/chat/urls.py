@@ -1,7 +1,13 @@
 from django.urls import path
-from .views import ChatMessageListCreateView, ChatSessionListCreateView
+from .views import (
+    ChatMessageDetailView, ChatMessageListCreateView, ChatMessageStreamView, ChatSessionListCreateView, chat_message_async, ready,
+)
 
 urlpatterns = [
     path("chat/", ChatMessageListCreateView.as_view(), name="chat-list-create"),
+    path("chat/<int:pk>/", ChatMessageDetailView.as_view(), name="chat-detail"),
+    path("chat/stream/", ChatMessageStreamView.as_view(), name="chat-stream"),
+    path("chat/async/", chat_message_async, name="chat-async"),
     path("sessions/", ChatSessionListCreateView.as_view(), name="session-list-create"),
+    path("health/ready/", ready, name="health-ready"),
 ]
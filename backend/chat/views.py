@@ -1,28 +1,170 @@
+import hashlib
+import json
+import logging
+
 from rest_framework import generics, permissions, serializers
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
+from rest_framework.permissions import AllowAny, IsAuthenticated
+from . import jobs
+from .admission import Overloaded, error_type
+from .metrics import CHAT_ERRORS, CHAT_REQUESTS, METRICS_TOKEN, REGISTRY, Timings, register_collectors
 from .models import ChatMessage, ChatSession
+from .pagination import ChatMessageCursorPagination, ChatSessionCursorPagination
 from .serializers import ChatMessageSerializer, ChatSessionSerializer
-from .rag_pipeline import RAGPipeline
+from .throttling import ChatRateThrottle, take_chat_token
+from .rag_pipeline import FALLBACK_ANSWER, RAGPipeline
+from .warmup import readiness
+from asgiref.sync import sync_to_async
 from django.db import transaction, IntegrityError
+from django.db.models import Count, Max
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.http import parse_etags
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException, AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.views import APIView
 
+logger = logging.getLogger(__name__)
 
 rag = RAGPipeline()
+register_collectors(rag)
+
+
+def count_outcome(endpoint, timings, exc=None):
+    """Count a handled chat message; `exc` is the error answered with FALLBACK_ANSWER."""
+    if exc is not None:
+        logger.error("Chat answer failed (%s): %s: %s", endpoint, type(exc).__name__, exc, exc_info=exc)
+        CHAT_ERRORS.inc(type=error_type(exc))
+    CHAT_REQUESTS.inc(endpoint=endpoint, outcome="error" if exc is not None else timings.outcome or "answered")
+
+
+def store_timings(chat, timings):
+    """
+    Keep the stage breakdown on the saved message (RAG_STORE_TIMINGS only). Called once
+    the "save" span has closed, so the breakdown includes it.
+    """
+    breakdown = timings.breakdown()
+    if breakdown is not None:
+        chat.timings = breakdown
+        chat.save(update_fields=["timings", "updated_at"])
+
+
+def get_or_create_session(user, brand, appliance):
+    """One ChatSession per (user, brand, appliance), safe against concurrent first messages."""
+    # Use user-specific session_id to avoid conflicts
+    session_id = f"{user.id}-{brand}-{appliance}"
+
+    # Use atomic transaction with proper error handling
+    try:
+        with transaction.atomic():
+            session, created = ChatSession.objects.get_or_create(
+                user=user,
+                appliance=appliance,
+                company=brand,
+                defaults={
+                    "session_id": session_id,
+                    "title": f"{brand.capitalize()} {appliance.capitalize()} Support",
+                }
+            )
+    except IntegrityError:
+        # Handle race condition - get existing session
+        session = ChatSession.objects.get(
+            user=user,
+            appliance=appliance,
+            company=brand
+        )
+    return session
+
+
+class UpstreamBusy(APIException):
+    """An Overloaded upstream as a DRF error: 429 (queue full) or 503 (circuit open), with Retry-After."""
+    default_detail = "The assistant is busy right now. Please try again shortly."
+    default_code = "busy"
+
+    def __init__(self, exc):
+        super().__init__()
+        self.status_code = exc.status_code
+        # DRF's exception handler turns `wait` into the Retry-After header
+        self.wait = exc.retry_after
 
-class ChatMessageListCreateView(generics.ListCreateAPIView):
+
+def busy_response(exc):
+    """UpstreamBusy for views that build their own responses."""
+    response = JsonResponse({"detail": UpstreamBusy.default_detail}, status=exc.status_code)
+    response["Retry-After"] = str(exc.retry_after)
+    return response
+
+
+class ETagListMixin:
+    """
+    Conditional GET for list views. The ETag comes from a cheap aggregate over the
+    (indexed) queryset plus the page requested, so an unchanged page answers
+    If-None-Match with 304 before any rows are fetched or serialized.
+    """
+    # fields whose Max() changes whenever a listed row is added or modified
+    etag_fields = ("id",)
+
+    def list_etag(self, request):
+        state = self.get_queryset().aggregate(
+            count=Count("id"), **{f"max_{field}": Max(field) for field in self.etag_fields}
+        )
+        raw = json.dumps([request.user.pk, request.get_full_path(), state], sort_keys=True, default=str)
+        return '"%s"' % hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def list(self, request, *args, **kwargs):
+        etag = self.list_etag(request)
+        if etag in parse_etags(request.headers.get("If-None-Match", "")):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = super().list(request, *args, **kwargs)
+        response["ETag"] = etag
+        # browsers may keep the page but must revalidate it
+        response["Cache-Control"] = "private, no-cache"
+        return response
+
+
+class ChatMessageListCreateView(ETagListMixin, generics.ListCreateAPIView):
+    """
+    GET /api/chat/?session_id=<id>   newest messages first, cursor-paginated
+                                     ({ next, previous, results }); supports If-None-Match
+    POST /api/chat/                  { message, appliance, brand } -> saved ChatMessage
+                                     with "Prefer: respond-async" (or RAG_CHAT_ASYNC_JOBS=1):
+                                     202 + pending ChatMessage, answered by a background
+                                     worker; poll the Location (/api/chat/<id>/)
+    """
     permission_classes = [IsAuthenticated]
+    throttle_classes = [ChatRateThrottle]
     serializer_class = ChatMessageSerializer
+    pagination_class = ChatMessageCursorPagination
+    # a background job answers an existing row, which changes updated_at but not id
+    etag_fields = ("id", "updated_at")
 
     def get_queryset(self):
         session_id = self.request.query_params.get("session_id")
         if not session_id:
             return ChatMessage.objects.none()
     
+        # ordered by the pagination class (newest first)
         return ChatMessage.objects.filter(
             session_id=session_id,
             user=self.request.user
-        ).order_by("timestamp")
+        )
+
+    def respond_async(self):
+        return jobs.ASYNC_JOBS or "respond-async" in self.request.headers.get("Prefer", "")
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        if response.data.get("status") == "pending":
+            response.status_code = status.HTTP_202_ACCEPTED
+            response["Location"] = reverse("chat-detail", args=[response.data["id"]])
+            response["Preference-Applied"] = "respond-async"
+            response["Retry-After"] = "1"
+        return response
 
     def perform_create(self, serializer):
         message = self.request.data.get("message")
@@ -32,57 +174,181 @@ class ChatMessageListCreateView(generics.ListCreateAPIView):
         if not appliance or not brand:
             raise serializers.ValidationError("Appliance and brand are required.")
 
-        # Use user-specific session_id to avoid conflicts
-        session_id = f"{self.request.user.id}-{brand}-{appliance}"
-        
-        # Use atomic transaction with proper error handling
-        try:
+        session = get_or_create_session(self.request.user, brand, appliance)
+
+        if self.respond_async():
+            CHAT_REQUESTS.inc(endpoint="chat", outcome="queued")
             with transaction.atomic():
-                session, created = ChatSession.objects.get_or_create(
+                chat = serializer.save(
                     user=self.request.user,
-                    appliance=appliance,
-                    company=brand,
-                    defaults={
-                        "session_id": session_id,
-                        "title": f"{brand.capitalize()} {appliance.capitalize()} Support",
-                    }
+                    session_id=session.session_id,
+                    message=message,
+                    status="pending",
                 )
-        except IntegrityError:
-            # Handle race condition - get existing session
-            session = ChatSession.objects.get(
-                user=self.request.user,
-                appliance=appliance,
-                company=brand
-            )
+                jobs.enqueue(chat, appliance, brand)
+            return
 
         # Call RAG pipeline
         # Call RAG pipeline with appliance, brand, and session_id
+        usage = {}
+        timings = Timings()
+        error = None
         try:
+            rag.admit()
             ai_answer, sources = rag.answer_query(
                 message,
                 appliance=appliance,
                 brand=brand,
                 session_id=session.session_id,  # ✅ pass session id for follow-ups
+                usage=usage,
+                timings=timings,
             )
+        except Overloaded as e:
+            # nothing is saved; the client retries after Retry-After
+            CHAT_REQUESTS.inc(endpoint="chat", outcome="busy")
+            raise UpstreamBusy(e)
         except Exception as e:
-            ai_answer = "⚠️ Sorry, I'm facing technical difficulties. Please try again later."
+            error = e
+            ai_answer = FALLBACK_ANSWER
             sources = []
+        count_outcome("chat", timings, error)
 
         # Save message with correct session reference
-        serializer.save(
-            user=self.request.user,
-            session_id=session.session_id,
-            message=message,
-            response=ai_answer,
-            sources=sources if hasattr(serializer.Meta.model, 'sources') else None
-        )
+        with timings.span("save"):
+            serializer.save(
+                user=self.request.user,
+                session_id=session.session_id,
+                message=message,
+                response=ai_answer,
+                sources=sources if hasattr(serializer.Meta.model, 'sources') else None,
+                prompt_tokens=usage.get("prompt_tokens"),
+                completion_tokens=usage.get("completion_tokens"),
+            )
+        store_timings(serializer.instance, timings)
+        timings.finish()
+
 
-class ChatSessionListCreateView(generics.ListCreateAPIView):
+class ChatMessageDetailView(generics.RetrieveAPIView):
+    """GET /api/chat/<id>/ -> one ChatMessage; poll it while its status is "pending"."""
+    permission_classes = [IsAuthenticated]
+    serializer_class = ChatMessageSerializer
+
+    def get_queryset(self):
+        return ChatMessage.objects.filter(user=self.request.user)
+
+    def retrieve(self, request, *args, **kwargs):
+        response = super().retrieve(request, *args, **kwargs)
+        response["Cache-Control"] = "private, no-cache"
+        if response.data["status"] == "pending":
+            response["Retry-After"] = "1"
+        return response
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class ChatMessageStreamView(APIView):
+    """
+    POST /api/chat/stream/
+
+    Same body as POST /api/chat/ ({ message, appliance, brand }), but the answer is
+    sent as Server-Sent Events while the LLM generates it:
+
+        event: token   data: {"text": "..."}            (repeated)
+        event: done    data: <saved ChatMessage>        (once, after the DB save)
+
+        event: busy    data: {"detail", "retry_after"}   (instead, when the LLM is overloaded)
+
+    The full answer and sources are saved to ChatMessage when the stream finishes, or
+    the text streamed so far if the client disconnects first.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [ChatRateThrottle]
+
+    def post(self, request, *args, **kwargs):
+        message = request.data.get("message")
+        appliance = request.data.get("appliance")
+        brand = request.data.get("brand")
+
+        if not message or not appliance or not brand:
+            return Response({"error": "Message, appliance and brand are required."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            rag.admit()
+        except Overloaded as e:
+            CHAT_REQUESTS.inc(endpoint="stream", outcome="busy")
+            raise UpstreamBusy(e)
+
+        session = get_or_create_session(request.user, brand, appliance)
+        user = request.user
+
+        def events():
+            ai_answer, sources = None, []
+            usage = {}
+            timings = Timings()
+            error = None
+            streamed = []
+            busy = False
+            try:
+                for kind, payload in rag.answer_query_stream(
+                    message, appliance=appliance, brand=brand, session_id=session.session_id, usage=usage,
+                    timings=timings,
+                ):
+                    if kind == "token":
+                        streamed.append(payload)
+                        yield sse("token", {"text": payload})
+                    else:
+                        ai_answer, sources = payload
+            except Overloaded as e:
+                # the queue filled up after admit(); nothing was streamed or saved
+                busy = True
+                CHAT_REQUESTS.inc(endpoint="stream", outcome="busy")
+                yield sse("busy", {"detail": UpstreamBusy.default_detail, "retry_after": e.retry_after})
+                return
+            except Exception as e:
+                # keep whatever was already shown; the saved reply explains the failure
+                error = e
+                ai_answer = FALLBACK_ANSWER
+                sources = []
+                yield sse("token", {"text": ("\n\n" if streamed else "") + FALLBACK_ANSWER})
+            finally:
+                # also runs when the client disconnects mid-stream (the generator is closed
+                # at a yield): the turn is saved with the text streamed so far
+                if not busy:
+                    if ai_answer is None:
+                        ai_answer = "".join(streamed)
+                    count_outcome("stream", timings, error)
+                    with timings.span("save"):
+                        chat = ChatMessage.objects.create(
+                            user=user,
+                            session_id=session.session_id,
+                            message=message,
+                            response=ai_answer,
+                            sources=sources,
+                            prompt_tokens=usage.get("prompt_tokens"),
+                            completion_tokens=usage.get("completion_tokens"),
+                        )
+                    store_timings(chat, timings)
+                    timings.finish()
+            yield sse("done", ChatMessageSerializer(chat).data)
+
+        response = StreamingHttpResponse(events(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        # stop nginx-style proxies from buffering the whole stream
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+class ChatSessionListCreateView(ETagListMixin, generics.ListCreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
     serializer_class = ChatSessionSerializer
+    pagination_class = ChatSessionCursorPagination
+    etag_fields = ("id", "last_activity")
 
     def get_queryset(self):
-        return ChatSession.objects.filter(user=self.request.user).order_by('-last_activity')
+        # ordered by the pagination class (newest first)
+        return ChatSession.objects.filter(user=self.request.user)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -106,11 +372,117 @@ class ChatSessionListCreateView(generics.ListCreateAPIView):
         try:
             session = ChatSession.objects.get(user=request.user, session_id=session_id)
             session.delete()
+            rag.session_contexts.delete(session_id)
             return Response({"message": "Session deleted successfully"}, status=status.HTTP_200_OK)
         except ChatSession.DoesNotExist:
             return Response({"error": "Session not found"}, status=status.HTTP_404_NOT_FOUND)
 
 
+
+
+def jwt_user(request):
+    """Authenticated user from the Bearer token, or None (DRF views get this from JWTAuthentication)."""
+    try:
+        result = JWTAuthentication().authenticate(request)
+    except (InvalidToken, AuthenticationFailed):
+        return None
+    return result[0] if result else None
+
+
+@csrf_exempt
+async def chat_message_async(request):
+    """
+    POST /api/chat/async/
+
+    Async twin of POST /api/chat/ for ASGI servers (uvicorn / daphne): same body and
+    response, but the embed and LLM calls await the network instead of holding a
+    worker thread, so one process can keep many conversations in flight.
+    """
+    if request.method != "POST":
+        return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+
+    user = await sync_to_async(jwt_user)(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided."}, status=401)
+
+    try:
+        data = json.loads(request.body or b"{}")
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON body."}, status=400)
+    message = data.get("message")
+    appliance = data.get("appliance")
+    brand = data.get("brand")
+    if not appliance or not brand:
+        return JsonResponse(["Appliance and brand are required."], status=400, safe=False)
+
+    retry_after = take_chat_token(f"user:{user.pk}")
+    if retry_after:
+        response = JsonResponse({"detail": "Request was throttled."}, status=429)
+        response["Retry-After"] = str(retry_after)
+        return response
+    try:
+        rag.admit()
+    except Overloaded as e:
+        CHAT_REQUESTS.inc(endpoint="async", outcome="busy")
+        return busy_response(e)
+
+    session = await sync_to_async(get_or_create_session)(user, brand, appliance)
+
+    usage = {}
+    timings = Timings()
+    error = None
+    try:
+        ai_answer, sources = await rag.aanswer_query(
+            message,
+            appliance=appliance,
+            brand=brand,
+            session_id=session.session_id,
+            usage=usage,
+            timings=timings,
+        )
+    except Overloaded as e:
+        CHAT_REQUESTS.inc(endpoint="async", outcome="busy")
+        return busy_response(e)
+    except Exception as e:
+        error = e
+        ai_answer = FALLBACK_ANSWER
+        sources = []
+    count_outcome("async", timings, error)
+
+    with timings.span("save"):
+        chat = await ChatMessage.objects.acreate(
+            user=user,
+            session_id=session.session_id,
+            message=message,
+            response=ai_answer,
+            sources=sources,
+            prompt_tokens=usage.get("prompt_tokens"),
+            completion_tokens=usage.get("completion_tokens"),
+        )
+    await sync_to_async(store_timings)(chat, timings)
+    timings.finish()
+    return JsonResponse(ChatMessageSerializer(chat).data, status=201)
+
+
+# ✅ Readiness probe for the load balancer: 503 until this worker's index is loaded
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def ready(request):
+    is_ready, info = readiness(rag)
+    return Response(info, status=status.HTTP_200_OK if is_ready else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+def metrics(request):
+    """
+    GET /metrics: Prometheus text format for this worker process (stage latency,
+    chat outcomes, upstream errors, admission and connection reuse, caches, job queue depth).
+    """
+    if METRICS_TOKEN and request.headers.get("Authorization", "") != f"Bearer {METRICS_TOKEN}":
+        return HttpResponse(status=401)
+    return HttpResponse(REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # from rest_framework import generics, permissions
 # from rest_framework.permissions import IsAuthenticated
 # from .models import ChatMessage, ChatSession
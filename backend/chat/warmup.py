@@ -0,0 +1,92 @@
+# backend/chat/warmup.py
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# set RAG_WARMUP=0 to go back to loading on the first chat request
+WARMUP_ENABLED = os.environ.get("RAG_WARMUP", "1") != "0"
+# also send one tiny embedding + LLM request so the first user does not pay connection setup
+WARMUP_PING_UPSTREAM = os.environ.get("RAG_WARMUP_PING", "1") != "0"
+
+_lock = threading.Lock()
+_state = {
+    "status": "cold",     # cold -> loading -> ready | failed
+    "pid": None,
+    "error": None,
+    "load_seconds": None,
+    "embed_ping": None,   # "ok" / error string / None when skipped
+    "llm_ping": None,
+}
+
+
+def _ping(fn):
+    try:
+        fn()
+        return "ok"
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+
+def warm(pipeline):
+    """Load the index/metadata/chunk store, then open connections to the embed and LLM servers."""
+    _state["status"] = "loading"
+    t0 = time.monotonic()
+    try:
+        pipeline.ensure_loaded()
+    except Exception as e:
+        _state.update(status="failed", error=f"{type(e).__name__}: {e}")
+        logger.exception("RAG warm-up failed")
+        return
+    if pipeline.reranker is not None:
+        # a cross-encoder loaded on the first request would blow that request's re-rank budget
+        pipeline.reranker.encoder()
+    _state["load_seconds"] = round(time.monotonic() - t0, 3)
+    # the index is what requests cannot work without; upstream pings are best effort
+    _state["status"] = "ready"
+
+    if WARMUP_PING_UPSTREAM:
+        _state["embed_ping"] = _ping(lambda: pipeline.embed_query("warm-up"))
+        _state["llm_ping"] = _ping(lambda: pipeline.call_llm("Reply with OK.", max_tokens=1))
+    logger.info("RAG warm-up finished: %s", _state)
+
+
+def start_warmup(pipeline=None):
+    """
+    Start warming the pipeline in a daemon thread, once per process.
+
+    Called from wsgi.py / asgi.py so every server worker warms itself at boot.
+    Safe to call more than once; only the first call in each process starts a thread.
+    """
+    if not WARMUP_ENABLED:
+        return None
+    if pipeline is None:
+        from .views import rag as pipeline
+
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return None
+        _state.update(pid=os.getpid(), status="loading", error=None)
+    thread = threading.Thread(target=warm, args=(pipeline,), name="rag-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def readiness(pipeline=None):
+    """(is_ready, status dict) for the readiness endpoint."""
+    if pipeline is None:
+        from .views import rag as pipeline
+
+    if _state["pid"] not in (None, os.getpid()) and not pipeline.is_loaded:
+        # forked from a process that started warm-up (gunicorn --preload): the state came
+        # along but the thread did not, so warm this worker now
+        start_warmup(pipeline)
+
+    status = dict(_state)
+    if pipeline.is_loaded:
+        # also covers RAG_WARMUP=0 / warm-up not started, once a request has loaded it
+        status["status"] = "ready"
+    status.pop("pid", None)
+    return status["status"] == "ready", status
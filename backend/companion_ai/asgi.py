@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'companion_ai.settings')
 
 application = get_asgi_application()
+
+# load the RAG index in the background now instead of on the first chat request
+from chat.warmup import start_warmup  # noqa: E402
+
+start_warmup()
@@ -17,8 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from chat.views import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path("metrics", metrics, name="metrics"),
     path("api/auth/", include("authapp.urls")),
     path("api/", include("chat.urls")),
 ]
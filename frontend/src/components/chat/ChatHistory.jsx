@@ -2,11 +2,17 @@ import React, { useEffect } from "react";
 import { motion } from "framer-motion";
 import { useDispatch, useSelector } from "react-redux";
 import { Clock, MessageSquare, Trash2 } from "lucide-react";
-import { fetchChatHistory, fetchSessionMessages, setCurrentSession, deleteChatSession } from "../../store/slices/chatSlice";
+import {
+  fetchChatHistory,
+  fetchOlderSessions,
+  fetchSessionMessages,
+  setCurrentSession,
+  deleteChatSession,
+} from "../../store/slices/chatSlice";
 
 const ChatHistory = () => {
   const dispatch = useDispatch();
-  const { chatHistory, historyLoading, historyError, currentSessionId } = useSelector(
+  const { chatHistory, chatHistoryNext, loadingOlder, historyLoading, historyError, currentSessionId } = useSelector(
     (state) => state.chat
   );
 
@@ -86,6 +92,15 @@ const ChatHistory = () => {
               </div>
             </motion.div>
           ))}
+          {chatHistoryNext && (
+            <button
+              onClick={() => dispatch(fetchOlderSessions(chatHistoryNext))}
+              disabled={loadingOlder}
+              className="w-full text-center text-xs text-gray-400 hover:text-white py-2 disabled:opacity-50"
+            >
+              {loadingOlder ? "Loading..." : "Load older chats"}
+            </button>
+          )}
         </div>
       )}
     </div>
@@ -2,7 +2,7 @@ import React, { useState, useRef, useEffect } from "react";
 import { motion } from "framer-motion";
 import { useDispatch, useSelector } from "react-redux";
 import { Send, Zap, Mic, MicOff } from "lucide-react";
-import { addMessage, sendMessageAPI } from "../../store/slices/chatSlice";
+import { addMessage, streamMessageAPI } from "../../store/slices/chatSlice";
 import Button from "../common/Button";
 import useSpeechRecognition from "../../hooks/useSpeechRecognition";
 
@@ -50,9 +50,9 @@ const ChatInput = () => {
     // Add user message immediately
     dispatch(addMessage(userMessage));
 
-    // Send to backend
+    // Send to backend (answer streams in token by token)
     dispatch(
-      sendMessageAPI({
+      streamMessageAPI({
         message: message.trim(),
         selectedAppliance,
         selectedBrand,
@@ -4,7 +4,7 @@ import { useDispatch, useSelector } from "react-redux";
 import { useNavigate } from "react-router-dom";
 // ===== ADDED: Settings icon for toggle button =====
 import { Bot, Menu, X, Cpu, Zap, Activity, Wifi, Settings } from "lucide-react";
-import { toggleSidebar } from "../store/slices/chatSlice";
+import { fetchOlderMessages, toggleSidebar } from "../store/slices/chatSlice";
 import { logoutUser } from "../store/slices/authSlice";
 // ===== ADDED: Import for right sidebar toggle =====
 import { toggleRightSidebar, setRightSidebarActiveTab } from "../store/slices/uiSlice";
@@ -22,9 +22,9 @@ const ChatPage = () => {
   const messagesEndRef = useRef(null);
   
   const { isAuthenticated, user } = useSelector((state) => state.auth);
-  const { messages, isTyping, sidebarOpen, selectedAppliance, selectedBrand } = useSelector(
-    (state) => state.chat
-  );
+  const {
+    messages, isTyping, sidebarOpen, selectedAppliance, selectedBrand, olderMessagesUrl, loadingOlder,
+  } = useSelector((state) => state.chat);
   // ===== ADDED: Get right sidebar state =====
   const { rightSidebarOpen, rightSidebarActiveTab } = useSelector((state) => state.ui);
 
@@ -316,6 +316,17 @@ const ChatPage = () => {
               className="flex flex-col"
             >
               <div className="flex-1 overflow-y-auto p-6 space-y-8 relative chat-scrollbar">
+                {olderMessagesUrl && messages.length > 0 && (
+                  <div className="flex justify-center">
+                    <button
+                      onClick={() => dispatch(fetchOlderMessages(olderMessagesUrl))}
+                      disabled={loadingOlder}
+                      className="text-xs text-gray-400 hover:text-white px-4 py-2 rounded-full border border-white/10 disabled:opacity-50"
+                    >
+                      {loadingOlder ? "Loading..." : "Load older messages"}
+                    </button>
+                  </div>
+                )}
                 <AnimatePresence>
                   {messages.length === 0 ? (
                     <motion.div
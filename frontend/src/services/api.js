@@ -60,6 +60,17 @@ export const chatAPI = {
   sendMessage: (message, { appliance, brand }) =>
   api.post("/chat/", { message, appliance, brand }),
 
+  // Server-Sent Events stream of the answer; uses fetch because axios can't read a streaming body
+  streamMessage: (message, { appliance, brand }) =>
+    fetch(`${API_BASE_URL}/chat/stream/`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+        Authorization: `Bearer ${localStorage.getItem("token")}`,
+      },
+      body: JSON.stringify({ message, appliance, brand }),
+    }),
+
   getMaintenanceTips: (appliance) => api.get(`/chat/tips/${appliance}`),
 
   getChatHistory: (sessionId) => api.get(`/chat/?session_id=${sessionId}`),
@@ -1,6 +1,17 @@
 import { createSlice, createAsyncThunk } from "@reduxjs/toolkit";
 import { chatAPI } from "../../services/api";
 
+// "LG_WM_1.txt#3 (pages 2-3), ..." for the sources a saved ChatMessage cites; null when none
+const formatSources = (sources) => {
+  const labels = (sources || []).map((s) => {
+    const pages = s.pages
+      ? ` (${s.pages[0] === s.pages[1] ? `page ${s.pages[0]}` : `pages ${s.pages[0]}-${s.pages[1]}`})`
+      : "";
+    return `${s.file_name}#${s.chunk_id}${pages}`;
+  });
+  return labels.length ? labels.join(", ") : null;
+};
+
 // Existing async thunk - FIXED
 export const sendMessageAPI = createAsyncThunk(
   "chat/sendMessageAPI",
@@ -14,12 +25,70 @@ export const sendMessageAPI = createAsyncThunk(
       console.log(data);
       return data;
     } catch (error) {
-      return rejectWithValue(error.message);
+      // 429 / 503 carry a "busy" detail from the server
+      return rejectWithValue(error.response?.data?.detail || error.message);
     }
   }
 );
 
 
+// Streaming version of sendMessageAPI: AI text appears token by token
+export const streamMessageAPI = createAsyncThunk(
+  "chat/streamMessageAPI",
+  async ({ message, selectedAppliance, selectedBrand }, { dispatch, requestId, rejectWithValue }) => {
+    try {
+      const response = await chatAPI.streamMessage(message, {
+        appliance: selectedAppliance,
+        brand: selectedBrand,
+      });
+      if (response.status === 429 || response.status === 503) {
+        // rate limited or the assistant is overloaded; Retry-After says when to try again
+        const body = await response.json().catch(() => ({}));
+        throw new Error(body.detail || "The assistant is busy. Please try again shortly.");
+      }
+      if (!response.ok || !response.body) {
+        throw new Error("Failed to send message");
+      }
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let saved = null;
+
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // SSE events are separated by a blank line
+        let sep;
+        while ((sep = buffer.indexOf("\n\n")) !== -1) {
+          const raw = buffer.slice(0, sep);
+          buffer = buffer.slice(sep + 2);
+          let event = "message";
+          let data = "";
+          raw.split("\n").forEach((line) => {
+            if (line.startsWith("event:")) event = line.slice(6).trim();
+            else if (line.startsWith("data:")) data += line.slice(5).trim();
+          });
+          if (!data) continue;
+          const payload = JSON.parse(data);
+          if (event === "token") {
+            dispatch(appendStreamToken({ requestId, text: payload.text }));
+          } else if (event === "done") {
+            saved = payload;
+          } else if (event === "busy") {
+            throw new Error(payload.detail);
+          }
+        }
+      }
+      return saved;
+    } catch (error) {
+      return rejectWithValue(error.message);
+    }
+  }
+);
+
 // ✅ Delete chat session
 export const deleteChatSession = createAsyncThunk(
   "chat/deleteChatSession",
@@ -64,27 +133,43 @@ export const getMaintenanceTips = createAsyncThunk(
   }
 );
 
+// Last ETag and body per history URL: the server answers an unchanged page with a
+// bodyless 304, and we reuse what we already have
+const historyCache = new Map();
+
+const fetchWithETag = async (url) => {
+  const cached = historyCache.get(url);
+  const headers = {
+    'Authorization': `Bearer ${localStorage.getItem('token')}`,
+    'Content-Type': 'application/json'
+  };
+  if (cached) headers['If-None-Match'] = cached.etag;
+
+  // no-store: we do the revalidation ourselves, so the browser must not answer from its cache
+  const response = await fetch(url, { headers, cache: "no-store" });
+  if (response.status === 304 && cached) return cached.data;
+  if (!response.ok) return null;
+
+  const data = await response.json();
+  const etag = response.headers.get('ETag');
+  if (etag) historyCache.set(url, { etag, data });
+  return data;
+};
+
 // FIXED: New async thunks for chat history
 export const fetchChatHistory = createAsyncThunk(
   "chat/fetchChatHistory",
   async (_, { rejectWithValue }) => {
     try {
-      // Fetch user's chat sessions from backend
+      // Fetch user's chat sessions from backend: first page, most recently active first
       // FIXED:
-      const token = localStorage.getItem('token');
-      const response = await fetch("http://127.0.0.1:8000/api/sessions/", {
-        headers: {
-          'Authorization': `Bearer ${token}`,
-          'Content-Type': 'application/json'
-        },
-      });
+      const data = await fetchWithETag("http://127.0.0.1:8000/api/sessions/");
       
-      if (!response.ok) {
+      if (!data) {
         throw new Error("Failed to fetch chat history");
       }
       
-      const data = await response.json();
-      return data;
+      return data; // { next, previous, results }
     } catch (error) {
       return rejectWithValue(error.message);
     }
@@ -95,20 +180,45 @@ export const fetchSessionMessages = createAsyncThunk(
   "chat/fetchSessionMessages",
   async (sessionId, { rejectWithValue }) => {
     try {
-      // Fetch messages for a specific chat session
-      const response = await fetch(`/api/chat/?session_id=${sessionId}`, {
-        headers: {
-          'Authorization': `Bearer ${localStorage.getItem('token')}`,
-          'Content-Type': 'application/json'
-        },
-      });
+      // Fetch messages for a specific chat session: latest page, newest first
+      const data = await fetchWithETag(`/api/chat/?session_id=${sessionId}`);
       
-      if (!response.ok) {
+      if (!data) {
         throw new Error("Failed to fetch session messages");
       }
       
-      const data = await response.json();
-      return data;
+      return data; // { next, previous, results }
+    } catch (error) {
+      return rejectWithValue(error.message);
+    }
+  }
+);
+
+// Older pages: follow the `next` cursor URL the server returned with the last page
+export const fetchOlderSessions = createAsyncThunk(
+  "chat/fetchOlderSessions",
+  async (url, { rejectWithValue }) => {
+    try {
+      const data = await fetchWithETag(url);
+      if (!data) {
+        throw new Error("Failed to fetch older chats");
+      }
+      return data; // { next, previous, results }
+    } catch (error) {
+      return rejectWithValue(error.message);
+    }
+  }
+);
+
+export const fetchOlderMessages = createAsyncThunk(
+  "chat/fetchOlderMessages",
+  async (url, { rejectWithValue }) => {
+    try {
+      const data = await fetchWithETag(url);
+      if (!data) {
+        throw new Error("Failed to fetch older messages");
+      }
+      return data; // { next, previous, results }
     } catch (error) {
       return rejectWithValue(error.message);
     }
@@ -129,6 +239,9 @@ const chatSlice = createSlice({
     
     // FIXED: Chat history state management
     chatHistory: [], // Array of user's chat sessions
+    chatHistoryNext: null, // URL of the next (older) page of sessions, if any
+    olderMessagesUrl: null, // URL of the page of messages before the loaded ones, if any
+    loadingOlder: false, // an older page of sessions or messages is being fetched
     currentSessionId: null, // Currently active session ID
     historyLoading: false, // Loading state for history operations
     historyError: null, // Error state for history operations
@@ -180,6 +293,17 @@ const chatSlice = createSlice({
       // Clear any history-related errors
       state.historyError = null;
     },
+    appendStreamToken: (state, action) => {
+      // Streamed AI message is keyed by the thunk's requestId until the saved id arrives
+      const { requestId, text } = action.payload;
+      let aiMessage = state.messages.find((m) => m.id === requestId);
+      if (!aiMessage) {
+        aiMessage = { id: requestId, timestamp: Date.now(), type: "ai", content: "", source: null };
+        state.messages.push(aiMessage);
+        state.isTyping = false;
+      }
+      aiMessage.content += text;
+    },
   },
   extraReducers: (builder) => {
     builder
@@ -198,7 +322,7 @@ const chatSlice = createSlice({
           timestamp: Date.now(),
           type: "ai",
           content: action.payload.response, 
-          source: null,
+          source: formatSources(action.payload.sources),
         };
         state.messages.push(aiMessage);
       })
@@ -207,6 +331,28 @@ const chatSlice = createSlice({
         state.isTyping = false;
         state.error = action.payload;
       })
+
+      // Stream message
+      .addCase(streamMessageAPI.pending, (state) => {
+        state.isLoading = true;
+        state.isTyping = true;
+        state.error = null;
+      })
+      .addCase(streamMessageAPI.fulfilled, (state, action) => {
+        state.isLoading = false;
+        state.isTyping = false;
+        const aiMessage = state.messages.find((m) => m.id === action.meta.requestId);
+        if (aiMessage && action.payload) {
+          aiMessage.id = action.payload.id;
+          aiMessage.content = action.payload.response;
+          aiMessage.source = formatSources(action.payload.sources);
+        }
+      })
+      .addCase(streamMessageAPI.rejected, (state, action) => {
+        state.isLoading = false;
+        state.isTyping = false;
+        state.error = action.payload;
+      })
       
       // Get maintenance tips
       .addCase(getMaintenanceTips.fulfilled, (state, action) => {
@@ -223,7 +369,8 @@ const chatSlice = createSlice({
       })
       .addCase(fetchChatHistory.fulfilled, (state, action) => {
         state.historyLoading = false;
-        state.chatHistory = action.payload; // Store fetched chat sessions
+        state.chatHistory = action.payload.results; // Store fetched chat sessions
+        state.chatHistoryNext = action.payload.next;
       })
       .addCase(fetchChatHistory.rejected, (state, action) => {
         state.historyLoading = false;
@@ -236,12 +383,47 @@ const chatSlice = createSlice({
       })
       .addCase(fetchSessionMessages.fulfilled, (state, action) => {
         state.isLoading = false;
-        state.messages = action.payload; // Replace current messages with session messages
+        // Replace current messages with session messages (oldest first on screen)
+        state.messages = [...action.payload.results].reverse();
+        state.olderMessagesUrl = action.payload.next;
       })
       .addCase(fetchSessionMessages.rejected, (state, action) => {
         state.isLoading = false;
         state.error = action.payload;
       })
+
+      // Older pages are appended below the sessions / above the messages already shown;
+      // a page for a list that was reloaded meanwhile (its cursor is gone) is dropped
+      .addCase(fetchOlderSessions.pending, (state) => {
+        state.loadingOlder = true;
+      })
+      .addCase(fetchOlderSessions.fulfilled, (state, action) => {
+        state.loadingOlder = false;
+        if (state.chatHistoryNext !== action.meta.arg) return;
+        const known = new Set(state.chatHistory.map((session) => session.id));
+        state.chatHistory.push(...action.payload.results.filter((session) => !known.has(session.id)));
+        state.chatHistoryNext = action.payload.next;
+      })
+      .addCase(fetchOlderSessions.rejected, (state, action) => {
+        state.loadingOlder = false;
+        state.historyError = action.payload;
+      })
+
+      .addCase(fetchOlderMessages.pending, (state) => {
+        state.loadingOlder = true;
+      })
+      .addCase(fetchOlderMessages.fulfilled, (state, action) => {
+        state.loadingOlder = false;
+        if (state.olderMessagesUrl !== action.meta.arg) return;
+        const known = new Set(state.messages.map((message) => message.id));
+        const older = [...action.payload.results].reverse().filter((message) => !known.has(message.id));
+        state.messages = [...older, ...state.messages];
+        state.olderMessagesUrl = action.payload.next;
+      })
+      .addCase(fetchOlderMessages.rejected, (state, action) => {
+        state.loadingOlder = false;
+        state.error = action.payload;
+      })
       // ✅ Delete session
       .addCase(deleteChatSession.fulfilled, (state, action) => {
         // Remove the deleted session from chatHistory
@@ -274,6 +456,7 @@ export const {
   // FIXED: Export new chat history actions
   setCurrentSession, // For setting active session
   clearHistoryError, // For clearing history errors
+  appendStreamToken,
 } = chatSlice.actions;
 
 export default chatSlice.reducer;